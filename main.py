@@ -1,21 +1,41 @@
 # Importing required libraries
 import os
-from dotenv import load_dotenv
+import uuid
 from typing import List, Tuple
 
-from torch import classes
-import streamlit as st
+# Timed from here: the heavy libraries (torch, whisper, chromadb, llama_cpp...) are imported per mode, on first use
+from modules.lazy_loader import lazy_import, startup_timer, patch_torch_classes
+from modules.warmup import warmup, start_warmup, models_installed, WARMUP_COMPONENTS
 
-from modules.streamlit_utils import init_page, render_page, display_message, avatars
-from modules.ux_utils import Locale, Translator, TextResources
-from modules.chatbot_utils import vanilla, function_call_chatbot, rag_chatbot, bluetooth_processor
-from modules.chatbot_utils.install_utils import install_models
+with startup_timer.phase("import UI (streamlit, dotenv, ux)"):
+    from dotenv import load_dotenv
+    import streamlit as st
+
+    from modules.streamlit_utils import init_page, render_page, display_message, wait_for_models, avatars
+    from modules.ux_utils import Locale, Translator, TextResources
 
 # Load dotenv
 load_dotenv()
 
+# With INFERENCE_SERVER_URL, the UI is a thin client of the inference server (server.py),
+# otherwise the models are loaded in this process (in the background, see warmup)
+USE_INFERENCE_SERVER = bool(os.getenv("INFERENCE_SERVER_URL"))
+if USE_INFERENCE_SERVER:
+    backend = lazy_import("modules.server_utils", "import inference server client")
+else:
+    backend = lazy_import("modules.chatbot_utils", "import chatbot (llama_cpp, llama_cpp_agent)")
+
+def get_backend(*components: str):
+    """
+    The chatbot functions, once the models of the given components are ready (the progress is shown meanwhile).
+    """
+    if not USE_INFERENCE_SERVER:
+        models_installed.get() # in case the chat model is not warmed up (see WARMUP_MODELS)
+    wait_for_models(warmup.names(*components), text = st.session_state.state["text"])
+    return backend
+
 # Launching and init services
-classes.__path__ = [] # Must have to avoid error (somehow)
+patch_torch_classes() # Must have to avoid error (somehow), again on every rerun in case a mode imported torch
 
 if "opened" not in st.session_state:        
     # Initialize language
@@ -47,13 +67,21 @@ if "opened" not in st.session_state:
         state = state
     )
 
-    # Welcoming message
-    if not os.getenv("MODEL_INSTALLED"):
-        install_models()
-        os.environ["MODEL_INSTALLED"] = "true"
+    # First paint is done: report the startup time (once per process)
+    if not os.getenv("STARTUP_REPORTED"):
+        startup_timer.mark("first paint")
+        print(startup_timer.format_report())
+        os.environ["STARTUP_REPORTED"] = "true"
+
+    # Load the models in the background (the LLMs and bge live in the inference server when there is one)
+    if USE_INFERENCE_SERVER:
+        start_warmup([c for c in WARMUP_COMPONENTS if c == "whisper"])
+    else:
+        start_warmup()
 
     # TODO: Get initial history from session in DB
     st.session_state.history = []
+    st.session_state.session_id = str(uuid.uuid4()) # Key of the KV-state cache of this conversation
     history = st.session_state.history
     
     # Set opened to True
@@ -100,7 +128,10 @@ if st.session_state.state["audio_transcript"]:
 
     # Get transcript from audio
     question = st.session_state.state["audio_transcript"]
-    answer, stream = vanilla(message = question, history = history, stream = True)
+    answer, stream = get_backend("chat").vanilla(
+        message = question, history = history, stream = True,
+        session_id = st.session_state.session_id
+    )
 
     # Either stream or write depending on the answer
     if stream:
@@ -122,16 +153,26 @@ elif question:
     if state["mode"] == text.RAG:
         # If file has any change, update Chroma database
         update_database = st.session_state.state.get("update_database")
-        answer, stream = rag_chatbot(
+        answer, stream = get_backend("chat", "embedding").rag_chatbot(
             message = question, history = history, stream = True,
-            n_results = 4, update_database = update_database, text = text
+            n_results = 4, update_database = update_database, text = text,
+            session_id = st.session_state.session_id
         )
     elif state["mode"] == text.FUNCTION_CALLING:
-        answer, stream = function_call_chatbot(message = question, history = history, stream = True)
+        answer, stream = get_backend("chat").function_call_chatbot(
+            message = question, history = history, stream = True,
+            session_id = st.session_state.session_id
+        )
     elif state["mode"] == text.VANILLA:
-        answer, stream = vanilla(message = question, history = history, stream = True)
+        answer, stream = get_backend("chat").vanilla(
+            message = question, history = history, stream = True,
+            session_id = st.session_state.session_id
+        )
     else:
-        answer, stream = vanilla(message = question, history = history, stream = True)
+        answer, stream = get_backend("chat").vanilla(
+            message = question, history = history, stream = True,
+            session_id = st.session_state.session_id
+        )
 
     # Either stream or write depending on the answer
     if stream:
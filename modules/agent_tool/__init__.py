@@ -1,8 +1,22 @@
-# Import the LlmStructuredOutputSettings
-from llama_cpp_agent.llm_output_settings import LlmStructuredOutputSettings
-from llama_cpp_agent.llm_output_settings import LlmStructuredOutputSettings
-from .tools import search_func, weather_func, wikipedia_func, gmail_func
-
-# Now let's create an instance of the LlmStructuredOutput class by calling the `from_functions` function of it and passing it a list of functions.
-func_list = [search_func, weather_func, wikipedia_func]
-output_settings = LlmStructuredOutputSettings.from_functions(func_list, allow_parallel_function_calling=True)
\ No newline at end of file
+# The tools and their structured output settings are built on first use (see __getattr__),
+# so importing a light submodule (e.g. bluetooth_command_utils) does not import llama_cpp_agent and the tool clients.
+from ..lazy_loader import LazyLoader
+
+def _build_output_settings():
+    # Import the LlmStructuredOutputSettings
+    from llama_cpp_agent.llm_output_settings import LlmStructuredOutputSettings
+    from .tools import search_func, weather_func, wikipedia_func
+
+    # Now let's create an instance of the LlmStructuredOutput class by calling the `from_functions` function of it and passing it a list of functions.
+    func_list = [search_func, weather_func, wikipedia_func]
+    output_settings = LlmStructuredOutputSettings.from_functions(func_list, allow_parallel_function_calling=True)
+    return func_list, output_settings
+
+_tools = LazyLoader("build function calling tools", _build_output_settings)
+
+def __getattr__(name: str):
+    if name == "func_list":
+        return _tools.get()[0]
+    if name == "output_settings":
+        return _tools.get()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
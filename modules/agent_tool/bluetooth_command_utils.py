@@ -1,4 +1,21 @@
+import os
 import re
+import threading
+from functools import lru_cache
+from typing import NamedTuple
+
+# Minimum confidence of the rule parser to skip the LLM, can be changed in .env
+FAST_PATH_CONFIDENCE = float(os.getenv("BLUETOOTH_FAST_PATH_CONFIDENCE", "0.75"))
+
+@lru_cache(maxsize = 64)
+def _only_pattern(action: str, color: str) -> re.Pattern:
+    """
+    Compiled regex of "<action> only <color>", optionally preceded by "turn " (compiled once per pair).
+    """
+    return re.compile(
+        r'\b(?:turn\s+)?' + re.escape(action) + r'\s+only\s+' + re.escape(color) + r'\b',
+        re.IGNORECASE
+    )
 
 def add_only_flags(text: str, command_string: str, colors: list[str] | None = None) -> str:
     """
@@ -33,21 +50,171 @@ def add_only_flags(text: str, command_string: str, colors: list[str] | None = No
             result_commands.append(cmd)
             continue
 
-        # Build regex to find "<action> only <color>", optionally preceded by "turn "
-        # Use word boundaries to avoid partial matches.
+        # Find "<action> only <color>", optionally preceded by "turn "
         # e.g., matches "turn off only red" or "off only red"
-        pattern = re.compile(
-            r'\b(?:turn\s+)?' + re.escape(action) + r'\s+only\s+' + re.escape(color) + r'\b',
-            re.IGNORECASE
-        )
-
-        if pattern.search(text_lower):
+        if _only_pattern(action, color).search(text_lower):
             result_commands.append(f"{action},only,{color}")
         else:
             result_commands.append(cmd)
 
     return ";".join(result_commands)
 
+### Rule parser (fast path before the LLM)
+# Vocabulary: word -> signal / color
+SIGNAL_WORDS = {
+    "on": "on", "activate": "on", "enable": "on",
+    "off": "off", "deactivate": "off", "disable": "off",
+    "blink": "blink", "blinks": "blink", "blinking": "blink", "flash": "blink", "flashes": "blink", "flashing": "blink",
+}
+COLOR_WORDS = {
+    "red": "red", "green": "green", "yellow": "yellow",
+    "all": "all", "every": "all", "everything": "all",
+}
+ONLY_WORDS = {"only", "just"}
+SEPARATOR_WORDS = {",", ";", ".", "!", "and", "then", "also", "after", "that", "plus"}
+FILLER_WORDS = {
+    "turn", "switch", "shut", "make", "set", "let", "keep", "start", "put",
+    "the", "a", "an", "please", "pls", "can", "could", "would", "you", "me", "it", "them", "to", "of",
+    "light", "lights", "lamp", "lamps", "led", "leds", "bulb", "bulbs", "one", "ones", "color", "colour", "colors", "colours",
+    "now", "too", "as", "well", "?",
+}
+# Words the rules cannot handle (negation, exceptions, choices, conditions, timing): always ask the LLM
+UNSUPPORTED_WORDS = {
+    "not", "don", "dont", "doesn", "never", "no", "but", "except", "or", "without", "unless", "if", "when", "while",
+    "until", "before", "second", "seconds", "minute", "minutes", "times", "again", "other", "others", "rest",
+}
+_TOKEN_PATTERN = re.compile(r"[a-z]+|[0-9]+|[,;.!?]")
+
+class ParseResult(NamedTuple):
+    commands: list[tuple[str, bool, str]] # (signal, only, color)
+    confidence: float
+
+    @property
+    def command_string(self) -> str:
+        """
+        Same format as bluetooth_processor: "signal,color;" or "signal,only,color;" per command.
+        """
+        return "".join(
+            f"{signal},only,{color};" if only else f"{signal},{color};"
+            for signal, only, color in self.commands
+        )
+
+class CommandParser:
+    """
+    Deterministic parser of smart light commands (e.g. "turn on only red and blink green").\n
+    The message is split into words with one precompiled regex, then a small state machine reads them:
+    a signal word sets the current signal, "only" flags the next colors, and each color becomes a command.
+    Colors written before their signal ("red on, green off") wait for the next signal.
+    A signal after the last color that no color follows ("turn on red then turn it off") is ambiguous:
+    the confidence is 0 so the LLM reads the message.
+    The confidence is the share of meaningful words the rules understood; below min_confidence the
+    message should go to the LLM.
+    """
+    def __init__(self, min_confidence: float = FAST_PATH_CONFIDENCE):
+        self.min_confidence = min_confidence
+        self._lock = threading.Lock()
+
+        # Counters
+        self.calls = 0
+        self.hits = 0
+
+    def _is_next_signal(self, words: list[str], index: int) -> bool:
+        # Next meaningful word after a color is a signal, e.g. "green off"
+        for word in words[index + 1:]:
+            if word in FILLER_WORDS:
+                continue
+            return word in SIGNAL_WORDS
+        return False
+
+    def _parse(self, text: str) -> ParseResult:
+        words = _TOKEN_PATTERN.findall(text.lower())
+        commands: list[tuple[str, bool, str]] = []
+        signal = None
+        only = False
+        waiting: list[tuple[bool, str]] = [] # colors written before their signal
+        dangling = False # the current signal has no color yet
+        after_separator = True
+        known = unknown = 0
+
+        for index, word in enumerate(words):
+            if word in UNSUPPORTED_WORDS or word.isdigit():
+                return ParseResult([], 0.0)
+            if word in SIGNAL_WORDS:
+                known += 1
+                signal = SIGNAL_WORDS[word]
+                only = False
+                commands += [(signal, waiting_only, color) for waiting_only, color in waiting]
+                dangling = not waiting
+                waiting = []
+                after_separator = False
+            elif word in ONLY_WORDS:
+                known += 1
+                only = True
+            elif word in COLOR_WORDS:
+                known += 1
+                color = COLOR_WORDS[word]
+                # "only all" means nothing, like add_only_flags; "only" flags the first color after it
+                flag = only and color != "all"
+                only = False
+                if signal is None or (after_separator and self._is_next_signal(words, index)):
+                    waiting.append((flag, color))
+                else:
+                    commands.append((signal, flag, color))
+                    dangling = False
+                after_separator = False
+            elif word in SEPARATOR_WORDS:
+                after_separator = True
+            elif word not in FILLER_WORDS:
+                unknown += 1
+
+        # A signal without a color after the colors ("... then turn it off"): not understood
+        if dangling and commands:
+            return ParseResult([], 0.0)
+
+        # A single signal without any color ("turn the lights on") applies to all lights
+        if not commands and not waiting and known == 1 and signal is not None:
+            commands = [(signal, False, "all")]
+
+        # Colors without any signal: not understood
+        if waiting or not commands:
+            return ParseResult([], 0.0)
+
+        # Remove repeated commands, keep the order
+        commands = list(dict.fromkeys(commands))
+        return ParseResult(commands, known / (known + unknown))
+
+    def parse(self, text: str) -> ParseResult:
+        """
+        Parse one message. Check result.confidence against min_confidence (or use is_confident) before using it.
+        """
+        result = self._parse(text)
+        with self._lock:
+            self.calls += 1
+            if self.is_confident(result):
+                self.hits += 1
+        return result
+
+    def parse_batch(self, texts: list[str]) -> list[ParseResult]:
+        """
+        Parse several messages at once.
+        """
+        return [self.parse(text) for text in texts]
+
+    def is_confident(self, result: ParseResult) -> bool:
+        return bool(result.commands) and result.confidence >= self.min_confidence
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hits": self.hits,
+                "fallbacks": self.calls - self.hits,
+                "hit_rate": self.hits / self.calls if self.calls else 0.0,
+            }
+
+# Global parser used by bluetooth_processor
+command_parser = CommandParser()
+
 if __name__ == "__main__":
     '''
     In this example, "on,yellow" matches "turn on only yellow" → "on,only,yellow"
@@ -65,4 +232,26 @@ if __name__ == "__main__":
 
     updated = add_only_flags(example_text, example_commands, colors=colors)
     print("Original commands: ", example_commands)
-    print("After adding 'only' flags:", updated)
\ No newline at end of file
+    print("After adding 'only' flags:", updated)
+
+    # Fast-path parser
+    for message in ["turn on only red and blink green", "Red on, green off please", "all lights off",
+                    "blink yellow if nobody is home"]:
+        result = command_parser.parse(message)
+        print(f"{message!r} -> {result.command_string!r} (confidence: {result.confidence:.2f})")
+
+    # Self-check: messages the rules must read, and messages they must leave to the LLM
+    expected = {
+        "turn on only red and blink green": "on,only,red;blink,green;",
+        "Red on, green off please": "on,red;off,green;",
+        "turn the lights on": "on,all;",
+        "blink only red and green": "blink,only,red;blink,green;",
+        "turn on only red, green": "on,only,red;on,green;",
+    }
+    for message, command_string in expected.items():
+        result = command_parser.parse(message)
+        assert command_parser.is_confident(result) and result.command_string == command_string, (message, result)
+    for message in ["turn on red then turn it off", "turn on red and also make it blink", "blink yellow if nobody is home",
+                    "turn on all but red", "turn on red or green"]:
+        assert not command_parser.is_confident(command_parser.parse(message)), message
+    print(command_parser.stats())
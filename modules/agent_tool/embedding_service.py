@@ -0,0 +1,165 @@
+# Importing required libraries
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+import numpy as np
+
+# Embedding service settings, can be changed in .env
+EMBED_BATCH_WAIT_MS = float(os.getenv("RAG_EMBED_BATCH_WAIT_MS", "5")) # how long the first request waits for others
+EMBED_MAX_BATCH = int(os.getenv("RAG_EMBED_MAX_BATCH", "32"))
+QUERY_CACHE_SIZE = int(os.getenv("RAG_QUERY_CACHE_SIZE", "1024")) # query embeddings kept (LRU)
+LATENCY_WINDOW = 1000 # requests the latency percentiles are computed on
+
+def normalize_query(text: str) -> str:
+    """
+    Cache key of a query: whitespace collapsed, lower case (bge-small-en-v1.5 is uncased).
+    """
+    return " ".join(text.split()).lower()
+
+class EmbeddingService:
+    """
+    Process-wide query embeddings, shared by every session (RAG retrieval, semantic response cache).\n
+    + LRU cache of the embeddings by normalized text: a repeated question costs no forward pass
+    + Micro-batching: the requests that arrive within EMBED_BATCH_WAIT_MS are embedded in one batched forward pass
+      (by one thread, so concurrent users do not each run a single-item pass)
+    + The same text requested twice while in flight is embedded once
+    """
+    def __init__(self, load_model: Callable[[], object], max_batch: int = EMBED_MAX_BATCH,
+                 wait_ms: float = EMBED_BATCH_WAIT_MS, cache_size: int = QUERY_CACHE_SIZE):
+        """
+        Args:
+            - load_model (Callable) : Returns the embedding model (with get_text_embedding_batch), called by the batching thread.
+            - max_batch (int) : Maximum texts per forward pass.
+            - wait_ms (float) : How long a batch waits for more requests.
+            - cache_size (int) : Query embeddings kept in the LRU cache.
+        """
+        self.load_model = load_model
+        self.max_batch = max(1, max_batch)
+        self.wait = wait_ms / 1000
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._in_flight: dict[str, Future] = {}
+        self._requests: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        # Stats
+        self.n_requests = 0
+        self.cache_hits = 0
+        self.shared = 0 # requests answered by a pass of the same text in flight
+        self.batches = 0
+        self.embedded = 0
+        self.busy_seconds = 0.0
+        self.latencies: deque[float] = deque(maxlen = LATENCY_WINDOW)
+
+    def embed(self, text: str, timeout: float = None) -> np.ndarray:
+        """
+        The embedding of a query (get_text_embedding of the model), from the cache or from the next batch.
+
+        Args:
+            - text (str) : The query.
+            - timeout (float) : Seconds to wait for the batch (None: no limit).
+        """
+        start = time.perf_counter()
+        key = normalize_query(text)
+        with self._lock:
+            self.n_requests += 1
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                self.latencies.append(time.perf_counter() - start)
+                return vector
+
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+            else:
+                future = self._in_flight[key] = Future()
+                self._requests.put((key, " ".join(text.split()), future))
+                if self._thread is None:
+                    self._thread = threading.Thread(target = self._run, name = "embedding-service", daemon = True)
+                    self._thread.start()
+
+        vector = future.result(timeout)
+        with self._lock:
+            self.latencies.append(time.perf_counter() - start)
+        return vector
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._requests.get()]
+            # Collect the requests of the next few milliseconds
+            deadline = time.perf_counter() + self.wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout = remaining))
+                except queue.Empty:
+                    break
+
+            start = time.perf_counter()
+            try:
+                vectors = self.load_model().get_text_embedding_batch([text for _, text, _ in batch])
+                results = [np.asarray(vector, dtype = np.float32) for vector in vectors]
+            except Exception as e:
+                with self._lock:
+                    for key, _, future in batch:
+                        self._in_flight.pop(key, None)
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._lock:
+                self.batches += 1
+                self.embedded += len(batch)
+                self.busy_seconds += time.perf_counter() - start
+                for (key, _, _), vector in zip(batch, results):
+                    self._cache[key] = vector
+                    self._in_flight.pop(key, None)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last = False)
+            for (_, _, future), vector in zip(batch, results):
+                future.set_result(vector)
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+            return {
+                "requests": self.n_requests,
+                "cache_hits": self.cache_hits,
+                "cache_hit_rate": round(self.cache_hits / self.n_requests, 3) if self.n_requests else 0.0,
+                "cached": len(self._cache),
+                "shared_in_flight": self.shared,
+                "batches": self.batches,
+                "avg_batch_size": round(self.embedded / self.batches, 2) if self.batches else 0.0,
+                "texts_per_second": round(self.embedded / self.busy_seconds, 1) if self.busy_seconds else 0.0,
+                "latency_ms": {
+                    "avg": round(float(latencies.mean()), 2),
+                    "p50": round(float(np.percentile(latencies, 50)), 2),
+                    "p95": round(float(np.percentile(latencies, 95)), 2),
+                },
+            }
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    # A fake model with a fixed cost per forward pass: 64 concurrent queries take a few passes instead of 64
+    class FakeModel:
+        def get_text_embedding_batch(self, texts):
+            time.sleep(0.02)
+            return [[float(len(text)), 1.0] for text in texts]
+
+    service = EmbeddingService(lambda: FakeModel())
+    questions = [f"What is EfficientNet-B{i % 8}?" for i in range(64)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = 64) as pool:
+        list(pool.map(service.embed, questions))
+    print(f"64 queries in {(time.perf_counter() - start) * 1000:.0f} ms: {service.stats()}")
@@ -0,0 +1,219 @@
+# Importing required libraries
+import os
+import re
+import math
+import threading
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+# BM25 settings
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60 # reciprocal rank fusion: 1 / (RRF_K + rank)
+
+# Words: letters and digits, joined by "-", "_" or "." inside a term ("EfficientNet-B7", "v1.5", "top_k")
+TERM_PATTERN = re.compile(r"[A-Za-z0-9]+(?:[-_.][A-Za-z0-9]+)*")
+STOPWORDS = frozenset("""
+a an and are as at be been but by can did do does for from had has have how i if in into is it its of on or our so
+such than that the their then there these they this to was we were what when where which who why will with you your
+""".split())
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lower-cased terms of a text without stopwords; a compound term also gives its parts
+    ("EfficientNet-B7" -> "efficientnet-b7", "efficientnet", "b7").
+    """
+    terms = []
+    for match in TERM_PATTERN.finditer(text):
+        term = match.group(0).lower()
+        if term in STOPWORDS:
+            continue
+        terms.append(term)
+        parts = re.split(r"[-_.]", term)
+        if len(parts) > 1:
+            terms.extend(p for p in parts if p and p not in STOPWORDS)
+    return terms
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = RRF_K) -> list[tuple[str, float]]:
+    """
+    Merge rankings (ids, best first) by reciprocal rank fusion.
+
+    Returns:
+        list[tuple[str, float]]: (id, fused score), best first.
+    """
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key = lambda item: -item[1])
+
+class BM25Index:
+    """
+    Inverted index of the chunks (term -> chunk row -> term frequency), scored with BM25.\n
+    + Built during ingestion next to the vector store, saved as compact arrays (bm25.npz: terms, offsets, rows, tfs)
+    + Same versions as the vector store: queries only see the committed chunks
+    + Deleted rows are masked, then dropped when they are half of the index
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._load()
+
+    @property
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    ### Storage
+    def _load(self) -> None:
+        self.postings: dict[str, dict[int, int]] = {}
+        self.doc_ids: list[Optional[str]] = []
+        self.lengths = np.zeros(0, dtype = np.int32)
+        self.versions = np.zeros(0, dtype = np.int64)
+        self.alive = np.zeros(0, dtype = bool)
+        if not self.exists:
+            self.index: dict[str, int] = {}
+            return
+
+        with np.load(self.path, allow_pickle = False) as data:
+            offsets, rows, tfs = data["offsets"], data["rows"], data["tfs"]
+            for i, term in enumerate(data["terms"].tolist()):
+                start, end = offsets[i], offsets[i + 1]
+                self.postings[term] = dict(zip(rows[start:end].tolist(), tfs[start:end].tolist()))
+            self.doc_ids = [doc_id or None for doc_id in data["doc_ids"].tolist()]
+            self.lengths = data["lengths"]
+            self.versions = data["versions"]
+            self.alive = data["alive"]
+        self.index = {doc_id: row for row, doc_id in enumerate(self.doc_ids) if doc_id is not None}
+
+    def persist(self) -> None:
+        with self._lock:
+            if self.alive.size and self.alive.sum() < self.alive.size // 2:
+                self._compact()
+            terms = sorted(self.postings)
+            offsets = np.zeros(len(terms) + 1, dtype = np.int64)
+            offsets[1:] = np.cumsum([len(self.postings[t]) for t in terms])
+            rows = np.fromiter((r for t in terms for r in self.postings[t]), dtype = np.int32, count = offsets[-1])
+            tfs = np.fromiter((f for t in terms for f in self.postings[t].values()), dtype = np.int32, count = offsets[-1])
+
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok = True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, terms = np.array(terms, dtype = str), offsets = offsets, rows = rows, tfs = tfs,
+                         doc_ids = np.array([doc_id or "" for doc_id in self.doc_ids], dtype = str),
+                         lengths = self.lengths, versions = self.versions, alive = self.alive)
+            os.replace(tmp_path, self.path)
+
+    def _compact(self) -> None:
+        keep = np.flatnonzero(self.alive)
+        new_rows = np.full(len(self.doc_ids), -1, dtype = np.int64)
+        new_rows[keep] = np.arange(len(keep))
+        postings = {}
+        for term, docs in self.postings.items():
+            docs = {int(new_rows[row]): tf for row, tf in docs.items() if new_rows[row] >= 0}
+            if docs:
+                postings[term] = docs
+        self.postings = postings
+        self.doc_ids = [self.doc_ids[row] for row in keep]
+        self.lengths = self.lengths[keep]
+        self.versions = self.versions[keep]
+        self.alive = np.ones(len(keep), dtype = bool)
+        self.index = {doc_id: row for row, doc_id in enumerate(self.doc_ids)}
+
+    ### Index
+    def add(self, ids: list[str], texts: list[str], versions: list[int]) -> None:
+        with self._lock:
+            self.delete([doc_id for doc_id in ids if doc_id in self.index])
+            start = len(self.doc_ids)
+            lengths = []
+            for n, text in enumerate(texts):
+                counts = Counter(tokenize(text))
+                for term, tf in counts.items():
+                    self.postings.setdefault(term, {})[start + n] = tf
+                lengths.append(sum(counts.values()))
+            self.doc_ids.extend(ids)
+            self.index.update((doc_id, start + n) for n, doc_id in enumerate(ids))
+            self.lengths = np.concatenate([self.lengths, np.array(lengths, dtype = np.int32)])
+            self.versions = np.concatenate([self.versions, np.array(versions, dtype = np.int64)])
+            self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype = bool)])
+
+    def delete(self, ids: list[str]) -> None:
+        with self._lock:
+            for doc_id in ids:
+                row = self.index.pop(doc_id, None)
+                if row is not None:
+                    self.alive[row] = False
+                    self.doc_ids[row] = None
+
+    def ids(self) -> set[str]:
+        with self._lock:
+            return set(self.index)
+
+    def count(self) -> int:
+        return len(self.index)
+
+    def clear(self) -> None:
+        with self._lock:
+            if self.exists:
+                os.remove(self.path)
+            self._load()
+
+    def query(self, text: str, n_results: int, max_version: Optional[int] = None) -> list[tuple[str, float]]:
+        """
+        BM25 top-k of a query.
+
+        Returns:
+            list[tuple[str, float]]: (chunk id, BM25 score) of the chunks with at least one query term, best first.
+        """
+        terms = tokenize(text)
+        with self._lock:
+            visible = self.alive if max_version is None else self.alive & (self.versions <= max_version)
+            n_docs = int(visible.sum())
+            if not terms or n_docs == 0 or n_results <= 0:
+                return []
+
+            avg_length = max(float(self.lengths[visible].mean()), 1.0)
+            norms = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths / avg_length)
+            scores = np.zeros(len(self.doc_ids), dtype = np.float32)
+            for term, query_tf in Counter(terms).items():
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                rows = np.fromiter(docs.keys(), dtype = np.int64, count = len(docs))
+                tfs = np.fromiter(docs.values(), dtype = np.float32, count = len(docs))
+                mask = visible[rows]
+                rows, tfs = rows[mask], tfs[mask]
+                if rows.size == 0:
+                    continue
+                idf = math.log(1 + (n_docs - rows.size + 0.5) / (rows.size + 0.5))
+                scores[rows] += query_tf * idf * tfs * (BM25_K1 + 1) / (tfs + norms[rows])
+
+            matched = np.flatnonzero(scores > 0)
+            if matched.size == 0:
+                return []
+            k = min(n_results, matched.size)
+            top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+            top = top[np.argsort(-scores[top])]
+            return [(self.doc_ids[row], float(scores[row])) for row in top]
+
+    def stats(self) -> dict:
+        return {"chunks": self.count(), "terms": len(self.postings),
+                "postings": sum(len(docs) for docs in self.postings.values())}
+
+if __name__ == "__main__":
+    import tempfile
+
+    chunks = {
+        "a": "EfficientNet-B7 achieves 84.3% top-1 accuracy on ImageNet with 66M parameters.",
+        "b": "Feature Pyramid Networks (FPN) build high-level semantic feature maps at all scales.",
+        "c": "Compound scaling uniformly scales network width, depth and resolution.",
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        index = BM25Index(os.path.join(folder, "bm25.npz"))
+        index.add(list(chunks), list(chunks.values()), [1, 1, 1])
+        index.persist()
+        reopened = BM25Index(index.path)
+        for query in ("EfficientNet-B7", "FPN", "how does compound scaling work"):
+            print(f"{query!r:40} {reopened.query(query, 2)}")
+        print(reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]]))
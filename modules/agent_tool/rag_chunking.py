@@ -0,0 +1,158 @@
+# Importing required libraries
+import os
+import re
+import hashlib
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from ..lazy_loader import LazyLoader, lazy_import
+
+# Chunking settings, can be changed in .env
+# bge-small-en-v1.5 reads at most 512 tokens: longer texts are truncated by the embedding model
+CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "384"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("RAG_CHUNK_OVERLAP", "64"))
+MIN_CHUNK_TOKENS = 32 # a smaller tail is merged into the previous chunk
+MIN_SECTION_CHARS = 200 # a smaller section is merged into the previous one
+
+# The chunks are measured with the tokenizer of the embedding model (no weights, no torch)
+TOKENIZER_NAME = "BAAI/bge-small-en-v1.5"
+transformers = lazy_import("transformers")
+tokenizer = LazyLoader(f"load tokenizer {TOKENIZER_NAME}", lambda: transformers.AutoTokenizer.from_pretrained(TOKENIZER_NAME))
+
+# Headings of papers and documents: "1 Introduction", "3.2. Model scaling", "Abstract", "# Title", "RELATED WORK"
+HEADING_PATTERN = re.compile(
+    r"^(?:#{1,6}\s+.+"
+    r"|(?:\d+(?:\.\d+)*\.?|[IVX]+\.)\s+[A-Z][^\n.]{1,80}"
+    r"|(?:Abstract|Introduction|Conclusions?|References|Acknowledg(?:e)?ments?|Appendix[^\n]{0,60})"
+    r"|[A-Z][A-Z0-9 \-:]{3,60})$",
+    re.MULTILINE
+)
+# Preferred places to end a chunk, best first
+BREAK_PATTERNS = (re.compile(r"\n\s*\n"), re.compile(r"[.!?][\"')\]]?\s"), re.compile(r"[;:,]\s"))
+
+class Chunk(NamedTuple):
+    id: str
+    text: str
+    file: str
+    page: Optional[int]
+    start: int # character offsets of the chunk in the page (or document) text
+    end: int
+    section: str
+
+    @property
+    def embed_text(self) -> str:
+        # The section title gives context to chunks from the middle of a section
+        return f"{self.section}\n{self.text}" if self.section and not self.text.startswith(self.section) else self.text
+
+    @property
+    def metadata(self) -> dict:
+        # Chroma metadata values cannot be None
+        return {"file": self.file, "page": self.page if self.page is not None else -1,
+                "start": self.start, "end": self.end, "section": self.section}
+
+def split_sections(text: str) -> list[tuple[str, int, int]]:
+    """
+    Split a text at its headings.
+
+    Returns:
+        list[tuple[str, int, int]]: (heading, start, end) of each section; the text before the first heading has heading "".
+    """
+    starts = [(m.group(0).strip().lstrip("#").strip(), m.start()) for m in HEADING_PATTERN.finditer(text)]
+    if not starts or starts[0][1] > 0:
+        starts.insert(0, ("", 0))
+    sections = []
+    for i, (heading, start) in enumerate(starts):
+        end = starts[i + 1][1] if i + 1 < len(starts) else len(text)
+        if not text[start:end].strip():
+            continue
+        # A tiny section (a false heading, a caption...) is merged into the previous one
+        if sections and end - start < MIN_SECTION_CHARS:
+            sections[-1] = (sections[-1][0], sections[-1][1], end)
+        else:
+            sections.append((heading, start, end))
+    return sections
+
+def _break_at(text: str, start: int, end: int, min_end: int) -> int:
+    """
+    The best place to end a chunk in text[min_end:end] (paragraph, sentence, clause), else end.
+    """
+    window = text[min_end:end]
+    for pattern in BREAK_PATTERNS:
+        matches = list(pattern.finditer(window))
+        if matches:
+            return min_end + matches[-1].end()
+    return end
+
+def chunk_text(text: str, file: str, page: Optional[int] = None,
+               chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> list[Chunk]:
+    """
+    Split a page (or a document) into chunks of at most chunk_tokens tokens, with overlap_tokens tokens of overlap.
+    Chunks never cross a heading, and end at a paragraph or sentence boundary when one is near.
+
+    Args:
+        - text (str) : The text of the page.
+        - file (str) : The file name (metadata).
+        - page (int) : The page number (metadata), None for files without pages.
+        - chunk_tokens (int) : Maximum tokens per chunk (embedding model tokens).
+        - overlap_tokens (int) : Tokens repeated at the start of the next chunk.
+
+    Returns:
+        list[Chunk]: The chunks, with their character offsets in text.
+    """
+    chunks: list[Chunk] = []
+    prefix = f"{file}:{page if page is not None else 0}"
+    for section, section_start, section_end in split_sections(text):
+        # One tokenization per section: the offsets map tokens back to characters
+        encoding = tokenizer.get()(text[section_start:section_end], add_special_tokens = False,
+                                   return_offsets_mapping = True)
+        offsets = [(section_start + s, section_start + e) for s, e in encoding["offset_mapping"]]
+        if not offsets:
+            continue
+
+        first = 0
+        previous_last = 0 # end (exclusive) of the previous chunk of the section
+        while first < len(offsets):
+            last = min(first + chunk_tokens, len(offsets)) # exclusive
+            start = offsets[first][0]
+            end = offsets[last - 1][1]
+
+            # Not the end of the section: end at a natural boundary in the last quarter of the window
+            if last < len(offsets):
+                min_end = offsets[first + (last - first) * 3 // 4][0]
+                end = _break_at(text, start, end, min_end)
+                while last > first + 1 and offsets[last - 1][0] >= end:
+                    last -= 1
+
+            # A tail with few new tokens (the overlap aside) is merged into the previous chunk of the section
+            if chunks and first > 0 and last - previous_last < MIN_CHUNK_TOKENS and chunks[-1].section == section:
+                previous = chunks.pop()
+                start = previous.start
+
+            chunk = text[start:end].strip()
+            if chunk:
+                digest = hashlib.sha1(chunk.encode("utf-8")).hexdigest()[:8]
+                chunks.append(Chunk(f"{prefix}:{len(chunks)}:{digest}", chunk, file, page, start, end, section))
+            if last >= len(offsets):
+                break
+            previous_last = last
+            first = max(last - overlap_tokens, first + 1)
+    return chunks
+
+def chunk_pages(pages: Iterable[tuple[str, Optional[int], str]]) -> Iterator[Chunk]:
+    """
+    Chunk the pages of documents.
+
+    Args:
+        - pages (Iterable[tuple[str, Optional[int], str]]) : (file, page, text) records.
+    """
+    for file, page, text in pages:
+        yield from chunk_text(text, file, page)
+
+if __name__ == "__main__":
+    sample = (
+        "Abstract\nWe study how to scale convolutional networks. " * 20 + "\n\n"
+        "1 Introduction\n" + "Scaling up ConvNets is widely used to achieve better accuracy. " * 80 + "\n\n"
+        "2 Related Work\nConvNet accuracy has improved a lot. " * 10
+    )
+    for chunk in chunk_text(sample, "sample.pdf", page = 1):
+        n_tokens = len(tokenizer.get()(chunk.text, add_special_tokens = False)["input_ids"])
+        print(f"{chunk.id:<28} section={chunk.section!r:<20} chars={chunk.start}-{chunk.end} tokens={n_tokens}")
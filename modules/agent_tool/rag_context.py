@@ -0,0 +1,198 @@
+# Importing required libraries
+import os
+import re
+import time
+import threading
+from collections import deque
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+from .vector_store import Hit
+
+# Context settings, can be changed in .env
+CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1024")) # token budget of the retrieved context in the prompt
+MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7")) # 1: relevance only, 0: diversity only
+DUPLICATE_SIMILARITY = float(os.getenv("RAG_DUPLICATE_SIMILARITY", "0.92")) # cosine above which a chunk is a near-duplicate
+CONTEXT_CANDIDATES = 20 # retrieved chunks the context is selected from
+MIN_TRUNCATED_TOKENS = 48 # the last chunk is cut to the remaining budget only if that leaves this many tokens
+MAX_RECORDED_REQUESTS = 20
+
+SENTENCE_END = re.compile(r"[.!?][\"')\]]?\s")
+
+class PackedContext(NamedTuple):
+    text: str
+    hits: list[Hit] # the chunks in the context, in order
+    n_tokens: int # tokens of text (tokenizer of the chat model)
+    n_candidates: int
+    n_duplicates: int # near-duplicates dropped
+    truncated: bool # the last chunk was cut to fit the budget
+
+def mmr_order(relevance: np.ndarray, vectors: np.ndarray, lambda_: float = MMR_LAMBDA,
+              duplicate_similarity: float = DUPLICATE_SIMILARITY) -> tuple[list[int], int]:
+    """
+    Order candidates by maximal marginal relevance: each step takes the candidate with the best
+    lambda * relevance - (1 - lambda) * (max similarity to the chunks already taken).
+
+    Args:
+        - relevance (np.ndarray) : Relevance of each candidate in [0, 1].
+        - vectors (np.ndarray) : Normalized embeddings of the candidates.
+        - lambda_ (float) : Weight of the relevance against the diversity.
+        - duplicate_similarity (float) : Candidates this similar to a taken chunk are dropped.
+
+    Returns:
+        tuple[list[int], int]: The candidate indices in MMR order, and the number of dropped near-duplicates.
+    """
+    similarity = vectors @ vectors.T
+    remaining = list(range(len(relevance)))
+    max_similarity = np.full(len(relevance), -1.0, dtype = np.float32)
+    order, n_duplicates = [], 0
+    while remaining:
+        scores = lambda_ * relevance[remaining] - (1 - lambda_) * np.maximum(max_similarity[remaining], 0.0)
+        best = remaining.pop(int(np.argmax(scores)))
+        if max_similarity[best] >= duplicate_similarity:
+            n_duplicates += 1
+            continue
+        order.append(best)
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return order, n_duplicates
+
+def chunk_header(hit: Hit, number: int) -> str:
+    """
+    "[Chunk 1] (paper.pdf, page 3, 2 Related Work)": where the chunk comes from, for the model and for citations.
+    """
+    meta = hit.metadata or {}
+    source = [meta.get("file", "")]
+    if isinstance(meta.get("page"), int) and meta["page"] >= 0:
+        source.append(f"page {meta['page']}")
+    source.append(meta.get("section", ""))
+    source = ", ".join(s for s in source if s)
+    return f"[Chunk {number}] ({source})" if source else f"[Chunk {number}]"
+
+def truncate_to_tokens(text: str, n_tokens: int, count_tokens: Callable[[str], int]) -> str:
+    """
+    The longest start of text with at most n_tokens tokens, ending at a sentence when possible.
+    """
+    total = count_tokens(text)
+    if total <= n_tokens:
+        return text
+    end = len(text) * n_tokens // max(total, 1)
+    while end > 0:
+        cut = text[:end]
+        sentences = list(SENTENCE_END.finditer(cut))
+        if sentences and sentences[-1].end() > end // 2:
+            cut = cut[:sentences[-1].end()]
+        cut = cut.rstrip()
+        if count_tokens(cut) <= n_tokens:
+            return cut
+        end = end * 9 // 10
+    return ""
+
+def pack_context(hits: list[Hit], vectors: np.ndarray, count_tokens: Callable[[str], int],
+                 token_budget: int = CONTEXT_TOKENS, max_chunks: Optional[int] = None,
+                 lambda_: float = MMR_LAMBDA) -> PackedContext:
+    """
+    Assemble the context of a RAG prompt: chunks in MMR order, near-duplicates dropped, within a token budget.
+
+    Args:
+        - hits (list[Hit]) : The retrieved chunks, best first (any score: cosine, BM25 or fused).
+        - vectors (np.ndarray) : Their normalized embeddings (for the diversity).
+        - count_tokens (Callable[[str], int]) : Counts the tokens of a text with the tokenizer of the chat model.
+        - token_budget (int) : Maximum tokens of the context.
+        - max_chunks (int) : Maximum chunks of the context (None: only the budget).
+        - lambda_ (float) : MMR weight of the relevance against the diversity.
+
+    Returns:
+        PackedContext: The context and how it was built.
+    """
+    if not hits:
+        return PackedContext("", [], 0, 0, 0, False)
+
+    # Relevance in [0, 1] from the scores of the retriever
+    scores = np.array([hit.score for hit in hits], dtype = np.float32)
+    spread = float(scores.max() - scores.min())
+    relevance = (scores - scores.min()) / spread if spread > 0 else np.ones(len(hits), dtype = np.float32)
+    order, n_duplicates = mmr_order(relevance, vectors, lambda_)
+
+    parts, chosen, used, truncated = [], [], 0, False
+    separator_tokens = count_tokens("\n\n")
+    for index in order:
+        if max_chunks is not None and len(chosen) >= max_chunks:
+            break
+        hit = hits[index]
+        header = chunk_header(hit, len(chosen) + 1)
+        part = f"{header}\n{hit.document.strip()}"
+        n_tokens = count_tokens(part) + (separator_tokens if parts else 0)
+        if used + n_tokens <= token_budget:
+            parts.append(part)
+            chosen.append(hit)
+            used += n_tokens
+            continue
+
+        # The best remaining chunk does not fit: cut it to what is left of the budget, then stop
+        remaining = token_budget - used - count_tokens(header) - (separator_tokens if parts else 0)
+        if remaining >= MIN_TRUNCATED_TOKENS:
+            document = truncate_to_tokens(hit.document.strip(), remaining, count_tokens)
+            if document:
+                parts.append(f"{header}\n{document}")
+                chosen.append(hit)
+                truncated = True
+        break
+
+    text = "\n\n".join(parts)
+    return PackedContext(text, chosen, count_tokens(text) if text else 0, len(hits), n_duplicates, truncated)
+
+class ContextMetrics:
+    """
+    Token counts of the last RAG requests (context and whole prompt), for /metrics.
+    """
+    def __init__(self, max_requests: int = MAX_RECORDED_REQUESTS):
+        self.requests: deque[dict] = deque(maxlen = max_requests)
+        self.n_requests = 0
+        self.total_prompt_tokens = 0
+        self.total_context_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, packed: PackedContext, prompt_tokens: int, session_id: Optional[str] = None) -> None:
+        with self._lock:
+            self.n_requests += 1
+            self.total_prompt_tokens += prompt_tokens
+            self.total_context_tokens += packed.n_tokens
+            self.requests.append({
+                "time": round(time.time(), 3),
+                "session_id": session_id,
+                "prompt_tokens": prompt_tokens,
+                "context_tokens": packed.n_tokens,
+                "chunks": len(packed.hits),
+                "candidates": packed.n_candidates,
+                "duplicates": packed.n_duplicates,
+                "truncated": packed.truncated,
+            })
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.n_requests,
+                "avg_prompt_tokens": round(self.total_prompt_tokens / self.n_requests, 1) if self.n_requests else 0.0,
+                "avg_context_tokens": round(self.total_context_tokens / self.n_requests, 1) if self.n_requests else 0.0,
+                "token_budget": CONTEXT_TOKENS,
+                "last": list(self.requests),
+            }
+
+# Global metrics of the process
+context_metrics = ContextMetrics()
+
+if __name__ == "__main__":
+    # Three chunks, two of them nearly the same: the duplicate is dropped, the rest fits a small budget
+    rng = np.random.default_rng(0)
+    base = rng.standard_normal((2, 16)).astype(np.float32)
+    vectors = np.stack([base[0], base[0] + 0.01 * rng.standard_normal(16).astype(np.float32), base[1]])
+    vectors /= np.linalg.norm(vectors, axis = 1, keepdims = True)
+    hits = [
+        Hit("a", 0.9, "EfficientNet-B7 reaches 84.3% top-1 accuracy. " * 5, {"file": "efficientnet.pdf", "page": 1, "section": "Abstract"}),
+        Hit("b", 0.89, "EfficientNet-B7 reaches 84.3% top-1 accuracy. " * 5, {"file": "efficientnet.pdf", "page": 1, "section": "Abstract"}),
+        Hit("c", 0.7, "Compound scaling balances width, depth and resolution. " * 20, {"file": "efficientnet.pdf", "page": 3, "section": "3 Compound Model Scaling"}),
+    ]
+    packed = pack_context(hits, vectors, lambda text: len(text.split()), token_budget = 120)
+    print(packed.text)
+    print(f"{packed.n_tokens} tokens, {len(packed.hits)} chunks, {packed.n_duplicates} duplicates, truncated: {packed.truncated}")
@@ -0,0 +1,107 @@
+# Importing required libraries
+import time
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+MAX_FINISHED_JOBS = 20
+
+class IngestionJob:
+    """
+    One sync of the document folder (parse -> chunk -> embed -> upsert -> commit), with its progress.
+    """
+    def __init__(self, job_id: int, reason: str):
+        self.id = job_id
+        self.reason = reason
+        self.state = "queued" # queued -> running -> done | failed
+        self.progress = 0.0
+        self.step = ""
+        self.error: Optional[str] = None
+        self.summary = ""
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.done = threading.Event()
+
+    def status(self) -> dict:
+        return {
+            "id": self.id,
+            "reason": self.reason,
+            "state": self.state,
+            "progress": round(self.progress, 3),
+            "step": self.step,
+            "error": self.error,
+            "summary": self.summary,
+            "seconds": round((self.finished_at or time.time()) - self.created_at, 2),
+        }
+
+class IngestionQueue:
+    """
+    Run index syncs in the background, off the request path.\n
+    + Jobs run one at a time (each one commits a new index version); a job submitted while another one is
+      queued is merged into it, since a sync covers every change of the folder
+    + Queries keep using the last committed version while a job runs
+    """
+    def __init__(self, sync: Callable[[Callable[[float, str], None]], object]):
+        """
+        Args:
+            - sync (Callable) : Syncs the index, reporting progress(fraction, step). Its result is shown as the job summary.
+        """
+        self.sync = sync
+        self._executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "rag-ingest")
+        self._jobs: deque[IngestionJob] = deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, reason: str = "update") -> IngestionJob:
+        """
+        Queue a sync of the document folder (or return the one that is already queued).
+        """
+        with self._lock:
+            for job in self._jobs:
+                if job.state == "queued":
+                    return job
+            job = IngestionJob(next(self._ids), reason)
+            self._jobs.append(job)
+            finished = [j for j in self._jobs if j.done.is_set()]
+            for old in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                self._jobs.remove(old)
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job: IngestionJob) -> None:
+        def progress(fraction: float, step: str = "") -> None:
+            job.progress = min(max(fraction, job.progress), 1.0)
+            job.step = step or job.step
+
+        job.state = "running"
+        try:
+            job.summary = str(self.sync(progress) or "")
+            job.progress = 1.0
+            job.state = "done"
+        except Exception as e:
+            job.state = "failed"
+            job.error = str(e)
+            print(f">>> Ingestion job {job.id} failed: {e}")
+        finally:
+            job.finished_at = time.time()
+            job.done.set()
+
+    def busy(self) -> bool:
+        return any(not job.done.is_set() for job in self._jobs)
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Wait until every submitted job is over. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for job in list(self._jobs):
+            remaining = None if deadline is None else max(0.0, deadline - time.time())
+            if not job.done.wait(remaining):
+                return False
+        return True
+
+    def jobs(self) -> list[dict]:
+        with self._lock:
+            return [job.status() for job in self._jobs]
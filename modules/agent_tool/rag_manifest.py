@@ -0,0 +1,121 @@
+# Importing required libraries
+import os
+import json
+import hashlib
+import threading
+from typing import NamedTuple
+
+# Files that can be indexed (the others in the document folder are ignored)
+INDEXED_EXTENSIONS = (".pdf", ".docx", ".doc", ".txt", ".md", ".pptx", ".ppt", ".csv", ".html", ".htm", ".json")
+HASH_CHUNK_BYTES = 1 << 20
+
+class FileState(NamedTuple):
+    size: int
+    mtime: float
+    sha256: str
+
+class SyncPlan(NamedTuple):
+    added: list[str]     # new files
+    changed: list[str]   # files whose content changed
+    removed: list[str]   # files that are gone
+    unchanged: list[str]
+    states: dict[str, FileState] # current state of the added and changed files
+
+    @property
+    def to_index(self) -> list[str]:
+        return self.added + self.changed
+
+    def __str__(self) -> str:
+        return f"+{len(self.added)} new, ~{len(self.changed)} changed, -{len(self.removed)} removed, {len(self.unchanged)} unchanged"
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class IndexManifest:
+    """
+    What is in the index: file name -> (size, mtime, content hash, chunk ids).\n
+    Used to re-index only new and changed files, and to delete the chunks of removed files.
+    Unchanged size and mtime skip the hash; a touched file with the same content is not re-indexed.
+
+    version is the last committed version of the index: chunks of a newer version are not visible to queries yet.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.version, self.files = self._read()
+
+    def _read(self) -> tuple[int, dict]:
+        if not os.path.exists(self.path):
+            return 0, {}
+        try:
+            with open(self.path, "r", encoding = "utf-8") as f:
+                data = json.load(f)
+            return data.get("version", 0), data.get("files", {})
+        except (OSError, json.JSONDecodeError) as e:
+            print(f">>> Cannot read the index manifest {self.path}, the documents will be re-indexed: {e}")
+            return 0, {}
+
+    def save(self) -> None:
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok = True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding = "utf-8") as f:
+                json.dump({"version": self.version, "files": self.files}, f, indent = 1)
+            os.replace(tmp_path, self.path)
+
+    def plan(self, input_dir: str) -> SyncPlan:
+        """
+        Compare the document folder with the manifest.
+        """
+        names = sorted(
+            name for name in os.listdir(input_dir)
+            if name.lower().endswith(INDEXED_EXTENSIONS) and os.path.isfile(os.path.join(input_dir, name))
+        ) if os.path.isdir(input_dir) else []
+
+        added, changed, unchanged, states = [], [], [], {}
+        for name in names:
+            stat = os.stat(os.path.join(input_dir, name))
+            entry = self.files.get(name)
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                unchanged.append(name)
+                continue
+
+            sha256 = file_sha256(os.path.join(input_dir, name))
+            if entry is not None and entry["sha256"] == sha256:
+                # Touched but not modified: only the mtime is updated
+                entry["mtime"] = stat.st_mtime
+                unchanged.append(name)
+                continue
+            states[name] = FileState(stat.st_size, stat.st_mtime, sha256)
+            (changed if entry is not None else added).append(name)
+
+        removed = [name for name in self.files if name not in names]
+        return SyncPlan(added, changed, removed, unchanged, states)
+
+    def chunk_ids(self, name: str) -> list[str]:
+        entry = self.files.get(name)
+        return list(entry["chunk_ids"]) if entry else []
+
+    def set(self, name: str, state: FileState, chunk_ids: list[str]) -> None:
+        with self._lock:
+            self.files[name] = {**state._asdict(), "chunk_ids": chunk_ids}
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            self.files.pop(name, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.version = 0
+            self.files = {}
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "files": len(self.files),
+            "chunks": sum(len(entry["chunk_ids"]) for entry in self.files.values()),
+        }
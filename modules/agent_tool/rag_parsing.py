@@ -0,0 +1,171 @@
+# Importing required libraries
+import os
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator, NamedTuple, Optional
+
+from .rag_chunking import Chunk, chunk_text
+
+# Parsing settings, can be changed in .env
+# RAG_PARSE_PROCESSES=0: parse in the calling process (no pool, the default on a single core)
+_CORES = os.cpu_count() or 1
+PARSE_PROCESSES = int(os.getenv("RAG_PARSE_PROCESSES", str(min(4, _CORES) if _CORES > 1 else 0)))
+PAGES_PER_TASK = int(os.getenv("RAG_PAGES_PER_TASK", "16")) # a long PDF is split into page ranges parsed in parallel
+MAX_PENDING_TASKS = 2 # tasks parsed ahead of the embedder, per process (bounds the memory)
+
+class ParseTask(NamedTuple):
+    path: str
+    first_page: int = 0 # page range of a PDF (0-based, end excluded); other files are parsed whole
+    end_page: Optional[int] = None
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+class ParsedPart(NamedTuple):
+    name: str # file name
+    last: bool # last part of the file: all its chunks were yielded
+    chunks: list[Chunk]
+    error: Optional[str]
+
+def parse_tasks(path: str, pages_per_task: int = PAGES_PER_TASK) -> list[ParseTask]:
+    """
+    Split a file into parse tasks: page ranges for a PDF, the whole file otherwise.
+    """
+    if not path.lower().endswith(".pdf"):
+        return [ParseTask(path)]
+    import pypdf
+    n_pages = len(pypdf.PdfReader(path).pages)
+    return [ParseTask(path, first, min(first + pages_per_task, n_pages)) for first in range(0, n_pages, pages_per_task)] \
+        or [ParseTask(path, 0, 0)]
+
+def read_pages(task: ParseTask) -> Iterator[tuple[str, Optional[int], str]]:
+    """
+    Parse a task into (file, page, text) records, one page at a time (one record per file without pages).
+    """
+    if task.end_page is not None:
+        import pypdf
+        reader = pypdf.PdfReader(task.path)
+        labels = reader.page_labels
+        for i in range(task.first_page, task.end_page):
+            # Same page numbers as the llama_index PDF reader
+            label = labels[i] if i < len(labels) else str(i + 1)
+            yield task.name, int(label) if label.isdigit() else None, reader.pages[i].extract_text() or ""
+        return
+
+    from llama_index.core import SimpleDirectoryReader
+    for d in SimpleDirectoryReader(input_files = [task.path]).load_data():
+        page = d.metadata.get("page_label")
+        yield task.name, int(page) if page is not None and str(page).isdigit() else None, d.get_content()
+
+def parse_and_chunk(task: ParseTask) -> list[Chunk]:
+    """
+    Parse and chunk a task (runs in the parser processes).
+    """
+    return [chunk for file, page, text in read_pages(task) for chunk in chunk_text(text, file, page)]
+
+def _init_parser() -> None:
+    # One process per core already: no thread pool in the tokenizer
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+class ParserPool:
+    """
+    Parse and chunk documents in a process pool and stream the chunks to the embedder.\n
+    + Files are parsed in parallel, long PDFs in page ranges: the parse time scales with the cores
+    + At most MAX_PENDING_TASKS tasks per process are parsed ahead of the consumer, so the memory stays bounded
+      however big the folder is
+    + The parts are yielded in the order of the files, as soon as each is ready
+    """
+    def __init__(self, n_processes: int = PARSE_PROCESSES):
+        self.n_processes = n_processes
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Started on first use, kept for the next syncs (spawn: the parent holds threads and torch)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers = self.n_processes, mp_context = mp.get_context("spawn"), initializer = _init_parser
+            )
+        return self._executor
+
+    def parse(self, paths: list[str]) -> Iterator[ParsedPart]:
+        """
+        Parse and chunk files.
+
+        Args:
+            - paths (list[str]) : The files to parse.
+
+        Returns:
+            Iterator[ParsedPart]: The chunks of each part of each file, in order. A file that failed yields
+            one part with its error (and no chunks); the parts already yielded for it must be discarded.
+        """
+        # Planning is cheap (PDF page counts), done lazily so the first file is parsed at once
+        def tasks() -> Iterator[tuple[ParseTask, bool, Optional[Exception]]]:
+            for path in paths:
+                try:
+                    file_tasks = parse_tasks(path)
+                except Exception as e:
+                    yield ParseTask(path), True, e
+                    continue
+                for i, task in enumerate(file_tasks):
+                    yield task, i == len(file_tasks) - 1, None
+
+        def run(task: ParseTask, error: Optional[Exception]) -> Future:
+            future = Future()
+            if error is not None:
+                future.set_exception(error)
+            elif self.n_processes <= 0:
+                try:
+                    future.set_result(parse_and_chunk(task))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                future = self._get_executor().submit(parse_and_chunk, task)
+            return future
+
+        pending: deque[tuple[ParseTask, bool, Future]] = deque()
+        failed: set[str] = set()
+        task_iter = tasks()
+        max_pending = max(1, self.n_processes * MAX_PENDING_TASKS)
+        while True:
+            # Keep the pool busy, up to the bound
+            for task, last, error in task_iter:
+                pending.append((task, last, run(task, error)))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                return
+
+            task, last, future = pending.popleft()
+            if task.name in failed:
+                continue
+            try:
+                yield ParsedPart(task.name, last, future.result(), None)
+            except Exception as e:
+                failed.add(task.name)
+                yield ParsedPart(task.name, True, [], str(e))
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures = True)
+            self._executor = None
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import tracemalloc
+    from .tool_rag import DOCUMENT_DIR
+
+    # python -m modules.agent_tool.rag_parsing [folder]
+    folder = sys.argv[1] if len(sys.argv) > 1 else DOCUMENT_DIR
+    paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))]
+    tracemalloc.start()
+    for n_processes in (0, PARSE_PROCESSES):
+        pool = ParserPool(n_processes)
+        start = time.perf_counter()
+        n_chunks = sum(len(part.chunks) for part in pool.parse(paths))
+        pool.close()
+        print(f"{n_processes} processes: {n_chunks} chunks in {time.perf_counter() - start:.2f}s "
+              f"(peak {tracemalloc.get_traced_memory()[1] / 2**20:.1f} MiB in this process)")
+        tracemalloc.reset_peak()
@@ -1,85 +1,326 @@
 ### IMPORT
-import chromadb
-from chromadb import Collection
-from llama_index.core import VectorStoreIndex, Settings, SimpleDirectoryReader, VectorStoreIndex
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.vector_stores.chroma import ChromaVectorStore
-import streamlit as st
-from ..ux_utils import Locale, TextResources, Translator
-
-embed_model: HuggingFaceEmbedding = None
-collection: Collection = None
-
-def document_embedding():
+import os
+import time
+import threading
+from typing import TYPE_CHECKING, Callable
+from ..ux_utils import TextResources
+from ..lazy_loader import LazyLoader, lazy_import
+from ..warmup import warmup
+from .rag_chunking import Chunk, tokenizer as chunk_tokenizer
+from .embedding_service import EmbeddingService
+from .rag_context import PackedContext, CONTEXT_CANDIDATES, CONTEXT_TOKENS, pack_context
+from .rag_manifest import IndexManifest, SyncPlan
+from .rag_jobs import IngestionQueue
+from .rag_parsing import ParserPool
+from .vector_store import Hit, VectorStore, VECTOR_STORE, open_store
+from .rag_bm25 import BM25Index, STOPWORDS, reciprocal_rank_fusion
+
+# llama_index and the HF embeddings (torch) are only imported when RAG is used
+llama_index_hf = lazy_import("llama_index.embeddings.huggingface")
+if TYPE_CHECKING:
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+# Embedding settings, can be changed in .env (bigger batches are faster on CPU, up to the cache size of the host)
+EMBED_MODEL_NAME = "BAAI/bge-small-en-v1.5"
+EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "32"))
+embed_model_loader = LazyLoader(
+    f"load embedding model {EMBED_MODEL_NAME}",
+    lambda: llama_index_hf.HuggingFaceEmbedding(model_name = EMBED_MODEL_NAME, embed_batch_size = EMBED_BATCH_SIZE)
+)
+
+# Documents and index
+DOCUMENT_DIR = "./res/documents_rag"
+CHROMA_PATH = "./chroma"
+NUMPY_STORE_PATH = "./vector_index"
+STORE_PATH = CHROMA_PATH if VECTOR_STORE == "chroma" else NUMPY_STORE_PATH
+MANIFEST_PATH = os.path.join(STORE_PATH, "manifest.json") # one manifest per backend
+BM25_PATH = os.path.join(STORE_PATH, "bm25.npz")
+
+# Retrieval settings, can be changed in .env
+# auto (default): lexical for keyword queries ("EfficientNet-B7", "FPN"), hybrid otherwise. hybrid: BM25 + dense
+# fused by reciprocal rank. dense: embeddings only. lexical: BM25 only (no embedding model at query time)
+RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL", "auto").lower()
+RRF_CANDIDATES = 20 # candidates of each retriever before the fusion
+KEYWORD_QUERY_MAX_WORDS = 4
+
+# What the index holds (file -> content hash -> chunk ids), one sync at a time
+manifest = IndexManifest(MANIFEST_PATH)
+_sync_lock = threading.Lock()
+
+# Parser processes (PDF/DOCX parsing and chunking), started at the first sync
+parser_pool = ParserPool()
+
+embed_model: "HuggingFaceEmbedding" = None
+store: VectorStore = None
+lexical_index: BM25Index = None
+_store_lock = threading.Lock()
+
+def get_embed_model() -> "HuggingFaceEmbedding":
+    """
+    Load the embedding model once (ingestion, and the query embeddings of embedding_service).
+    Waits for the background warm-up if it is loading the model.
+    """
     global embed_model
-    global collection
-
-    if embed_model is None:
-        embed_model_name = "BAAI/bge-small-en-v1.5"
-        embed_model = HuggingFaceEmbedding(model_name = embed_model_name)
-
-    # Load document: documents at first is a Document class of llama_index
-    documents = SimpleDirectoryReader(input_dir = "./res/documents_rag").load_data()
-
-    # By using get_content() we change it into string type
-    documents = [d.get_content() for d in documents]
-
-    # Indexing and storing embedding to disk
-    client = chromadb.PersistentClient(path="./chroma")
-    try:
-        collection = client.get_collection(name="docs")
-        if collection.count() > 0:
-            print("Using existing collection.")
-            return
-    except:
-        collection = client.create_collection(name="docs")
-
-    for i, d in enumerate(documents): # store each document in a vector embedding database, d should be strings
-        embeddings = embed_model.get_text_embedding(d)
-        collection.add(
-            ids=[str(i)],
-            embeddings=embeddings,
-            documents=[d]
+
+    warmup.wait("embedding")
+    embed_model = embed_model_loader.get()
+    return embed_model
+
+# Query embeddings of every session: LRU cache and micro-batched forward passes
+embedding_service = EmbeddingService(get_embed_model)
+
+def embed_chunks(chunks: list[Chunk], batch_size: int = EMBED_BATCH_SIZE) -> list[list[float]]:
+    """
+    Embed chunks with batched forward passes (batch_size chunks per call).
+    """
+    model = get_embed_model()
+    embeddings = []
+    for i in range(0, len(chunks), batch_size):
+        embeddings.extend(model.get_text_embedding_batch([c.embed_text for c in chunks[i:i + batch_size]]))
+    return embeddings
+
+def add_chunks(store: VectorStore, chunks: list[Chunk], version: int,
+               batch_size: int = EMBED_BATCH_SIZE) -> None:
+    """
+    Embed and store chunks of an index version, one batch at a time (and add them to the BM25 index).
+    """
+    for i in range(0, len(chunks), batch_size):
+        batch = chunks[i:i + batch_size]
+        store.add(
+            ids = [c.id for c in batch],
+            embeddings = embed_chunks(batch, batch_size),
+            documents = [c.text for c in batch],
+            metadatas = [{**c.metadata, "version": version} for c in batch]
         )
+        lexical_index.add([c.id for c in batch], [c.embed_text for c in batch], [version] * len(batch))
+
+def get_store() -> VectorStore:
+    """
+    Open the vector store (RAG_VECTOR_STORE in .env) and the BM25 index once, and bring them back in line with the manifest.
+    """
+    global store, lexical_index
+
+    with _store_lock:
+        if store is not None:
+            return store
+        opened = open_store(VECTOR_STORE, STORE_PATH)
+        lexical_index = BM25Index(BM25_PATH)
+
+        # The index was deleted or never built: the manifest describes nothing
+        if opened.count() == 0 and manifest.files:
+            manifest.clear()
+            lexical_index.clear()
+        # Chunks without a version (built before versioning): rebuild the index once
+        elif manifest.version == 0 and opened.count() > 0:
+            opened.clear()
+            lexical_index.clear()
+            manifest.clear()
+        # Chunks the manifest does not know: of a sync that never committed, or replaced but not deleted yet
+        else:
+            known = {chunk_id for name in manifest.files for chunk_id in manifest.chunk_ids(name)}
+            orphans = opened.ids() - known
+            if orphans:
+                opened.delete(list(orphans))
+                opened.persist()
+            lexical_orphans = lexical_index.ids() - known
+            if lexical_orphans:
+                lexical_index.delete(list(lexical_orphans))
+                lexical_index.persist()
+
+            # Index built before BM25: build the inverted index from the stored chunks
+            if not lexical_index.exists and opened.count() > 0:
+                hits = opened.get(sorted(known))
+                lexical_index.add(
+                    [hit.id for hit in hits],
+                    [_chunk_of(hit).embed_text for hit in hits],
+                    [hit.metadata.get("version", 0) for hit in hits]
+                )
+                lexical_index.persist()
+        store = opened
+        return store
+
+def _chunk_of(hit: Hit) -> Chunk:
+    meta = hit.metadata
+    return Chunk(hit.id, hit.document, meta.get("file", ""), meta.get("page"), meta.get("start", 0),
+                 meta.get("end", 0), meta.get("section", ""))
+
+def sync_index(input_dir: str = DOCUMENT_DIR, progress: Callable[[float, str], None] = None) -> SyncPlan:
+    """
+    Bring the index up to date with the document folder: only new and changed files are parsed and embedded,
+    the chunks of changed and removed files are deleted.
+
+    The new chunks belong to the next index version and stay invisible to queries until the commit
+    (manifest saved), so queries keep answering from the last committed version meanwhile.
+
+    Args:
+        - input_dir (str) : The document folder.
+        - progress (Callable[[float, str], None]) : Called with the fraction done and the current step.
+
+    Returns:
+        SyncPlan: What was added, changed, removed and left as is.
+    """
+    progress = progress or (lambda fraction, step: None)
+    with _sync_lock:
+        store = get_store()
+        plan = manifest.plan(input_dir)
+        if not plan.to_index and not plan.removed:
+            manifest.save() # mtimes of touched files
+            return plan
 
-    # Embed the document (when run for the first time)
-    _ = ChromaVectorStore(chroma_collection = collection, persist_dir = "./chroma")
+        version = manifest.version + 1
+        start = time.perf_counter()
+
+        # 1. New and changed files: parsed and chunked by the parser processes, streamed to the embedder
+        #    (in file order) and stored as the new version
+        indexed: dict[str, list[str]] = {}
+        failed: set[str] = set()
+        chunk_ids: list[str] = [] # chunks stored so far for the current file
+        for part in parser_pool.parse([os.path.join(input_dir, name) for name in plan.to_index]):
+            if part.name in failed:
+                continue
+            progress((len(indexed) + len(failed)) / len(plan.to_index), f"indexing {part.name}")
+            chunks = [c._replace(id = f"{c.id}@{version}") for c in part.chunks]
+            try:
+                if part.error is not None:
+                    raise RuntimeError(part.error)
+                chunk_ids.extend(c.id for c in chunks)
+                add_chunks(store, chunks, version)
+            except Exception as e:
+                # Not committed: retried at the next sync (a changed file keeps its old chunks meanwhile)
+                print(f">>> Failed to index {part.name}: {e}")
+                store.delete(chunk_ids)
+                lexical_index.delete(chunk_ids)
+                failed.add(part.name)
+                chunk_ids = []
+                continue
+            if part.last:
+                indexed[part.name], chunk_ids = chunk_ids, []
+
+        # 2. Commit: the manifest switches to the new version, then the chunks it replaced are deleted
+        progress(1.0, "committing")
+        stale = [chunk_id for name in plan.removed + list(indexed) for chunk_id in manifest.chunk_ids(name)]
+        for name in plan.removed:
+            manifest.remove(name)
+        for name, chunk_ids in indexed.items():
+            manifest.set(name, plan.states[name], chunk_ids)
+        manifest.version = version
+        store.persist() # the new chunks are durable before the manifest points to them
+        lexical_index.persist()
+        manifest.save()
+        store.delete(stale)
+        lexical_index.delete(stale)
+        store.persist()
+        lexical_index.persist()
+
+    print(f">>> Index version {version}: +{len(plan.added)} new, ~{len(plan.changed)} changed, -{len(plan.removed)} removed files "
+          f"({sum(len(ids) for ids in indexed.values())} chunks embedded in {time.perf_counter() - start:.2f}s)")
+    return plan
+
+# Background index syncs (the queries use the last committed version meanwhile)
+ingestion_queue = IngestionQueue(lambda progress: sync_index(progress = progress))
+
+def index_stats() -> dict:
+    return {
+        **manifest.stats(),
+        "store": store.stats() if store is not None else None,
+        "bm25": lexical_index.stats() if lexical_index is not None else None,
+        "jobs": ingestion_queue.jobs(),
+    }
+
+def document_embedding(wait: bool = False) -> None:
+    """
+    Queue a sync of the document folder.
+
+    Args:
+        - wait (bool) : Wait until the index is up to date.
+    """
+    job = ingestion_queue.submit()
+    if wait:
+        job.done.wait()
+
+def is_keyword_query(query: str) -> bool:
+    """
+    A few words and no stopword ("EfficientNet-B7", "FPN anchors"): exact terms matter more than meaning.
+    """
+    words = query.split()
+    return 0 < len(words) <= KEYWORD_QUERY_MAX_WORDS and not any(w.strip("?!.,;:").lower() in STOPWORDS for w in words)
+
+def retrieve(query: str, n_results: int, mode: str = RETRIEVAL_MODE) -> list[Hit]:
+    """
+    Top-k chunks of the last committed index version for a query.
+
+    Args:
+        - query (str) : The question of the user.
+        - n_results (int) : k.
+        - mode (str) : "auto", "hybrid", "dense" or "lexical" (see RAG_RETRIEVAL).
+
+    Returns:
+        list[Hit]: The chunks, best first (fused RRF scores in hybrid mode).
+    """
+    store = get_store()
+    version = manifest.version
+    if mode == "auto":
+        mode = "lexical" if is_keyword_query(query) else "hybrid"
+
+    # BM25 first: in lexical mode the embedding model is not needed at all
+    lexical = []
+    if mode in ("lexical", "hybrid"):
+        lexical = lexical_index.query(query, max(n_results, RRF_CANDIDATES), max_version = version)
+        if mode == "lexical":
+            if lexical:
+                scores = dict(lexical[:n_results])
+                return [hit._replace(score = scores[hit.id]) for hit in store.get(list(scores))]
+            mode = "dense" # no exact term matched: fall back to the meaning
+
+    query_emb = embedding_service.embed(query).tolist()
+    dense = store.query([query_emb], max(n_results, RRF_CANDIDATES) if lexical else n_results, max_version = version)[0]
+    if not lexical:
+        return dense[:n_results]
+
+    # Reciprocal rank fusion of both rankings (the chunks only found by BM25 are fetched from the store)
+    fused = reciprocal_rank_fusion([[hit.id for hit in dense], [chunk_id for chunk_id, _ in lexical]])[:n_results]
+    by_id = {hit.id: hit for hit in dense}
+    by_id.update((hit.id, hit) for hit in store.get([chunk_id for chunk_id, _ in fused if chunk_id not in by_id]))
+    return [by_id[chunk_id]._replace(score = score) for chunk_id, score in fused if chunk_id in by_id]
+
+def build_rag_context(message: str, n_results: int = 4, update_database: bool = False,
+                      count_tokens: Callable[[str], int] = None, token_budget: int = CONTEXT_TOKENS) -> PackedContext:
+    """
+    Retrieve the chunks of a question and pack them into a context (MMR order, no near-duplicates, within the budget).
+
+    Args:
+        - message (str) : The question of the user.
+        - n_results (int) : Maximum chunks in the context.
+        - update_database (bool) : Index the changes of the document folder (in the background).
+        - count_tokens (Callable[[str], int]) : Token counter of the chat model (default: the embedding tokenizer).
+        - token_budget (int) : Maximum tokens of the context (RAG_CONTEXT_TOKENS in .env).
+
+    Returns:
+        PackedContext: The context and its token count.
+    """
+    # Get the store (changes of the folder are indexed in the background)
+    if store is None or update_database:
+        # Nothing committed yet: the first index is waited for, later ones are not
+        document_embedding(wait = manifest.version == 0)
+        get_store()
+
+    # Nothing indexed yet
+    if n_results <= 0 or store.count() == 0:
+        return pack_context([], None, count_tokens)
+
+    # Candidates of the last committed version, then the context is selected from them
+    hits = retrieve(message, max(n_results, CONTEXT_CANDIDATES))
+    if count_tokens is None:
+        count_tokens = lambda text: len(chunk_tokenizer.get()(text, add_special_tokens = False)["input_ids"])
+    return pack_context(hits, store.embeddings([hit.id for hit in hits]), count_tokens,
+                        token_budget = token_budget, max_chunks = n_results)
 
 def get_rag_context(message: str, n_results: int = 4,
-                    update_database: bool = False, text: TextResources = None):
-    # In case text not passed into the function
-    if text is None:
-        translator = Translator(Locale.ENGLISH)
-        text = TextResources(translator = translator)
-    
-    # Get embed_model and collection
-    global embed_model
-    global collection
-    if (embed_model is None or collection is None) or update_database:
-        document_embedding()
-        st.success(text.RAG_UPDATE_ANNOUNCEMENT)
-
-    # Clip the max n_results
-    if n_results > 5:
-        n_results = 5
-
-    # Embed the query
-    query_emb = embed_model.get_text_embedding(message)
-
-    # Search for top-k docs
-    results = collection.query(
-        query_embeddings = [query_emb],
-        n_results = n_results,
-        include = ["documents"]
-    )
-    docs = [hit for hit in results["documents"][0]]
-
-    # Prepare prompt with retrieved context
-    context = ""
-    for i, doc in enumerate(docs):
-        context += f"[Chunk {i + 1}]\n"
-        context += doc
-        if i < (n_results - 1):
-            context += "\n\n***\n\n"
-    
-    return context
\ No newline at end of file
+                    update_database: bool = False, text: TextResources = None,
+                    count_tokens: Callable[[str], int] = None) -> str:
+    """
+    The packed context of a question, as text (see build_rag_context). text is not used anymore: the indexing
+    announcements are shown by the sidebar.
+    """
+    return build_rag_context(message, n_results = n_results, update_database = update_database,
+                             count_tokens = count_tokens).text
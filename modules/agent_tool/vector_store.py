@@ -0,0 +1,521 @@
+# Importing required libraries
+import os
+import json
+import time
+import threading
+from abc import ABC, abstractmethod
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from ..lazy_loader import lazy_import
+
+chromadb = lazy_import("chromadb")
+
+# Vector store settings, can be changed in .env
+# numpy (default): memory-mapped float16 matrix searched in this process. chroma: the Chroma persistent client
+VECTOR_STORE = os.getenv("RAG_VECTOR_STORE", "numpy").lower()
+SEARCH_BLOCK_ROWS = 1 << 16 # rows scored per matrix product (bounds the float32 scratch memory)
+MIN_CAPACITY = 1024
+
+# Quantized first pass of the numpy store: binary (default, 1 bit per dimension, 32x smaller than float32),
+# int8 (8x smaller, closer to the float ranking) or none (exact search only)
+QUANTIZATION = os.getenv("RAG_QUANTIZATION", "binary").lower()
+RESCORE_CANDIDATES = int(os.getenv("RAG_RESCORE_CANDIDATES", "100")) # rows rescored with float16 vectors per query
+RESCORE_FACTOR = 10 # at least RESCORE_FACTOR * k candidates
+INT8_SIGMAS = 4.0 # int8 range: +-4 standard deviations of the components of a unit vector (the rest is clipped)
+CODE_DTYPES = {"binary": np.uint8, "int8": np.int8, "none": None}
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype = np.uint8) # for NumPy < 2.0 (no bitwise_count)
+
+def encode(matrix: np.ndarray, quantization: str) -> np.ndarray:
+    """
+    Quantized codes of normalized float32 rows: sign bits packed 8 per byte (binary), or int8 components (int8).
+    """
+    if quantization == "binary":
+        return np.packbits(matrix > 0, axis = 1)
+    scale = 127 * np.sqrt(matrix.shape[1]) / INT8_SIGMAS
+    return np.clip(np.rint(matrix * scale), -127, 127).astype(np.int8)
+
+def hamming(codes: np.ndarray, code: np.ndarray) -> np.ndarray:
+    """
+    Hamming distances between binary codes (rows) and one code.
+    """
+    if hasattr(np, "bitwise_count") and codes.shape[1] % 8 == 0:
+        # 64 bits at a time
+        return np.bitwise_count(np.bitwise_xor(codes.view(np.uint64), code.view(np.uint64))).sum(axis = 1, dtype = np.int32)
+    return POPCOUNT[np.bitwise_xor(codes, code)].sum(axis = 1, dtype = np.int32)
+
+class Hit(NamedTuple):
+    id: str
+    score: float # cosine similarity
+    document: str
+    metadata: dict
+
+class VectorStore(ABC):
+    """
+    Where the chunk embeddings are stored and searched.\n
+    Every chunk has a "version" metadata: queries only see the chunks of max_version and before (see IndexManifest).
+    """
+    @abstractmethod
+    def add(self, ids: list[str], embeddings: list[list[float]], documents: list[str], metadatas: list[dict]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, ids: list[str]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def ids(self) -> set[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, ids: list[str]) -> list[Hit]:
+        """
+        The stored chunks of some ids (in that order, score 0; unknown ids are skipped).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def embeddings(self, ids: list[str]) -> np.ndarray:
+        """
+        The normalized float32 embeddings of some ids (a row of zeros for an unknown id).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def count(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def query(self, embeddings: list[list[float]], n_results: int, max_version: Optional[int] = None) -> list[list[Hit]]:
+        """
+        Top-k search of a batch of query embeddings.
+
+        Args:
+            - embeddings (list[list[float]]) : The query embeddings.
+            - n_results (int) : k.
+            - max_version (int) : Only the chunks of this index version and before are returned (None: all).
+
+        Returns:
+            list[list[Hit]]: The hits of each query, best first.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def persist(self) -> None:
+        """
+        Make the changes durable (and visible to the other processes).
+        """
+
+    def stats(self) -> dict:
+        return {"backend": type(self).__name__, "count": self.count()}
+
+class ChromaStore(VectorStore):
+    """
+    The Chroma persistent client (SQLite + HNSW).
+    """
+    def __init__(self, path: str, name: str = "chunks"):
+        self.name = name
+        self.client = chromadb.PersistentClient(path = path)
+        self.collection = self.client.get_or_create_collection(name = name, metadata = {"hnsw:space": "cosine"})
+
+    def add(self, ids, embeddings, documents, metadatas) -> None:
+        self.collection.add(ids = ids, embeddings = embeddings, documents = documents, metadatas = metadatas)
+
+    def delete(self, ids: list[str]) -> None:
+        if ids:
+            self.collection.delete(ids = list(ids))
+
+    def ids(self) -> set[str]:
+        return set(self.collection.get(include = [])["ids"])
+
+    def get(self, ids: list[str]) -> list[Hit]:
+        if not ids:
+            return []
+        results = self.collection.get(ids = list(ids), include = ["documents", "metadatas"])
+        found = {i: Hit(i, 0.0, doc, meta) for i, doc, meta in zip(results["ids"], results["documents"], results["metadatas"])}
+        return [found[i] for i in ids if i in found]
+
+    def embeddings(self, ids: list[str]) -> np.ndarray:
+        results = self.collection.get(ids = list(ids), include = ["embeddings"]) if ids else {"ids": [], "embeddings": []}
+        found = dict(zip(results["ids"], results["embeddings"]))
+        dim = len(next(iter(found.values()))) if found else 0
+        matrix = np.array([found[i] if i in found else np.zeros(dim) for i in ids], dtype = np.float32).reshape(len(ids), dim)
+        return matrix / np.maximum(np.linalg.norm(matrix, axis = 1, keepdims = True), 1e-12)
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def query(self, embeddings, n_results, max_version = None) -> list[list[Hit]]:
+        results = self.collection.query(
+            query_embeddings = embeddings,
+            n_results = n_results,
+            where = {"version": {"$lte": max_version}} if max_version is not None else None,
+            include = ["documents", "metadatas", "distances"]
+        )
+        return [
+            [Hit(i, 1.0 - d, doc, meta) for i, d, doc, meta in zip(ids, distances, documents, metadatas)]
+            for ids, distances, documents, metadatas in zip(
+                results["ids"], results["distances"], results["documents"], results["metadatas"]
+            )
+        ]
+
+    def clear(self) -> None:
+        self.client.delete_collection(name = self.name)
+        self.collection = self.client.create_collection(name = self.name, metadata = {"hnsw:space": "cosine"})
+
+class NumpyStore(VectorStore):
+    """
+    Normalized embeddings in a memory-mapped float16 matrix (vectors.f16), documents and metadata in a sidecar
+    file (store.json), top-k with matrix products and argpartition.\n
+    + Opening is instant: the matrices are mapped, not read; the processes that open the same store share their pages
+    + Two-stage search: a first pass over quantized codes of all the rows (binary: Hamming distance, int8: int8 dot
+      products), then only the best RESCORE_CANDIDATES rows are rescored with their float16 vectors
+    + Deleted rows are masked, then dropped when they are half of the matrix (compaction)
+    + Rows added since the last persist() are not in the sidecar: another process (or a restart) ignores them
+    """
+    def __init__(self, path: str, quantization: str = QUANTIZATION):
+        if quantization not in CODE_DTYPES:
+            raise ValueError(f"Unknown quantization '{quantization}', use binary, int8 or none")
+        self.path = path
+        self.quantization = quantization
+        self.vectors_path = os.path.join(path, "vectors.f16")
+        self.codes_path = os.path.join(path, f"codes.{quantization}")
+        self.sidecar_path = os.path.join(path, "store.json")
+        self._lock = threading.RLock()
+        self._sidecar_mtime = None
+        self._load()
+
+    ### Storage
+    def _load(self) -> None:
+        data = {"dim": 0, "capacity": 0, "rows": []}
+        if os.path.exists(self.sidecar_path):
+            with open(self.sidecar_path, "r", encoding = "utf-8") as f:
+                data = json.load(f)
+            self._sidecar_mtime = os.stat(self.sidecar_path).st_mtime_ns
+        self.dim = data["dim"]
+        self.capacity = data["capacity"]
+        rows = data["rows"]
+        self.row_ids: list[Optional[str]] = [row["id"] for row in rows] # None: deleted row
+        self.documents: list[Optional[str]] = [row["document"] for row in rows]
+        self.metadatas: list[Optional[dict]] = [row["metadata"] for row in rows]
+        self.versions = np.array([row["metadata"].get("version", 0) if row["id"] else 0 for row in rows], dtype = np.int64)
+        self.alive = np.array([row["id"] is not None for row in rows], dtype = bool)
+        self.index = {row_id: i for i, row_id in enumerate(self.row_ids) if row_id is not None}
+        self.vectors = self._map(self.vectors_path, np.float16, self.dim, self.capacity) if self.capacity else None
+        self.codes = None
+        if self.capacity and self.quantization != "none":
+            # Codes of another quantization (or none yet): encode the stored vectors once
+            if data.get("quantization") != self.quantization or not os.path.exists(self.codes_path):
+                self._resize(self.codes_path, self.capacity * self.code_width)
+                self.codes = self._map(self.codes_path, CODE_DTYPES[self.quantization], self.code_width, self.capacity)
+                self._encode_rows(0, len(self.row_ids))
+                self.persist()
+            else:
+                self.codes = self._map(self.codes_path, CODE_DTYPES[self.quantization], self.code_width, self.capacity)
+
+    @property
+    def code_width(self) -> int:
+        return (self.dim + 7) // 8 if self.quantization == "binary" else self.dim
+
+    @staticmethod
+    def _map(path: str, dtype, width: int, capacity: int) -> np.memmap:
+        return np.memmap(path, dtype = dtype, mode = "r+", shape = (capacity, width))
+
+    @staticmethod
+    def _resize(path: str, n_bytes: int) -> None:
+        with open(path, "ab") as f:
+            f.truncate(n_bytes)
+
+    def _encode_rows(self, start: int, end: int) -> None:
+        for block in range(start, end, SEARCH_BLOCK_ROWS):
+            block_end = min(block + SEARCH_BLOCK_ROWS, end)
+            self.codes[block:block_end] = encode(self.vectors[block:block_end].astype(np.float32), self.quantization)
+
+    def _grow(self, rows: int) -> None:
+        if rows <= self.capacity:
+            return
+        capacity = max(MIN_CAPACITY, self.capacity * 2, rows)
+        os.makedirs(self.path, exist_ok = True)
+        for matrix in (self.vectors, self.codes):
+            if matrix is not None:
+                matrix.flush()
+        self.vectors = self.codes = None
+        self._resize(self.vectors_path, capacity * self.dim * 2)
+        self.vectors = self._map(self.vectors_path, np.float16, self.dim, capacity)
+        if self.quantization != "none":
+            self._resize(self.codes_path, capacity * self.code_width)
+            self.codes = self._map(self.codes_path, CODE_DTYPES[self.quantization], self.code_width, capacity)
+        self.capacity = capacity
+
+    def _refresh(self) -> None:
+        # Another process persisted the store: map its new state
+        try:
+            mtime = os.stat(self.sidecar_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._sidecar_mtime:
+            self._load()
+
+    def persist(self) -> None:
+        with self._lock:
+            for matrix in (self.vectors, self.codes):
+                if matrix is not None:
+                    matrix.flush()
+            os.makedirs(self.path, exist_ok = True)
+            tmp_path = f"{self.sidecar_path}.tmp"
+            with open(tmp_path, "w", encoding = "utf-8") as f:
+                json.dump({
+                    "dim": self.dim,
+                    "capacity": self.capacity,
+                    "quantization": self.quantization,
+                    "rows": [{"id": i, "document": d, "metadata": m}
+                             for i, d, m in zip(self.row_ids, self.documents, self.metadatas)],
+                }, f)
+            os.replace(tmp_path, self.sidecar_path)
+            self._sidecar_mtime = os.stat(self.sidecar_path).st_mtime_ns
+
+    def _compact(self) -> None:
+        # Rewrite the live rows into new files (the other processes keep their mapping of the old ones until they reload)
+        keep = np.flatnonzero(self.alive)
+        capacity = max(MIN_CAPACITY, len(keep) * 2)
+        matrices = [(self.vectors_path, self.vectors, np.float16, self.dim)]
+        if self.codes is not None:
+            matrices.append((self.codes_path, self.codes, CODE_DTYPES[self.quantization], self.code_width))
+        for path, matrix, dtype, width in matrices:
+            tmp_path = f"{path}.tmp"
+            compacted = np.memmap(tmp_path, dtype = dtype, mode = "w+", shape = (capacity, width))
+            for start in range(0, len(keep), SEARCH_BLOCK_ROWS):
+                block = keep[start:start + SEARCH_BLOCK_ROWS]
+                compacted[start:start + len(block)] = matrix[block]
+            compacted.flush()
+            del compacted
+            os.replace(tmp_path, path)
+        self.vectors = self.codes = None
+
+        self.row_ids = [self.row_ids[i] for i in keep]
+        self.documents = [self.documents[i] for i in keep]
+        self.metadatas = [self.metadatas[i] for i in keep]
+        self.versions = self.versions[keep]
+        self.alive = np.ones(len(keep), dtype = bool)
+        self.index = {row_id: i for i, row_id in enumerate(self.row_ids)}
+        self.capacity = capacity
+        self.vectors = self._map(self.vectors_path, np.float16, self.dim, capacity)
+        if self.quantization != "none":
+            self.codes = self._map(self.codes_path, CODE_DTYPES[self.quantization], self.code_width, capacity)
+        self.persist()
+
+    ### VectorStore
+    def add(self, ids, embeddings, documents, metadatas) -> None:
+        if not ids:
+            return
+        matrix = np.asarray(embeddings, dtype = np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis = 1, keepdims = True), 1e-12)
+        with self._lock:
+            if self.dim == 0:
+                self.dim = matrix.shape[1]
+            elif matrix.shape[1] != self.dim:
+                raise ValueError(f"Embeddings of dimension {matrix.shape[1]}, the store has dimension {self.dim}")
+            self.delete([i for i in ids if i in self.index])
+
+            start = len(self.row_ids)
+            self._grow(start + len(ids))
+            self.vectors[start:start + len(ids)] = matrix.astype(np.float16)
+            if self.codes is not None:
+                self.codes[start:start + len(ids)] = encode(matrix, self.quantization)
+            self.row_ids.extend(ids)
+            self.documents.extend(documents)
+            self.metadatas.extend(metadatas)
+            self.versions = np.concatenate([self.versions, [m.get("version", 0) for m in metadatas]]).astype(np.int64)
+            self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype = bool)])
+            self.index.update((row_id, start + n) for n, row_id in enumerate(ids))
+
+    def delete(self, ids: list[str]) -> None:
+        with self._lock:
+            for row_id in ids:
+                row = self.index.pop(row_id, None)
+                if row is None:
+                    continue
+                self.alive[row] = False
+                self.row_ids[row] = self.documents[row] = self.metadatas[row] = None
+            if self.alive.size and self.alive.sum() < self.alive.size // 2:
+                self._compact()
+
+    def ids(self) -> set[str]:
+        with self._lock:
+            return set(self.index)
+
+    def get(self, ids: list[str]) -> list[Hit]:
+        with self._lock:
+            rows = [self.index[i] for i in ids if i in self.index]
+            return [Hit(self.row_ids[r], 0.0, self.documents[r], self.metadatas[r]) for r in rows]
+
+    def embeddings(self, ids: list[str]) -> np.ndarray:
+        with self._lock:
+            matrix = np.zeros((len(ids), self.dim), dtype = np.float32)
+            for n, row_id in enumerate(ids):
+                if row_id in self.index:
+                    matrix[n] = self.vectors[self.index[row_id]]
+            return matrix
+
+    def count(self) -> int:
+        self._refresh()
+        return len(self.index)
+
+    def _exact_scores(self, queries: np.ndarray, n_rows: int) -> np.ndarray:
+        # Block by block: float16 rows -> float32
+        scores = np.empty((len(queries), n_rows), dtype = np.float32)
+        for start in range(0, n_rows, SEARCH_BLOCK_ROWS):
+            end = min(start + SEARCH_BLOCK_ROWS, n_rows)
+            scores[:, start:end] = queries @ self.vectors[start:end].astype(np.float32).T
+        return scores
+
+    def _first_pass_scores(self, queries: np.ndarray, n_rows: int) -> np.ndarray:
+        # Higher is better: minus the Hamming distance (binary), int8 dot product (int8)
+        query_codes = encode(queries, self.quantization)
+        scores = np.empty((len(queries), n_rows), dtype = np.float32)
+        for start in range(0, n_rows, SEARCH_BLOCK_ROWS):
+            end = min(start + SEARCH_BLOCK_ROWS, n_rows)
+            block = self.codes[start:end]
+            if self.quantization == "binary":
+                for q, code in enumerate(query_codes):
+                    scores[q, start:end] = -hamming(block, code)
+            else:
+                scores[:, start:end] = query_codes.astype(np.float32) @ block.astype(np.float32).T
+        return scores
+
+    def query(self, embeddings, n_results, max_version = None, exact: bool = False) -> list[list[Hit]]:
+        """
+        Top-k search (see VectorStore.query). exact=True scores every row with its float16 vector (the baseline
+        of the quantized search).
+        """
+        self._refresh()
+        queries = np.asarray(embeddings, dtype = np.float32).reshape(-1, self.dim or len(embeddings[0]))
+        queries /= np.maximum(np.linalg.norm(queries, axis = 1, keepdims = True), 1e-12)
+        with self._lock:
+            n_rows = len(self.row_ids)
+            visible = self.alive if max_version is None else self.alive & (self.versions <= max_version)
+            n_visible = int(visible.sum())
+            if n_rows == 0 or n_results <= 0 or n_visible == 0:
+                return [[] for _ in queries]
+            k = min(n_results, n_visible)
+            n_candidates = max(RESCORE_CANDIDATES, RESCORE_FACTOR * k)
+
+            hits = []
+            if exact or self.codes is None or n_visible <= n_candidates:
+                scores = self._exact_scores(queries, n_rows)
+                scores[:, ~visible] = -np.inf
+                top = np.argpartition(-scores, k - 1, axis = 1)[:, :k]
+                for q, rows in enumerate(top):
+                    rows = rows[np.argsort(-scores[q, rows])]
+                    hits.append([Hit(self.row_ids[r], float(scores[q, r]), self.documents[r], self.metadatas[r]) for r in rows])
+                return hits
+
+            # 1. Quantized first pass over all the rows, 2. rescoring of the candidates with their float16 vectors
+            first_pass = self._first_pass_scores(queries, n_rows)
+            first_pass[:, ~visible] = -np.inf
+            candidates = np.argpartition(-first_pass, n_candidates - 1, axis = 1)[:, :n_candidates]
+            for q, rows in enumerate(candidates):
+                rows = np.sort(rows) # sequential reads of the memory-mapped vectors
+                scores = self.vectors[rows].astype(np.float32) @ queries[q]
+                best = np.argsort(-scores)[:k]
+                hits.append([Hit(self.row_ids[r], float(scores[i]), self.documents[r], self.metadatas[r])
+                             for i, r in zip(best, rows[best])])
+            return hits
+
+    def clear(self) -> None:
+        with self._lock:
+            self.vectors = self.codes = None
+            for path in (self.vectors_path, self.codes_path, self.sidecar_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._sidecar_mtime = None
+            self._load()
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "dim": self.dim,
+            "rows": len(self.row_ids),
+            "capacity": self.capacity,
+            "quantization": self.quantization,
+            "vectors_mb": round(self.capacity * self.dim * 2 / 2**20, 2),
+            "codes_mb": round(self.capacity * self.code_width / 2**20, 2) if self.codes is not None else 0.0,
+        }
+
+    def quantization_report(self, n_queries: int = 100, k: int = 10, seed: int = 0) -> dict:
+        """
+        Compare the quantized search with the exact one: recall@k, latency and memory.
+        The queries are stored vectors with some noise (close to a real question about a chunk).
+        """
+        with self._lock:
+            rows = np.flatnonzero(self.alive)
+            if rows.size == 0:
+                return {}
+            rng = np.random.default_rng(seed)
+            rows = np.sort(rng.choice(rows, size = min(n_queries, rows.size), replace = False))
+            queries = self.vectors[rows].astype(np.float32)
+        queries += rng.standard_normal(queries.shape).astype(np.float32) * (0.5 / np.sqrt(max(self.dim, 1)))
+
+        # One query at a time, as in get_rag_context
+        timings = {}
+        results = {}
+        for name, exact in (("exact", True), ("quantized", False)):
+            start = time.perf_counter()
+            results[name] = [self.query([query], k, exact = exact)[0] for query in queries]
+            timings[name] = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = np.mean([
+            len({h.id for h in quantized} & {h.id for h in exact}) / max(len(exact), 1)
+            for quantized, exact in zip(results["quantized"], results["exact"])
+        ])
+        n_rows = len(self.row_ids)
+        return {
+            "rows": int(self.alive.sum()),
+            "quantization": self.quantization,
+            f"recall@{k}": round(float(recall), 4),
+            "exact_ms_per_query": round(timings["exact"], 3),
+            "quantized_ms_per_query": round(timings["quantized"], 3),
+            # Memory scanned by a query: all the codes + the rescored rows (quantized) or all the vectors (exact)
+            "float32_mb": round(n_rows * self.dim * 4 / 2**20, 2),
+            "float16_mb": round(n_rows * self.dim * 2 / 2**20, 2),
+            "codes_mb": round(n_rows * self.code_width / 2**20, 2) if self.codes is not None else 0.0,
+        }
+
+def open_store(backend: str, path: str) -> VectorStore:
+    """
+    Open the vector store of a backend ("numpy" or "chroma").
+    """
+    if backend == "numpy":
+        return NumpyStore(path)
+    if backend == "chroma":
+        return ChromaStore(path)
+    raise ValueError(f"Unknown vector store '{backend}', use numpy or chroma")
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    # python -m modules.agent_tool.vector_store [store folder]: recall@k and memory of the quantized search
+    if len(sys.argv) > 1:
+        for quantization in ("binary", "int8"):
+            print(NumpyStore(sys.argv[1], quantization).quantization_report())
+        sys.exit()
+
+    # Clustered random vectors (384 dims, like bge-small): chunks of a document are close to each other
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((500, 384)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), 50000)] + rng.standard_normal((50000, 384)).astype(np.float32)
+    for quantization in ("binary", "int8"):
+        with tempfile.TemporaryDirectory() as folder:
+            store = NumpyStore(folder, quantization)
+            store.add([str(i) for i in range(len(vectors))], vectors, [f"doc {i}" for i in range(len(vectors))],
+                      [{"version": 1}] * len(vectors))
+            store.persist()
+
+            start = time.perf_counter()
+            reopened = NumpyStore(folder, quantization)
+            print(f"open: {(time.perf_counter() - start) * 1000:.1f} ms, {reopened.stats()}")
+            print(reopened.quantization_report())
@@ -1,17 +1,27 @@
 import json
+import threading
 
 from .llm_respond import respond
+from .model_pool import model_pool, DEFAULT_CHAT_MODEL
+from .scheduler import scheduler, Priority
+from .system_snapshots import prepare_system_snapshots, register_system_prompt, BLUETOOTH_MODEL
+from .grammar_cache import grammar_cache, bluetooth_grammar
+from .speculative import SPECULATIVE_DEFAULTS
+from .response_cache import response_cache
+from .history_manager import history_manager
 from .prompts import original_prompt, bluetooth_prompt, agent_output_format, agent_system_prompt
 
 import json
 from ..chatbot_utils import respond
 from ..chatbot_utils.prompts import original_prompt, bluetooth_prompt, agent_output_format, agent_system_prompt
-from ..agent_tool.bluetooth_command_utils import add_only_flags
-from ..agent_tool.tool_rag import get_rag_context
+from ..agent_tool.bluetooth_command_utils import add_only_flags, command_parser
+from ..agent_tool.tool_rag import build_rag_context
+from ..agent_tool.rag_context import context_metrics
 from ..ux_utils import TextResources
 
 # Only a simple chatbot
-def vanilla(message: str, history: list[str], stream: bool = True):
+def vanilla(message: str, history: list[str], stream: bool = True, session_id: str = None,
+            cancel_event: threading.Event = None):
     """
     Send message and chat session log to Server to process using the chatbot.\n
     The data shall be in this format: {"message": str, "history": [[message, answer], [message, answer], ...]}.\n
@@ -20,9 +30,16 @@ def vanilla(message: str, history: list[str], stream: bool = True):
     # Catch error:
     try:
         # Pass the user input together with output settings to get_chat_response method.
-        answer = respond(
-            message, history = history,
-            system_message = original_prompt, stream = stream
+        # Only first messages are cached: later answers depend on the chat history
+        answer = response_cache.answer(
+            "vanilla", original_prompt, message, stream = stream,
+            cacheable = not history, cancel_event = cancel_event,
+            generate = lambda: respond(
+                message, history = history,
+                system_message = original_prompt, stream = stream,
+                session_id = session_id, priority = Priority.CHAT, cancel_event = cancel_event,
+                speculative = SPECULATIVE_DEFAULTS["vanilla"]
+            )
         )
 
         return answer, stream
@@ -31,7 +48,8 @@ def vanilla(message: str, history: list[str], stream: bool = True):
         return f"There was some error in the chatbot (Sever-side error).: {e}", False
 
 # function_call_chatbot
-def function_call_chatbot(message: str, history: list[str], stream: bool = True):
+def function_call_chatbot(message: str, history: list[str], stream: bool = True, session_id: str = None,
+                          cancel_event: threading.Event = None):
     """
     Send message and chat session log to Server to process using a Llama 3.2 function calling model.\n
     The data shall be in this format: {"message": str, "history": [[message, answer], [message, answer], ...]}.\n
@@ -39,7 +57,7 @@ def function_call_chatbot(message: str, history: list[str], stream: bool = True)
     # Catch error:
     try:
         # Pass the user input together with output settings to get_chat_response method.
-        results = respond(message, use_func_call=True)
+        results = respond(message, use_func_call=True, cancel_event=cancel_event)
 
         # Get context from function calling
         if type(results) is not str: # To avoid error when the model fail to parse the JSON
@@ -56,9 +74,17 @@ def function_call_chatbot(message: str, history: list[str], stream: bool = True)
 
         # Models
         prompt = agent_output_format.format(context = context, user_input = message)
-        answer = respond(
-            message = prompt, history = history,
-            system_message = agent_system_prompt, stream = stream
+
+        # Only first messages are cached: later answers depend on the chat history
+        answer = response_cache.answer(
+            "function_calling", agent_system_prompt, message, context = context,
+            stream = stream, cacheable = not history, cancel_event = cancel_event,
+            generate = lambda: respond(
+                message = prompt, history = history,
+                system_message = agent_system_prompt, stream = stream,
+                session_id = session_id, priority = Priority.CHAT, cancel_event = cancel_event,
+                speculative = SPECULATIVE_DEFAULTS["function_calling"]
+            )
         )
 
         return answer, stream
@@ -68,28 +94,42 @@ def function_call_chatbot(message: str, history: list[str], stream: bool = True)
 # RAG model
 def rag_chatbot(message: str, history: list[str], stream: bool = True,
                 n_results: int = 4, update_database: bool = False,
-                text: TextResources = None):
+                text: TextResources = None, session_id: str = None,
+                cancel_event: threading.Event = None):
     """
     Send message and chat session log to Server to process using a Llama 3.2 function calling model.\n
     The data shall be in this format: {"message": str, "history": [[message, answer], [message, answer], ...]}.\n
     """
     # Catch error:
     try:
-        # Pass the user input together with output settings to get_chat_response method.
-        context = get_rag_context(
+        # Retrieved chunks packed to the token budget, counted with the tokenizer of the chat model
+        count_tokens = lambda text: history_manager.count_text(DEFAULT_CHAT_MODEL, text)
+        packed = build_rag_context(
             message, n_results = n_results, update_database = update_database,
-            text = text
+            count_tokens = count_tokens
         )
-
-        # Print out context
-        print(f">>> Message: {message}")
-        print(f">>> Context: {context}")
+        context = packed.text
 
         # Models
         prompt = agent_output_format.format(context = context, user_input = message)
-        answer = respond(
-            message = prompt, history = history,
-            system_message = agent_system_prompt, stream = stream
+
+        # Print out context and the size of the final prompt
+        prompt_tokens = history_manager.count_prompt(DEFAULT_CHAT_MODEL, agent_system_prompt, "", history, prompt)
+        context_metrics.record(packed, prompt_tokens, session_id)
+        print(f">>> Message: {message}")
+        print(f">>> Context: {len(packed.hits)} chunks, {packed.n_tokens} tokens "
+              f"({packed.n_duplicates} near-duplicates dropped), prompt: {prompt_tokens} tokens")
+
+        # Only first messages are cached: later answers depend on the chat history
+        answer = response_cache.answer(
+            "rag", agent_system_prompt, message, context = context,
+            stream = stream, cacheable = not history, cancel_event = cancel_event,
+            generate = lambda: respond(
+                message = prompt, history = history,
+                system_message = agent_system_prompt, stream = stream,
+                session_id = session_id, priority = Priority.RAG, cancel_event = cancel_event,
+                speculative = SPECULATIVE_DEFAULTS["rag"]
+            )
         )
 
         return answer, stream
@@ -104,33 +144,33 @@ def bluetooth_processor(message: str):
     """
     # Catch error:
     try:
-        # Loop that let model try 3 times
-        tries = 0
-        while True:
-            try:
-                # Get response from model
-                answer = ""
-                commands = respond(
-                    message = message, history = [],
-                    model = "Llama-3.2-3B-Instruct-GRPO-GGUF.gguf", system_message = bluetooth_prompt
-                )
-
-                # Load commands into JSON format (dictionary) and get the answer
-                commands = json.loads(commands)
-                for command in commands:
-                    answer += f"{command['signal']},{command['color']};"
-
-                # Insert only into the command using Regex
-                answer = add_only_flags(
-                    message, command_string = answer,                
-                    colors = ["red", "green", "yellow"]
-                )
-                break
-            
-            except Exception as e:
-                tries += 1
-                if tries == 3:
-                    return f"Failed to get the command: {e}", False
+        # Fast path: common phrasings are parsed by rules, the LLM is only used when they are not confident
+        result = command_parser.parse(message)
+        if command_parser.is_confident(result):
+            return result.command_string
+
+        # The grammar only allows [{"signal": ..., "color": ...}, ...], so the answer parses in one pass
+        commands = respond(
+            message = message, history = [],
+            model = BLUETOOTH_MODEL, system_message = bluetooth_prompt,
+            session_id = "bluetooth", priority = Priority.COMMAND,
+            grammar = bluetooth_grammar, use_history_window = False
+        )
+
+        # Load commands into JSON format (dictionary) and get the answer
+        try:
+            commands = json.loads(commands)
+        except json.JSONDecodeError:
+            return f"Failed to get the command: {commands}", False
+        answer = ""
+        for command in commands:
+            answer += f"{command['signal']},{command['color']};"
+
+        # Insert only into the command using Regex
+        answer = add_only_flags(
+            message, command_string = answer,
+            colors = ["red", "green", "yellow"]
+        )
         return answer
-    except:
-        return f"There was some error in the Bluetooth processor (Sever-side error): {e}", False
\ No newline at end of file
+    except Exception as e:
+        return f"There was some error in the Bluetooth processor (Sever-side error): {e}", False
@@ -0,0 +1,168 @@
+# Importing required libraries
+import os
+import time
+import argparse
+import llama_cpp
+from llama_cpp import Llama
+
+from .model_pool import MODEL_DIR, DEFAULT_N_CTX, DEFAULT_LLAMA_KWARGS, POOL_MEMORY_BUDGET_GB
+from .context_policy import kv_cache_bytes
+from .runtime_profiles import save_profile, host_id, PROFILE_PATH
+
+# Reference chat turn used to score a configuration: prompt tokens to evaluate + tokens to generate
+BENCH_PROMPT_TOKENS = 512
+BENCH_GEN_TOKENS = 64
+BENCH_TEXT = (
+    "Jarvis is a helpful assistant that answers questions about documents, the weather and smart lights. "
+    "It reads the context, keeps the answer short and never makes up facts. "
+)
+
+# Search space
+BATCH_CANDIDATES = (64, 128, 256, 512)
+FLASH_ATTN_CANDIDATES = (False, True)
+CTX_CANDIDATES = (2048, 4096, 8192, 16384)
+
+def thread_candidates() -> list[int]:
+    n_cpu = os.cpu_count() or 1
+    candidates = {n_cpu, max(1, n_cpu // 2)} | {n for n in (2, 4, 6, 8, 12, 16, 24, 32, 48, 64) if n <= n_cpu}
+    return sorted(candidates)
+
+def load(model_path: str, n_ctx: int, n_batch: int, flash_attn: bool, n_threads: int) -> Llama:
+    return Llama(
+        model_path = model_path, n_ctx = n_ctx, n_batch = n_batch, n_ubatch = n_batch,
+        flash_attn = flash_attn, n_threads = n_threads, n_threads_batch = n_threads,
+        n_gpu_layers = 0, verbose = False
+    )
+
+def measure(llm: Llama, prompt_tokens: int = BENCH_PROMPT_TOKENS, gen_tokens: int = BENCH_GEN_TOKENS) -> dict:
+    """
+    Measure prompt evaluation and generation speed (tokens/s) of a loaded instance.
+    """
+    text = BENCH_TEXT * (prompt_tokens // 16 + 1)
+    tokens = llm.tokenize(text.encode("utf-8"), add_bos = True)[:min(prompt_tokens, llm.n_ctx() - gen_tokens - 1)]
+
+    # Warm up (first decode allocates the compute buffers)
+    llm.reset()
+    llm.eval(tokens[:8])
+
+    # Prompt evaluation
+    llm.reset()
+    start = time.perf_counter()
+    llm.eval(tokens)
+    prompt_time = time.perf_counter() - start
+
+    # Generation: one token per decode, like sampling (the sampler itself is negligible)
+    token = tokens[-1]
+    start = time.perf_counter()
+    for _ in range(gen_tokens):
+        llm.eval([token])
+    gen_time = time.perf_counter() - start
+
+    result = {
+        "prompt_tokens_per_s": len(tokens) / prompt_time,
+        "gen_tokens_per_s": gen_tokens / gen_time,
+    }
+    # Time of the reference turn (lower is better)
+    result["turn_time"] = BENCH_PROMPT_TOKENS / result["prompt_tokens_per_s"] + BENCH_GEN_TOKENS / result["gen_tokens_per_s"]
+    return result
+
+def autotune(model: str, model_dir: str = MODEL_DIR, max_ctx: int = None, verbose: bool = True) -> dict:
+    """
+    Benchmark a GGUF model on this host and return the best runtime profile.\n
+    1. Threads: generation threads (n_threads) and prompt threads (n_threads_batch) on one instance
+    2. n_batch and flash_attn: every combination with the best threads
+    3. n_ctx: the biggest context up to DEFAULT_N_CTX (or max_ctx) whose KV cache fits the pool memory budget
+       next to the weights, and that loads (the reference turn barely depends on n_ctx, so it does not choose it)
+    """
+    model_path = os.path.join(model_dir, model)
+    log = print if verbose else (lambda *args, **kwargs: None)
+    log(f">>> Autotuning {model} on {host_id()}")
+
+    # 1. Threads (changed at runtime, no reload)
+    llm = load(model_path, n_ctx = 4096, n_batch = 256, flash_attn = False, n_threads = thread_candidates()[-1])
+    n_ctx_train = llm._model.n_ctx_train()
+    kv_bytes_per_token = kv_cache_bytes(llm, n_ctx = 1)
+    best_gen = best_prompt = None
+    for n in thread_candidates():
+        llama_cpp.llama_set_n_threads(llm.ctx, n, n)
+        result = measure(llm)
+        log(f"    threads={n:<3} prompt={result['prompt_tokens_per_s']:8.1f} tok/s  gen={result['gen_tokens_per_s']:6.1f} tok/s")
+        if best_gen is None or result["gen_tokens_per_s"] > best_gen[1]:
+            best_gen = (n, result["gen_tokens_per_s"])
+        if best_prompt is None or result["prompt_tokens_per_s"] > best_prompt[1]:
+            best_prompt = (n, result["prompt_tokens_per_s"])
+    llm.close()
+    n_threads, n_threads_batch = best_gen[0], best_prompt[0]
+
+    def run(n_ctx: int, n_batch: int, flash_attn: bool) -> dict:
+        llm = load(model_path, n_ctx = n_ctx, n_batch = n_batch, flash_attn = flash_attn, n_threads = n_threads)
+        try:
+            llama_cpp.llama_set_n_threads(llm.ctx, n_threads, n_threads_batch)
+            return measure(llm)
+        finally:
+            llm.close()
+
+    # 2. Batch size and flash attention
+    best = None
+    for n_batch in BATCH_CANDIDATES:
+        for flash_attn in FLASH_ATTN_CANDIDATES:
+            try:
+                result = run(4096, n_batch, flash_attn)
+            except Exception as e:
+                log(f"    n_batch={n_batch} flash_attn={flash_attn}: failed ({e})")
+                continue
+            log(f"    n_batch={n_batch:<4} flash_attn={flash_attn!s:<5} turn={result['turn_time']:.2f}s")
+            if best is None or result["turn_time"] < best[2]["turn_time"]:
+                best = (n_batch, flash_attn, result)
+    if best is None:
+        # Every run failed: default batch settings, with the speeds measured in step 1
+        log("    every n_batch / flash_attn run failed, keeping the defaults")
+        best = (DEFAULT_LLAMA_KWARGS["n_batch"], DEFAULT_LLAMA_KWARGS["flash_attn"],
+                {"prompt_tokens_per_s": best_prompt[1], "gen_tokens_per_s": best_gen[1]})
+    n_batch, flash_attn, result = best
+
+    # 3. Context size: the biggest one that fits the memory budget, largest first
+    max_ctx = min(max_ctx or DEFAULT_N_CTX, n_ctx_train)
+    free_bytes = POOL_MEMORY_BUDGET_GB * (1 << 30) - os.path.getsize(model_path)
+    candidates = sorted({n for n in CTX_CANDIDATES if n <= max_ctx} | {max_ctx}, reverse = True)
+    for n_ctx in candidates:
+        if n_ctx * kv_bytes_per_token > free_bytes:
+            log(f"    n_ctx={n_ctx:<6} KV cache of {n_ctx * kv_bytes_per_token / 2**30:.2f} GB does not fit the budget")
+            continue
+        try:
+            result = run(n_ctx, n_batch, flash_attn)
+        except Exception as e: # not enough memory
+            log(f"    n_ctx={n_ctx}: failed ({e})")
+            continue
+        log(f"    n_ctx={n_ctx:<6} turn={result['turn_time']:.2f}s")
+        break
+    else:
+        n_ctx = candidates[-1]
+
+    profile = {
+        "n_ctx": n_ctx,
+        "n_threads": n_threads,
+        "n_threads_batch": n_threads_batch,
+        "n_batch": n_batch,
+        "flash_attn": flash_attn,
+        "prompt_tokens_per_s": round(result["prompt_tokens_per_s"], 1),
+        "gen_tokens_per_s": round(result["gen_tokens_per_s"], 1),
+        "llama_cpp_version": llama_cpp.__version__,
+        "tuned_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    log(f">>> Best profile for {model}: {profile}")
+    return profile
+
+if __name__ == "__main__":
+    # python -m modules.chatbot_utils.autotune [--models a.gguf b.gguf] [--max-ctx 8192]
+    parser = argparse.ArgumentParser(description = "Benchmark the installed GGUF models and save the best runtime profile per (host, model).")
+    parser.add_argument("--models", nargs = "*", help = "GGUF file names (default: every model in the model folder)")
+    parser.add_argument("--model-dir", default = MODEL_DIR)
+    parser.add_argument("--max-ctx", type = int, default = None, help = f"Biggest context size to consider (default: {DEFAULT_N_CTX})")
+    args = parser.parse_args()
+
+    models = args.models or sorted(f for f in os.listdir(args.model_dir) if f.endswith(".gguf"))
+    for model in models:
+        profile = autotune(model, model_dir = args.model_dir, max_ctx = args.max_ctx)
+        save_profile(model, profile)
+    print(f">>> Profiles saved to {PROFILE_PATH}")
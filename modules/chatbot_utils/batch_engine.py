@@ -0,0 +1,340 @@
+# Importing required libraries
+import os
+import time
+import queue
+import codecs
+import itertools
+import threading
+from typing import Generator, Optional
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp._internals import LlamaBatch, LlamaContext, LlamaSampler
+
+from .model_pool import model_pool
+from .scheduler import Priority, QueueFullError, RequestCancelled
+
+# Continuous batching settings, can be changed in .env
+USE_CONTINUOUS_BATCHING = os.getenv("LLM_CONTINUOUS_BATCHING", "false").lower() == "true"
+BATCH_N_PARALLEL = int(os.getenv("LLM_BATCH_N_PARALLEL", "8"))
+BATCH_N_CTX = int(os.getenv("LLM_BATCH_N_CTX", "16384"))
+BATCH_N_BATCH = int(os.getenv("LLM_BATCH_N_BATCH", "512"))
+BATCH_MAX_PENDING = int(os.getenv("LLM_BATCH_MAX_PENDING", "64"))
+
+class BatchRequest:
+    """
+    One sequence of the batch: its prompt, sampler, position in the KV cache and output queue.
+    """
+    def __init__(self, request_id: int, prompt_tokens: list[int], max_tokens: int, sampler: LlamaSampler,
+                 stop: list[str], priority: Priority, cancel_event: threading.Event):
+        self.request_id = request_id
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.sampler = sampler
+        self.stop = stop
+        self.priority = priority
+        self.cancel_event = cancel_event
+
+        self.output: queue.Queue = queue.Queue()
+        self.seq_id: Optional[int] = None
+        self.n_past = 0              # tokens of this sequence already in the KV cache
+        self.pending: list[int] = [] # prompt tokens not evaluated yet
+        self.last_token: Optional[int] = None
+        self.logits_index: Optional[int] = None # index in the batch of the token to sample from
+        self.n_generated = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors = "ignore")
+        self.text_buffer = "" # text held back while it could still become a stop sequence
+        self.enqueued_at = time.perf_counter()
+
+    @property
+    def reserved_tokens(self) -> int:
+        return len(self.prompt_tokens) + self.max_tokens
+
+class BatchEngine:
+    """
+    Continuous batching of several generations in one llama context.\n
+    The engine shares the weights of a pooled Llama instance and owns a separate context with n_parallel sequences.
+    A background loop builds one batch per step: one new token for every generating sequence, plus prompt chunks
+    of the sequences that just joined. New requests join the running batch at token boundaries, and each
+    request's streaming generator is fed from that shared decode loop.
+    """
+    def __init__(self, llm: Llama, n_parallel: int = BATCH_N_PARALLEL, n_ctx: int = BATCH_N_CTX,
+                 n_batch: int = BATCH_N_BATCH, max_pending: int = BATCH_MAX_PENDING):
+        self.llm = llm
+        self.n_parallel = n_parallel
+        self.n_ctx = n_ctx
+        self.n_batch = n_batch
+        self.max_pending = max_pending
+
+        # A new context on the same model weights, with one KV sequence per parallel request
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = n_batch
+        params.n_ubatch = n_batch
+        params.n_seq_max = n_parallel
+        params.n_threads = llm.n_threads
+        params.n_threads_batch = llm.n_threads_batch
+        params.flash_attn = llm.context_params.flash_attn
+        params.type_k = llm.context_params.type_k
+        params.type_v = llm.context_params.type_v
+        self._ctx = LlamaContext(model = llm._model, params = params, verbose = False)
+        self._batch = LlamaBatch(n_tokens = n_batch, embd = 0, n_seq_max = n_parallel, verbose = False)
+
+        self._pending: list[BatchRequest] = []
+        self._active: dict[int, BatchRequest] = {} # seq_id -> request
+        self._free_seq_ids = list(range(n_parallel))
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+
+        # Stats
+        self.steps = 0
+        self.tokens_generated = 0
+        self.tokens_prefilled = 0
+        self.decode_time = 0.0
+        self.batch_sizes = 0
+
+        self._thread = threading.Thread(target = self._loop, name = "batch-engine", daemon = True)
+        self._thread.start()
+
+    ### Public API
+    def submit(self, prompt: str, max_tokens: int = 1024, temperature: float = 0.7, top_k: int = 40,
+               top_p: float = 0.95, min_p: float = 0.05, repeat_penalty: float = 1.1, stop: list[str] = None,
+               priority: Priority = Priority.CHAT, cancel_event: threading.Event = None) -> Generator[str, None, None]:
+        """
+        Add a prompt to the batch and return a generator of text chunks.
+        """
+        prompt_tokens = self.llm.tokenize(prompt.encode("utf-8"), add_bos = True, special = True)
+        if len(prompt_tokens) + max_tokens > self.n_ctx:
+            max_tokens = self.n_ctx - len(prompt_tokens)
+            if max_tokens <= 0:
+                raise ValueError(f"The prompt ({len(prompt_tokens)} tokens) does not fit in the batch context ({self.n_ctx}).")
+
+        request = BatchRequest(
+            next(self._ids), prompt_tokens, max_tokens,
+            self._make_sampler(prompt_tokens, temperature, top_k, top_p, min_p, repeat_penalty),
+            stop or [], priority, cancel_event or threading.Event()
+        )
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                request.sampler.close()
+                raise QueueFullError(f"Too many requests are waiting ({self.max_pending}), please try again later.")
+            self._pending.append(request)
+            self._pending.sort(key = lambda r: (r.priority, r.request_id))
+            self._cond.notify()
+
+        return self._stream(request)
+
+    def close(self) -> None:
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self._active),
+            "pending": len(self._pending),
+            "steps": self.steps,
+            "tokens_generated": self.tokens_generated,
+            "tokens_prefilled": self.tokens_prefilled,
+            "avg_batch_size": self.batch_sizes / self.steps if self.steps else 0.0,
+            "tokens_per_second": (self.tokens_generated + self.tokens_prefilled) / self.decode_time if self.decode_time else 0.0,
+        }
+
+    ### Helpers
+    def _make_sampler(self, prompt_tokens: list[int], temperature: float, top_k: int,
+                      top_p: float, min_p: float, repeat_penalty: float) -> LlamaSampler:
+        sampler = LlamaSampler()
+        sampler.add_penalties(
+            n_vocab = self.llm.n_vocab(),
+            special_eos_id = self.llm.token_eos(),
+            linefeed_id = self.llm.token_nl(),
+            penalty_last_n = self.llm.last_n_tokens_size,
+            penalty_repeat = repeat_penalty,
+            penalty_freq = 0.0,
+            penalty_present = 0.0,
+            penalize_nl = True,
+            ignore_eos = False,
+        )
+        if temperature <= 0:
+            sampler.add_greedy()
+        else:
+            sampler.add_top_k(top_k)
+            sampler.add_top_p(top_p, 1)
+            sampler.add_min_p(min_p, 1)
+            sampler.add_temp(temperature)
+            sampler.add_dist(llama_cpp.LLAMA_DEFAULT_SEED)
+
+        # The repetition penalty also looks at the end of the prompt
+        for token in prompt_tokens[-self.llm.last_n_tokens_size:]:
+            llama_cpp.llama_sampler_accept(sampler.sampler, token)
+        return sampler
+
+    def _stream(self, request: BatchRequest) -> Generator[str, None, None]:
+        try:
+            while True:
+                item = request.output.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Consumer gone (or done): the loop drops the sequence at the next step
+            request.cancel_event.set()
+
+    def _add_token(self, token: int, pos: int, seq_id: int, logits: bool) -> int:
+        batch = self._batch.batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.n_seq_id[i] = 1
+        batch.seq_id[i][0] = seq_id
+        batch.logits[i] = logits
+        batch.n_tokens += 1
+        return i
+
+    def _admit(self) -> None:
+        """
+        Move pending requests into free sequences while their tokens fit in the KV cache.
+        """
+        reserved = sum(r.reserved_tokens for r in self._active.values())
+        for request in list(self._pending):
+            if not self._free_seq_ids:
+                break
+            if request.cancel_event.is_set():
+                self._pending.remove(request)
+                self._finish(request, RequestCancelled("The request was cancelled while waiting in the queue."))
+                continue
+            if reserved + request.reserved_tokens > self.n_ctx:
+                continue
+            self._pending.remove(request)
+            request.seq_id = self._free_seq_ids.pop(0)
+            request.pending = list(request.prompt_tokens)
+            self._active[request.seq_id] = request
+            reserved += request.reserved_tokens
+
+    def _finish(self, request: BatchRequest, error: Exception = None) -> None:
+        if request.seq_id is not None:
+            self._ctx.kv_cache_seq_rm(request.seq_id, -1, -1)
+            self._active.pop(request.seq_id, None)
+            self._free_seq_ids.append(request.seq_id)
+            request.seq_id = None
+        if error is None and request.text_buffer:
+            request.output.put(request.text_buffer)
+        request.output.put(error)
+        request.output.put(None)
+        request.sampler.close()
+
+    def _emit(self, request: BatchRequest, token: int) -> bool:
+        """
+        Send the text of a new token (holding back possible stop sequences). Returns True when a stop sequence is hit.
+        """
+        piece = self.llm._model.detokenize([token], special = False)
+        request.text_buffer += request.decoder.decode(piece)
+
+        for stop in request.stop:
+            index = request.text_buffer.find(stop)
+            if index != -1:
+                request.text_buffer = request.text_buffer[:index]
+                return True
+
+        holdback = max((len(s) for s in request.stop), default = 1) - 1
+        if len(request.text_buffer) > holdback:
+            cut = len(request.text_buffer) - holdback
+            request.output.put(request.text_buffer[:cut])
+            request.text_buffer = request.text_buffer[cut:]
+        return False
+
+    ### Decode loop
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while self._running and not self._pending and not self._active:
+                    self._cond.wait()
+                if not self._running:
+                    break
+                self._admit()
+
+            # Drop cancelled sequences (client disconnected)
+            for request in list(self._active.values()):
+                if request.cancel_event.is_set():
+                    self._finish(request)
+
+            if not self._active:
+                time.sleep(0.001)
+                continue
+
+            # Build the batch: first one token per generating sequence, then prompt chunks
+            self._batch.reset()
+            budget = self.n_batch
+            for request in self._active.values():
+                request.logits_index = None
+                if not request.pending and request.last_token is not None:
+                    request.logits_index = self._add_token(request.last_token, request.n_past, request.seq_id, True)
+                    request.n_past += 1
+                    budget -= 1
+            for request in self._active.values():
+                if not request.pending or budget <= 0:
+                    continue
+                chunk = request.pending[:budget]
+                request.pending = request.pending[len(chunk):]
+                for j, token in enumerate(chunk):
+                    is_last = not request.pending and j == len(chunk) - 1
+                    index = self._add_token(token, request.n_past, request.seq_id, is_last)
+                    request.n_past += 1
+                    if is_last:
+                        request.logits_index = index
+                budget -= len(chunk)
+                self.tokens_prefilled += len(chunk)
+
+            # One decode step for every sequence
+            n_tokens = self._batch.n_tokens()
+            start = time.perf_counter()
+            try:
+                self._ctx.decode(self._batch)
+            except Exception as e:
+                for request in list(self._active.values()):
+                    self._finish(request, e)
+                continue
+            self.decode_time += time.perf_counter() - start
+            self.steps += 1
+            self.batch_sizes += n_tokens
+
+            # Sample the next token of every sequence that has logits in this batch
+            for request in list(self._active.values()):
+                if request.logits_index is None:
+                    continue
+                token = request.sampler.sample(self._ctx, request.logits_index)
+                request.n_generated += 1
+                self.tokens_generated += 1
+                if llama_cpp.llama_token_is_eog(self.llm._model.vocab, token):
+                    self._finish(request)
+                    continue
+                stopped = self._emit(request, token)
+                if stopped or request.n_generated >= request.max_tokens:
+                    self._finish(request)
+                    continue
+                request.last_token = token
+
+        # Engine closed: end every request
+        for request in list(self._active.values()) + self._pending:
+            self._finish(request, RequestCancelled("The batch engine was closed."))
+        self._pending.clear()
+
+# One engine per model, created on first use
+batch_engines: dict[str, BatchEngine] = {}
+_engines_lock = threading.Lock()
+
+def get_batch_engine(model: str) -> BatchEngine:
+    """
+    Get the batch engine of a model. The model is pinned in the pool, since the engine shares its weights.
+    """
+    with _engines_lock:
+        engine = batch_engines.get(model)
+        if engine is None:
+            llm = model_pool.get(model)
+            model_pool.pin(model)
+            engine = BatchEngine(llm)
+            batch_engines[model] = engine
+        return engine
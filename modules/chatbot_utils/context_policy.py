@@ -0,0 +1,107 @@
+# Importing required libraries
+import os
+import threading
+from collections import OrderedDict
+import llama_cpp
+from llama_cpp import Llama
+
+# KV cache settings, can be changed in .env
+# Types: f16 (default), q8_0 (about half the memory) or q4_0 (about a quarter)
+KV_CACHE_TYPE = os.getenv("LLM_KV_TYPE", "f16").lower()
+KV_TYPES = {
+    "f16": llama_cpp.GGML_TYPE_F16,
+    "q8_0": llama_cpp.GGML_TYPE_Q8_0, "q8": llama_cpp.GGML_TYPE_Q8_0,
+    "q4_0": llama_cpp.GGML_TYPE_Q4_0, "q4": llama_cpp.GGML_TYPE_Q4_0,
+}
+# Bytes per element (q8_0 / q4_0 blocks: 32 values + one f16 scale)
+KV_TYPE_BYTES = {
+    llama_cpp.GGML_TYPE_F16: 2.0,
+    llama_cpp.GGML_TYPE_Q8_0: 34 / 32,
+    llama_cpp.GGML_TYPE_Q4_0: 18 / 32,
+}
+KV_TYPE_NAMES = {llama_cpp.GGML_TYPE_F16: "f16", llama_cpp.GGML_TYPE_Q8_0: "q8_0", llama_cpp.GGML_TYPE_Q4_0: "q4_0"}
+
+# Dynamic context sizing: each request uses the smallest bucket that fits prompt + max_tokens
+DYNAMIC_CTX = os.getenv("LLM_DYNAMIC_CTX", "false").lower() == "true"
+CTX_BUCKETS = tuple(sorted(int(n) for n in os.getenv("LLM_CTX_BUCKETS", "2048,4096,8192,16384").split(",")))
+CTX_HEADROOM = 1.1 # margin for the chat template tokens the estimate does not see
+CTX_INSTANCES = int(os.getenv("LLM_CTX_INSTANCES", "2")) # bucket instances kept per model (least recently used evicted)
+MAX_SESSION_BUCKETS = 4096 # sessions whose bucket is remembered
+
+# Bucket of each session: (model, session id) -> n_ctx, only grows (the KV states of a session stay in one instance)
+_session_buckets: OrderedDict[tuple[str, str], int] = OrderedDict()
+_session_lock = threading.Lock()
+
+def kv_cache_kwargs(kv_type: str = KV_CACHE_TYPE) -> dict:
+    """
+    Llama arguments of the KV cache type. A quantized V cache needs flash attention in llama.cpp.
+    """
+    if kv_type not in KV_TYPES:
+        raise ValueError(f"Unknown KV cache type '{kv_type}', use one of {list(KV_TYPES)}.")
+    ggml_type = KV_TYPES[kv_type]
+    kwargs = {"type_k": ggml_type, "type_v": ggml_type}
+    if ggml_type != llama_cpp.GGML_TYPE_F16:
+        kwargs["flash_attn"] = True
+    return kwargs
+
+def kv_cache_bytes(llm: Llama, n_ctx: int = None) -> int:
+    """
+    Memory of the KV cache of an instance: n_ctx * n_layer * (K + V values per token) * bytes per value.
+    """
+    metadata = llm.metadata
+    arch = metadata.get("general.architecture", "llama")
+    n_layer = int(metadata.get(f"{arch}.block_count", 0))
+    n_embd = int(metadata.get(f"{arch}.embedding_length", 0))
+    n_head = int(metadata.get(f"{arch}.attention.head_count", 1))
+    n_head_kv = int(metadata.get(f"{arch}.attention.head_count_kv", n_head))
+    head_dim_k = int(metadata.get(f"{arch}.attention.key_length", n_embd // max(n_head, 1)))
+    head_dim_v = int(metadata.get(f"{arch}.attention.value_length", n_embd // max(n_head, 1)))
+
+    params = llm.context_params
+    bytes_k = KV_TYPE_BYTES.get(params.type_k, 2.0)
+    bytes_v = KV_TYPE_BYTES.get(params.type_v, 2.0)
+    n_ctx = n_ctx or llm.n_ctx()
+    return int(n_ctx * n_layer * n_head_kv * (head_dim_k * bytes_k + head_dim_v * bytes_v))
+
+def kv_cache_report(llm: Llama) -> dict:
+    params = llm.context_params
+    return {
+        "n_ctx": llm.n_ctx(),
+        "type_k": KV_TYPE_NAMES.get(params.type_k, str(params.type_k)),
+        "type_v": KV_TYPE_NAMES.get(params.type_v, str(params.type_v)),
+        "kv_bytes": kv_cache_bytes(llm),
+        "kv_bytes_per_token": kv_cache_bytes(llm, n_ctx = 1),
+    }
+
+def context_buckets(max_ctx: int = None) -> list[int]:
+    """
+    The context buckets of an instance of at most max_ctx tokens, smallest first.
+    """
+    return [n for n in CTX_BUCKETS if max_ctx is None or n <= max_ctx] or [max_ctx]
+
+def context_bucket(n_tokens: int, max_ctx: int = None) -> int:
+    """
+    Smallest context bucket that holds n_tokens (prompt + max_tokens), at most max_ctx.
+    """
+    needed = int(n_tokens * CTX_HEADROOM)
+    buckets = context_buckets(max_ctx)
+    for n_ctx in buckets:
+        if n_ctx >= needed:
+            return n_ctx
+    return buckets[-1]
+
+def session_bucket(model: str, session_id: str, n_tokens: int, max_ctx: int = None) -> int:
+    """
+    Context bucket of a request of a session: the smallest that holds n_tokens, but never smaller than the
+    previous bucket of the session, so its cached KV states stay in the same instance.
+    """
+    n_ctx = context_bucket(n_tokens, max_ctx)
+    if not session_id:
+        return n_ctx
+    with _session_lock:
+        key = (model, session_id)
+        n_ctx = max(n_ctx, min(_session_buckets.pop(key, 0), max_ctx or n_ctx))
+        _session_buckets[key] = n_ctx
+        while len(_session_buckets) > MAX_SESSION_BUCKETS:
+            _session_buckets.popitem(last = False)
+    return n_ctx
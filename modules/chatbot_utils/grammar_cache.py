@@ -0,0 +1,99 @@
+# Importing required libraries
+import threading
+from copy import deepcopy
+from collections import OrderedDict
+from llama_cpp import Llama, LlamaGrammar
+from llama_cpp_agent.providers import LlamaCppPythonProvider
+from llama_cpp_agent.llm_output_settings import LlmStructuredOutputSettings, LlmStructuredOutputType
+
+# GBNF grammar of the smart light commands: [{"signal": ..., "color": ...}, ...]
+bluetooth_grammar = r"""
+root    ::= "[" ws command ( "," ws command )* ws "]"
+command ::= "{" ws "\"signal\"" ws ":" ws signal ws "," ws "\"color\"" ws ":" ws color ws "}"
+signal  ::= "\"on\"" | "\"blink\"" | "\"off\""
+color   ::= "\"red\"" | "\"green\"" | "\"yellow\"" | "\"all\""
+ws      ::= [ \t\n]{0,8}
+"""
+
+MAX_CACHED_SETTINGS = 64
+
+class GrammarCache:
+    """
+    Process-wide cache of grammars.\n
+    + GBNF text of each structured output settings object (generating it from the pydantic models is slow)
+    + LlamaGrammar object of each GBNF text, shared by every provider instead of one dict per provider
+    """
+    def __init__(self):
+        self._texts: OrderedDict[int, tuple[LlmStructuredOutputSettings, str]] = OrderedDict()
+        self._grammars: dict[str, LlamaGrammar] = {}
+        self._lock = threading.Lock()
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+
+    def gbnf(self, structured_output_settings: LlmStructuredOutputSettings) -> str:
+        key = id(structured_output_settings)
+        with self._lock:
+            entry = self._texts.get(key)
+            # The settings object is kept in the entry, so its id cannot be reused while cached
+            if entry is not None and entry[0] is structured_output_settings:
+                self._texts.move_to_end(key)
+                return entry[1]
+
+        text = structured_output_settings.get_gbnf_grammar()
+        with self._lock:
+            self._texts[key] = (structured_output_settings, text)
+            while len(self._texts) > MAX_CACHED_SETTINGS:
+                self._texts.popitem(last = False)
+        return text
+
+    def get(self, gbnf: str) -> LlamaGrammar:
+        with self._lock:
+            grammar = self._grammars.get(gbnf)
+            if grammar is not None:
+                self.hits += 1
+                return grammar
+            self.misses += 1
+            grammar = self._grammars[gbnf] = LlamaGrammar.from_string(gbnf, verbose = False)
+            return grammar
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"grammars": len(self._grammars), "settings": len(self._texts), "hits": self.hits, "misses": self.misses}
+
+# Global grammar cache
+grammar_cache = GrammarCache()
+
+class CachedGrammarProvider(LlamaCppPythonProvider):
+    """
+    LlamaCppPythonProvider that takes its grammars from the global grammar cache.\n
+    A raw GBNF grammar can also be given, it constrains every completion without structured output settings.
+    """
+    def __init__(self, llama_model: Llama, grammar: str = None):
+        super().__init__(llama_model)
+        self.grammar = grammar
+
+    def _grammar(self, structured_output_settings: LlmStructuredOutputSettings):
+        if structured_output_settings.output_type != LlmStructuredOutputType.no_structured_output:
+            return grammar_cache.get(grammar_cache.gbnf(structured_output_settings))
+        if self.grammar is not None:
+            return grammar_cache.get(self.grammar)
+        return None
+
+    def create_completion(self, prompt: str, structured_output_settings: LlmStructuredOutputSettings,
+                          settings, bos_token: str):
+        settings_dictionary = deepcopy(settings.as_dict())
+        settings_dictionary["stop"] = settings_dictionary.pop("additional_stop_sequences")
+        return self.llama_model.create_completion(
+            prompt, grammar = self._grammar(structured_output_settings), **settings_dictionary
+        )
+
+    def create_chat_completion(self, messages: list[dict[str, str]],
+                               structured_output_settings: LlmStructuredOutputSettings, settings):
+        settings_dictionary = deepcopy(settings.as_dict())
+        settings_dictionary["max_tokens"] = settings_dictionary.pop("n_predict")
+        settings_dictionary["stop"] = settings_dictionary.pop("stop_sequences")
+        return self.llama_model.create_chat_completion(
+            messages, grammar = self._grammar(structured_output_settings), **settings_dictionary
+        )
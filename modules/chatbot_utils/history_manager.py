@@ -0,0 +1,192 @@
+# Importing required libraries
+import os
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+from .prompts import summary_prompt, summary_input_format
+from .model_pool import model_pool
+from .scheduler import Priority
+from .kv_cache import DEFAULT_SESSION
+
+# History settings, can be changed in .env
+HISTORY_TOKEN_BUDGET = int(os.getenv("LLM_HISTORY_TOKENS", "3072"))
+HISTORY_KEEP_RATIO = float(os.getenv("LLM_HISTORY_KEEP_RATIO", "0.6"))
+SUMMARY_MAX_TOKENS = int(os.getenv("LLM_SUMMARY_MAX_TOKENS", "256"))
+TURN_OVERHEAD_TOKENS = 10 # header / end-of-turn markers of the user and assistant messages
+MAX_COUNTED_TURNS = 10000
+MAX_SESSIONS = 256
+
+# Session id used by the summarizer (its prompts are one-off, so they get their own KV-state session)
+SUMMARY_SESSION = "__summary__"
+
+class SessionHistory:
+    """
+    Window and rolling summary of one conversation.
+    """
+    def __init__(self):
+        self.window_start = 0     # first turn sent as-is to the model
+        self.summary = ""         # summary of the turns before summarized_turns
+        self.summarized_turns = 0
+        self.pending = False      # a summary job is queued or running
+
+class HistoryManager:
+    """
+    Keep the prompt size bounded, whatever the length of the conversation.\n
+    + The token count of each turn is computed once and cached
+    + The most recent turns are kept within token_budget. When the budget is exceeded, the window jumps forward
+      to keep_ratio * token_budget, so the prompt prefix (and its cached KV state) stays the same for several turns
+    + Turns that leave the window are folded into a rolling summary by a background worker (off the request path)
+    """
+    def __init__(self, token_budget: int = HISTORY_TOKEN_BUDGET, keep_ratio: float = HISTORY_KEEP_RATIO,
+                 summary_max_tokens: int = SUMMARY_MAX_TOKENS):
+        self.token_budget = token_budget
+        self.keep_ratio = keep_ratio
+        self.summary_max_tokens = summary_max_tokens
+        self._counts: OrderedDict[str, int] = OrderedDict()
+        self._sessions: OrderedDict[str, SessionHistory] = OrderedDict()
+        self._lock = threading.Lock()
+        self._jobs: queue.Queue = queue.Queue()
+        self._worker = None
+
+        # Stats
+        self.count_hits = 0
+        self.count_misses = 0
+        self.summaries = 0
+        self.summary_failures = 0
+
+    def count_turn(self, model: str, user: str, assistant: str) -> int:
+        """
+        Number of tokens of a (user, assistant) turn, cached by content.
+        """
+        key = hashlib.sha1(f"{model}\0{user}\0{assistant}".encode("utf-8")).hexdigest()
+        with self._lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                self.count_hits += 1
+                return self._counts[key]
+
+        n_tokens = self.count_text(model, f"{user}{assistant}") + TURN_OVERHEAD_TOKENS
+
+        with self._lock:
+            self.count_misses += 1
+            self._counts[key] = n_tokens
+            while len(self._counts) > MAX_COUNTED_TURNS:
+                self._counts.popitem(last = False)
+        return n_tokens
+
+    def count_text(self, model: str, text: str) -> int:
+        # Vocabulary-only instance: counting tokens needs neither the weights nor a model slot
+        return len(model_pool.tokenizer(model).tokenize(text.encode("utf-8"), add_bos = False, special = False))
+
+    def count_prompt(self, model: str, system_message: str, summary: str,
+                     history: List[Tuple[str, str]], message: str) -> int:
+        """
+        Estimated number of prompt tokens of a chat request (the turns use the cached counts).
+        """
+        n_tokens = self.count_text(model, f"{system_message}{summary}{message}") + 2 * TURN_OVERHEAD_TOKENS
+        return n_tokens + sum(self.count_turn(model, user, assistant) for user, assistant in history)
+
+    def _session(self, session_id: str) -> SessionHistory:
+        state = self._sessions.get(session_id)
+        if state is None:
+            state = self._sessions[session_id] = SessionHistory()
+            while len(self._sessions) > MAX_SESSIONS:
+                self._sessions.popitem(last = False)
+        self._sessions.move_to_end(session_id)
+        return state
+
+    def window(self, history: List[Tuple[str, str]], session_id: str = None,
+               model: str = None) -> Tuple[str, List[Tuple[str, str]]]:
+        """
+        Get (summary, recent turns) for the next prompt.
+
+        Args:
+            - history (List[Tuple[str, str]]) : The full chat history of the session.
+            - session_id (str) : The conversation id.
+            - model (str) : The model used (for its tokenizer and for the summary).
+
+        Returns:
+            Tuple[str, List[Tuple[str, str]]]: The summary of the older turns ("" if none) and the turns to keep.
+        """
+        session_id = session_id or DEFAULT_SESSION
+        counts = [self.count_turn(model, user, assistant) for user, assistant in history]
+
+        with self._lock:
+            state = self._session(session_id)
+
+            # The history was reset (new chat with the same session id)
+            if len(history) < state.window_start or len(history) < state.summarized_turns:
+                state = self._sessions[session_id] = SessionHistory()
+
+            # Jump the window forward only when the budget is exceeded
+            start = state.window_start
+            if sum(counts[start:]) > self.token_budget:
+                target = self.token_budget * self.keep_ratio
+                while start < len(history) and sum(counts[start:]) > target:
+                    start += 1
+                state.window_start = start
+
+            # Fold the turns that left the window into the summary (in the background)
+            if start > state.summarized_turns and not state.pending:
+                state.pending = True
+                self._jobs.put((session_id, model, list(history[state.summarized_turns:start]), start, state))
+                self._start_worker()
+
+            return state.summary, list(history[start:])
+
+    ### Background summarization
+    def _start_worker(self) -> None:
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target = self._work, name = "history-summarizer", daemon = True)
+            self._worker.start()
+
+    def _work(self) -> None:
+        while True:
+            session_id, model, turns, upto, state = self._jobs.get()
+            try:
+                summary = self._summarize(model, state.summary, turns)
+                with self._lock:
+                    state.summary = summary
+                    state.summarized_turns = upto
+                    self.summaries += 1
+            except Exception as e:
+                print(f">>> Failed to summarize the history of session '{session_id}': {e}")
+                with self._lock:
+                    self.summary_failures += 1
+            finally:
+                with self._lock:
+                    state.pending = False
+                self._jobs.task_done()
+
+    def _summarize(self, model: str, summary: str, turns: List[Tuple[str, str]]) -> str:
+        # Imported here: respond() itself uses the history manager
+        from .llm_respond import respond
+
+        conversation = "\n".join(f"User: {user}\nAssistant: {assistant}" for user, assistant in turns)
+        answer = respond(
+            message = summary_input_format.format(summary = summary or "(none)", conversation = conversation),
+            history = [], model = model, system_message = summary_prompt,
+            max_tokens = self.summary_max_tokens, temperature = 0.3,
+            session_id = SUMMARY_SESSION, priority = Priority.RAG, use_history_window = False
+        )
+        if not isinstance(answer, str) or answer.startswith("An error happens in Chatbot"):
+            raise RuntimeError(answer)
+        return answer.strip()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "counted_turns": len(self._counts),
+                "count_hits": self.count_hits,
+                "count_misses": self.count_misses,
+                "summaries": self.summaries,
+                "summary_failures": self.summary_failures,
+                "pending_summaries": self._jobs.qsize(),
+            }
+
+# Global history manager used by respond()
+history_manager = HistoryManager()
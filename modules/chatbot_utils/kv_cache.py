@@ -0,0 +1,253 @@
+# Importing required libraries
+import os
+import atexit
+import pickle
+import shutil
+import hashlib
+import weakref
+import itertools
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+from llama_cpp import Llama
+from llama_cpp.llama import LlamaState
+from llama_cpp.llama_cache import BaseLlamaCache
+
+# Budgets of the KV-state cache (per loaded model), can be changed in .env
+KV_CACHE_RAM_MB = int(os.getenv("KV_CACHE_RAM_MB", "1024"))
+KV_CACHE_DISK_MB = int(os.getenv("KV_CACHE_DISK_MB", "4096"))
+KV_CACHE_DIR = os.getenv("KV_CACHE_DIR", "./cache/kv_states")
+
+# Session used when the caller does not give one
+DEFAULT_SESSION = "default"
+
+# Pseudo-session of the system prompt snapshots (shared by every session, never evicted)
+SYSTEM_SESSION = "__system__"
+
+# Key of a cached state: (session id, token sequence)
+StateKey = Tuple[str, Tuple[int, ...]]
+
+# Spill folders: KV_CACHE_DIR/<namespace>/<pid>-<n>, one per cache (the files of a cache are useless to any other)
+_folder_ids = itertools.count()
+_open_caches: weakref.WeakSet = weakref.WeakSet()
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    if os.name != "posix":
+        # No cheap check without killing the process: keep the folder (removed by its process at exit)
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def remove_orphan_states(namespace_dir: str) -> None:
+    """
+    Delete the spilled states no cache owns anymore: folders of dead processes (crash) and loose files.
+    """
+    if not os.path.isdir(namespace_dir):
+        return
+    for name in os.listdir(namespace_dir):
+        path = os.path.join(namespace_dir, name)
+        if os.path.isdir(path):
+            pid = name.split("-")[0]
+            if pid.isdigit() and not _pid_alive(int(pid)):
+                shutil.rmtree(path, ignore_errors = True)
+        elif name.endswith(".pkl"):
+            os.remove(path)
+
+def state_size(state: LlamaState) -> int:
+    """
+    Bytes held by a LlamaState (KV data + saved logits).
+    """
+    return int(state.llama_state_size) + int(state.scores.nbytes)
+
+class SessionKVCache(BaseLlamaCache):
+    """
+    A session-keyed KV-state cache for one Llama instance (set with llm.set_cache).\n
+    Llama looks up the state with the longest token prefix of the new prompt (only inside the active session),
+    loads it, and only evaluates the new suffix. After the completion, the state is saved under the active session.\n
+    Old states are moved from RAM to disk, then deleted, when the byte budgets are exceeded.
+    The spilled files are in a folder of this cache, deleted by close() (instance removed from the pool, process exit);
+    the folders of crashed processes are deleted by the next cache of the namespace.
+    """
+    def __init__(self, namespace: str,
+                 capacity_bytes: int = KV_CACHE_RAM_MB << 20,
+                 disk_capacity_bytes: int = KV_CACHE_DISK_MB << 20,
+                 cache_dir: str = KV_CACHE_DIR):
+        super().__init__(capacity_bytes)
+        self.disk_capacity_bytes = disk_capacity_bytes
+        namespace_dir = os.path.join(cache_dir, namespace)
+        remove_orphan_states(namespace_dir)
+        self.cache_dir = os.path.join(namespace_dir, f"{os.getpid()}-{next(_folder_ids)}")
+
+        # LRU order: first item is the least recently used
+        self._ram: OrderedDict[StateKey, LlamaState] = OrderedDict()
+        self._disk: OrderedDict[StateKey, Tuple[str, int]] = OrderedDict() # key -> (file path, size)
+        self._snapshots: dict[StateKey, LlamaState] = {}
+        self._lock = threading.RLock()
+
+        # The session of the running completion
+        self.active_session: str = DEFAULT_SESSION
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.disk_loads = 0
+
+        _open_caches.add(self)
+
+    @contextmanager
+    def session(self, session_id: Optional[str]):
+        """
+        Make session_id the active session while the completion runs.
+        """
+        previous = self.active_session
+        self.active_session = session_id or DEFAULT_SESSION
+        try:
+            yield self
+        finally:
+            self.active_session = previous
+
+    @property
+    def cache_size(self) -> int:
+        return sum(state_size(state) for state in self._ram.values())
+
+    @property
+    def disk_size(self) -> int:
+        return sum(size for _, size in self._disk.values())
+
+    def _find_longest_prefix_key(self, key: Tuple[int, ...]) -> Optional[StateKey]:
+        best_len = 0
+        best_key = None
+        for state_key in list(self._ram.keys()) + list(self._disk.keys()) + list(self._snapshots.keys()):
+            if state_key[0] not in (self.active_session, SYSTEM_SESSION):
+                continue
+            prefix_len = Llama.longest_token_prefix(state_key[1], key)
+            if prefix_len > best_len:
+                best_len = prefix_len
+                best_key = state_key
+        return best_key
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        with self._lock:
+            state_key = self._find_longest_prefix_key(tuple(key))
+            if state_key is None:
+                self.misses += 1
+                raise KeyError("Key not found")
+            self.hits += 1
+
+            # System prompt snapshot
+            if state_key in self._snapshots:
+                return self._snapshots[state_key]
+
+            # State in RAM
+            if state_key in self._ram:
+                self._ram.move_to_end(state_key)
+                return self._ram[state_key]
+
+            # State on disk: load it back to RAM
+            path, _ = self._disk.pop(state_key)
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+            os.remove(path)
+            self.disk_loads += 1
+            self._ram[state_key] = state
+            self._trim()
+            return state
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState) -> None:
+        with self._lock:
+            key = tuple(key)
+
+            # States of the session that are a prefix of the new one are not needed anymore
+            for state_key in list(self._ram.keys()) + list(self._disk.keys()):
+                if state_key[0] == self.active_session and key[:len(state_key[1])] == state_key[1]:
+                    self._drop(state_key)
+
+            self._ram[(self.active_session, key)] = value
+            self._trim()
+
+    def _drop(self, state_key: StateKey) -> None:
+        self._ram.pop(state_key, None)
+        disk_item = self._disk.pop(state_key, None)
+        if disk_item is not None and os.path.exists(disk_item[0]):
+            os.remove(disk_item[0])
+
+    def _trim(self) -> None:
+        """
+        Move the least recently used states from RAM to disk, then delete the oldest ones on disk.
+        """
+        while self.cache_size > self.capacity_bytes and len(self._ram) > 1:
+            state_key, state = self._ram.popitem(last = False)
+            self._spill(state_key, state)
+
+        while self.disk_size > self.disk_capacity_bytes and len(self._disk) > 0:
+            state_key = next(iter(self._disk))
+            self._drop(state_key)
+
+    def _spill(self, state_key: StateKey, state: LlamaState) -> None:
+        if self.disk_capacity_bytes <= 0:
+            return
+        os.makedirs(self.cache_dir, exist_ok = True)
+        name = hashlib.sha1(repr(state_key).encode("utf-8")).hexdigest()
+        path = os.path.join(self.cache_dir, f"{name}.pkl")
+        with open(path, "wb") as f:
+            pickle.dump(state, f, protocol = pickle.HIGHEST_PROTOCOL)
+        self._disk[state_key] = (path, os.path.getsize(path))
+
+    def add_snapshot(self, tokens: Sequence[int], state: LlamaState) -> None:
+        """
+        Add a system prompt snapshot, used by every session whose prompt starts with tokens.
+        """
+        with self._lock:
+            self._snapshots[(SYSTEM_SESSION, tuple(tokens))] = state
+
+    def clear_session(self, session_id: str) -> None:
+        with self._lock:
+            for state_key in list(self._ram.keys()) + list(self._disk.keys()):
+                if state_key[0] == session_id:
+                    self._drop(state_key)
+
+    def close(self) -> None:
+        """
+        Delete the spilled states (when the Llama instance is closed: nothing can load them anymore).
+        """
+        with self._lock:
+            self._ram.clear()
+            self._disk.clear()
+            shutil.rmtree(self.cache_dir, ignore_errors = True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_loads": self.disk_loads,
+                "ram_states": len(self._ram),
+                "ram_bytes": self.cache_size,
+                "disk_states": len(self._disk),
+                "disk_bytes": self.disk_size,
+                "snapshots": len(self._snapshots),
+            }
+
+def get_session_cache(llm: Llama, namespace: str) -> SessionKVCache:
+    """
+    Get the SessionKVCache of a Llama instance (creating it the first time).
+    """
+    if not isinstance(llm.cache, SessionKVCache):
+        llm.set_cache(SessionKVCache(namespace = namespace))
+    return llm.cache
+
+@atexit.register
+def _close_caches() -> None:
+    for cache in list(_open_caches):
+        cache.close()
@@ -1,23 +1,32 @@
 # Importing required libraries
-import os
+import threading
+from contextlib import nullcontext
 from typing import List, Tuple
-from llama_cpp import Llama
 from llama_cpp_agent import LlamaCppAgent
-from llama_cpp_agent.providers import LlamaCppPythonProvider
 from llama_cpp_agent.chat_history import BasicChatHistory
 from llama_cpp_agent.chat_history.messages import Roles
-from llama_cpp_agent.messages_formatter import MessagesFormatter, MessagesFormatterType, PromptMarkers, llama_3_formatter
+from llama_cpp_agent.messages_formatter import MessagesFormatterType, llama_3_formatter
 
-from .prompts import original_prompt, agent_system_prompt
-from ..agent_tool import *
+from .prompts import original_prompt, agent_system_prompt, summary_message_format
+from .model_pool import model_pool, DEFAULT_CHAT_MODEL, DYNAMIC_CTX_VARIANT
+from .kv_cache import get_session_cache
+from .scheduler import scheduler, Priority, QueueFullError, RequestCancelled
+from .batch_engine import get_batch_engine, USE_CONTINUOUS_BATCHING
+from .history_manager import history_manager
+from .grammar_cache import CachedGrammarProvider
+from .speculative import get_speculative_llm, fits_speculative
+from .context_policy import DYNAMIC_CTX, session_bucket
+from .system_snapshots import ensure_system_snapshots
+from .worker_pool import get_worker_pool
+from ..warmup import warmup
 
-llm = None
-llm_model = None
+# Never evict a model while a request is running on it
+model_pool.busy_check = lambda key: scheduler.is_busy(key[0])
 
 def respond(
     message: str,
     history: List[Tuple[str, str]] = [],
-    model: str = "Llama-3.2-3B-Instruct-Q8_0.gguf", # gemma-3-1b-it-Q8_0.gguf
+    model: str = DEFAULT_CHAT_MODEL, # gemma-3-1b-it-Q8_0.gguf
     use_func_call: bool = False,
     system_message: str = original_prompt,
     max_tokens: int = 1024,
@@ -27,7 +36,14 @@ def respond(
     top_k: int = 40,
     repeat_penalty: float = 1.1,
     stream: bool = False,
-    debug_output: bool = None
+    debug_output: bool = None,
+    session_id: str = None,
+    priority: Priority = Priority.CHAT,
+    cancel_event: threading.Event = None,
+    use_batching: bool = None,
+    use_history_window: bool = True,
+    grammar: str = None,
+    speculative: str = None
 ):
     """
     Respond to a message using the Gemma3 model via Llama.cpp.
@@ -42,84 +58,134 @@ def respond(
         - top_p (float) : The top-p of the model.
         - top_k (int) : The top-k of the model.
         - repeat_penalty (float) : The repetition penalty of the model.
+        - session_id (str) : The conversation id, used to reuse the KV state of previous turns.
+        - priority (Priority) : The priority class of the request in the scheduler.
+        - cancel_event (threading.Event) : Set it to cancel the request (e.g. when the client disconnects).
+        - use_batching (bool) : Stream from the continuous batching engine (default: LLM_CONTINUOUS_BATCHING in .env).
+        - use_history_window (bool) : Keep only the recent turns within the token budget, older turns are summarized.
+        - grammar (str) : A GBNF grammar that constrains the answer (compiled once, see grammar_cache).
+        - speculative (str) : Speculative decoding method: "none", "prompt_lookup" or "draft" (see speculative).
 
     Returns:
         str: The response to the message.
     """
     try:
-        # Load the global variables
-        global llm
-        global llm_model
-
         # Ensure model is not None
         if model is None:
-            model = model
-
-        # Load the model
-        if llm is None or llm_model != model:
-            # Get model
-            '''
-            In this case:
-                - model is the string name.
-                - llm is a Llama class instance
-                - llm_model is the string name of the recent llm instance
-            Hence:
-                - If llm is None (no instance) --> get the instance of model
-                - If llm_model isn't new model --> get the instance of new model
-                - Else, skip --> use the current instance of model
-            '''
-            model_path = os.path.join("./llm_models", model)
-            model_path = os.path.abspath(model_path)
-
-            llm = Llama(
-                model_path=model_path,
-                flash_attn=False,
-                n_gpu_layers=0,
-                n_batch=64,
-                n_ctx=8192,
-                n_threads=8,
-                n_threads_batch=8,
-                verbose=False, # Disabling debug output
-            )
-            llm_model = model
-
-        provider = LlamaCppPythonProvider(llm)
-
-        # Create the agent
-        if use_func_call: # Model used for function calling
-            # Create a LlamaCppAgent instance as before, including a system message with information about the tools available for the LLM agent.
-            agent = LlamaCppAgent(
-                provider,
-                debug_output = debug_output if debug_output != None else True,
-                system_prompt = agent_system_prompt,
-                predefined_messages_formatter_type = MessagesFormatterType.CHATML,
-            )
-        elif "Llama-3.2" in model:
-            # Get Llama agent
-            agent = LlamaCppAgent(
-                provider,
-                system_prompt = system_message,
-                custom_messages_formatter = llama_3_formatter,
-                debug_output = debug_output if debug_output != None else False,
+            model = DEFAULT_CHAT_MODEL
+
+        # Multi-process mode (LLM_WORKERS): run the request in the worker process of the session
+        worker_pool = get_worker_pool()
+        if worker_pool is not None:
+            return worker_pool.respond(
+                message = message, history = history, model = model, use_func_call = use_func_call,
+                system_message = system_message, max_tokens = max_tokens, temperature = temperature,
+                top_p = top_p, top_k = top_k, repeat_penalty = repeat_penalty, stream = stream,
+                debug_output = debug_output, session_id = session_id, priority = priority,
+                cancel_event = cancel_event, use_batching = use_batching, use_history_window = use_history_window,
+                grammar = grammar, speculative = speculative
             )
-        else:
-            raise Exception("There is something wrong in the model choice.")
+        use_speculative = speculative not in (None, "none")
+        request_n_ctx = None # context size of this request (None: default instance)
+
+        # Queue on the background warm-up of the model (before taking a slot: the warm-up holds one)
+        warmup.wait(model)
 
-        # Set the settings like temperature, top-k, top-p, max tokens, etc.
-        settings = provider.get_provider_default_settings()
-        settings.temperature = temperature
-        settings.top_k = top_k
-        settings.top_p = top_p
-        settings.max_tokens = max_tokens
-        settings.repeat_penalty = repeat_penalty
-        settings.stream = stream # If does not have this weird and unnecessary looking line, the whole thing breaks
+        def _prepare():
+            """
+            Get the model, the KV-state session, the agent and the sampling settings (called while holding a model slot).
+            """
+            if use_speculative:
+                # Speculative instance (logits_all): its states hold the logits of every token, too big to cache
+                llm = get_speculative_llm(model, speculative)
+                kv_session = nullcontext()
+            elif request_n_ctx is not None:
+                # Context sized for this request (see context_policy), with its own system prompt snapshots
+                # (built at warm-up, so a bucket switch only reads them from disk)
+                llm = model_pool.get(model, n_ctx = request_n_ctx, variant = DYNAMIC_CTX_VARIANT)
+                ensure_system_snapshots(llm, model)
+            else:
+                # Get the model from the pool (loaded only once per (model, n_ctx, n_threads))
+                llm = model_pool.get(model)
+
+            if not use_speculative:
+                # KV-state cache of the model: the longest cached prefix of the session (or system prompt snapshot) is reused
+                kv_cache = get_session_cache(llm, namespace = f"{model}_{llm.n_ctx()}")
+                kv_session = kv_cache.session(session_id)
+
+            # Grammars (function calling or the given GBNF) come from the process-wide grammar cache
+            provider = CachedGrammarProvider(llm, grammar = grammar)
+
+            # Create the agent
+            if use_func_call: # Model used for function calling
+                # Create a LlamaCppAgent instance as before, including a system message with information about the tools available for the LLM agent.
+                agent = LlamaCppAgent(
+                    provider,
+                    debug_output = debug_output if debug_output != None else True,
+                    system_prompt = agent_system_prompt,
+                    predefined_messages_formatter_type = MessagesFormatterType.CHATML,
+                )
+            elif "Llama-3.2" in model:
+                # Get Llama agent
+                agent = LlamaCppAgent(
+                    provider,
+                    system_prompt = system_message,
+                    custom_messages_formatter = llama_3_formatter,
+                    debug_output = debug_output if debug_output != None else False,
+                )
+            else:
+                raise Exception("There is something wrong in the model choice.")
+
+            # Set the settings like temperature, top-k, top-p, max tokens, etc.
+            settings = provider.get_provider_default_settings()
+            settings.temperature = temperature
+            settings.top_k = top_k
+            settings.top_p = top_p
+            settings.max_tokens = max_tokens
+            settings.repeat_penalty = repeat_penalty
+            settings.stream = stream # If does not have this weird and unnecessary looking line, the whole thing breaks
+
+            return agent, settings, kv_session
 
         # Add the chat history
         if use_func_call:
-            results = agent.get_chat_response(message, structured_output_settings = output_settings)
+            # The tools (search, Wikipedia, Gmail) are only imported when function calling is used
+            from ..agent_tool import output_settings
+
+            # The size of the function calling prompt is not known here: largest bucket
+            if DYNAMIC_CTX:
+                request_n_ctx = model_pool.default_n_ctx(model)
+            with scheduler.slot(session_id, priority, model, cancel_event):
+                agent, settings, kv_session = _prepare()
+                with kv_session:
+                    results = agent.get_chat_response(message, structured_output_settings = output_settings)
             return results
         else:
-            messages = BasicChatHistory()
+            # Bound the prompt size: recent turns within the token budget + summary of the older ones
+            summary = ""
+            if use_history_window and history:
+                summary, history = history_manager.window(history, session_id, model)
+
+            # Prompt size, for the context of the instance
+            if DYNAMIC_CTX or use_speculative:
+                n_prompt = history_manager.count_prompt(model, system_message, summary, history, message)
+
+            # The speculative instances have a smaller context (LLM_SPECULATIVE_N_CTX): normal decoding if it does not fit
+            if use_speculative and not fits_speculative(n_prompt + max_tokens):
+                use_speculative = False
+
+            # Dynamic context: the smallest context bucket that holds the prompt + max_tokens, never smaller than
+            # the previous bucket of the session (its KV states are in that instance); the default instance is not used
+            if DYNAMIC_CTX and not use_speculative:
+                request_n_ctx = session_bucket(model, session_id, n_prompt + max_tokens, max_ctx = model_pool.default_n_ctx(model))
+
+            # k is large enough to keep every message (the window above already limits the history)
+            messages = BasicChatHistory(k = 2 * len(history) + 4)
+            if summary:
+                # The first system message is replaced by the agent's system prompt, so the summary comes second
+                # and the system prompt snapshot stays a prefix of the prompt
+                messages.add_message({"role": Roles.system, "content": system_message})
+                messages.add_message({"role": Roles.system, "content": summary_message_format.format(summary = summary)})
             for msn in history:
                 user = {"role": Roles.user, "content": msn[0]}
                 assistant = {"role": Roles.assistant, "content": msn[1]}
@@ -128,30 +194,68 @@ def respond(
             current_message = {"role": Roles.user, "content": message}
             messages.add_message(current_message)
 
+            # The message is already in the history (message = None avoids adding it twice),
+            # so the saved state of this turn is the exact prefix of the next turn's prompt
             if not stream:
                 # Non-streaming path: get a single dict back, extract text
-                text = agent.get_chat_response(
-                    message,
-                    role="assistant",
-                    llm_sampling_settings=settings,
-                    chat_history=messages,
-                    returns_streaming_generator=False,
-                    add_response_to_chat_history=True,
-                )
+                with scheduler.slot(session_id, priority, model, cancel_event):
+                    agent, settings, kv_session = _prepare()
+                    with kv_session:
+                        text = agent.get_chat_response(
+                            None,
+                            llm_sampling_settings=settings,
+                            chat_history=messages,
+                            returns_streaming_generator=False,
+                            add_response_to_chat_history=True,
+                        )
                 
                 return text
 
+            # Continuous batching: the answer shares decode steps with the other running streams
+            elif (use_batching if use_batching is not None else USE_CONTINUOUS_BATCHING) and "Llama-3.2" in model \
+                    and grammar is None and not use_speculative:
+                chat_messages = messages.get_chat_messages()
+                if not summary:
+                    chat_messages.insert(0, {"role": Roles.system, "content": system_message})
+                prompt, _ = llama_3_formatter.format_conversation(chat_messages, Roles.assistant)
+                def _batched():
+                    try:
+                        yield from get_batch_engine(model).submit(
+                            prompt,
+                            max_tokens = max_tokens,
+                            temperature = temperature,
+                            top_k = top_k,
+                            top_p = top_p,
+                            repeat_penalty = repeat_penalty,
+                            stop = llama_3_formatter.default_stop_sequences,
+                            priority = priority,
+                            cancel_event = cancel_event,
+                        )
+                    except (QueueFullError, RequestCancelled, ValueError) as e:
+                        yield f"An error happens in Chatbot: {str(e)}"
+
+                return _batched()
+
             # Streaming helper generator:
             else:
                 def _streaming():
-                    for chunk in agent.get_chat_response(
-                        message,
-                        role="assistant",
-                        llm_sampling_settings=settings,
-                        chat_history=messages,
-                        returns_streaming_generator=True,
-                    ):
-                        yield chunk # function stream_results() receive: out_stream["choices"][0]["text"] {"choices": [{"text": chunk}]}
+                    # The completion runs while the generator is consumed, so the slot and session are taken here.
+                    # Closing the generator (client gone) releases the slot.
+                    try:
+                        with scheduler.slot(session_id, priority, model, cancel_event):
+                            agent, settings, kv_session = _prepare()
+                            with kv_session:
+                                for chunk in agent.get_chat_response(
+                                    None,
+                                    llm_sampling_settings=settings,
+                                    chat_history=messages,
+                                    returns_streaming_generator=True,
+                                ):
+                                    if cancel_event is not None and cancel_event.is_set():
+                                        break
+                                    yield chunk # function stream_results() receive: out_stream["choices"][0]["text"] {"choices": [{"text": chunk}]}
+                    except (QueueFullError, RequestCancelled, TimeoutError) as e:
+                        yield f"An error happens in Chatbot: {str(e)}"
 
                 return _streaming()
 
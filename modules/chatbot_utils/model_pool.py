@@ -0,0 +1,295 @@
+# Importing required libraries
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional, Tuple
+from llama_cpp import Llama
+
+from .runtime_profiles import load_profile
+from .context_policy import kv_cache_kwargs, kv_cache_bytes, kv_cache_report, CTX_INSTANCES
+from .kv_cache import SessionKVCache
+
+# Default folder of the GGUF models (same as install_utils)
+MODEL_DIR = "./llm_models"
+
+# Main chat model - should never be evicted by device commands or RAG traffic
+DEFAULT_CHAT_MODEL = "Llama-3.2-3B-Instruct-Q8_0.gguf"
+
+# Memory budget of the pool (in GB), can be changed in .env
+POOL_MEMORY_BUDGET_GB = float(os.getenv("LLM_POOL_MEMORY_GB", "12"))
+
+# Lock the memory-mapped weights in RAM so they are never paged out (needs a high enough RLIMIT_MEMLOCK,
+# llama.cpp only warns otherwise), can be changed in .env
+USE_MLOCK = os.getenv("LLM_USE_MLOCK", "false").lower() == "true"
+
+# Default runtime parameters of the Llama instances (used when the model has no autotuned profile, see autotune)
+DEFAULT_N_CTX = 8192
+DEFAULT_N_THREADS = min(8, os.cpu_count() or 8)
+DEFAULT_LLAMA_KWARGS = {
+    "flash_attn": False,
+    "n_gpu_layers": 0,
+    "n_batch": 64,
+    "use_mmap": True,
+    "use_mlock": USE_MLOCK,
+    "verbose": False, # Disabling debug output
+}
+
+# Key of a pool entry: (model file, n_ctx, n_threads, variant)
+# The variant separates instances of the same model built with other Llama arguments (e.g. speculative decoding)
+ModelKey = Tuple[str, int, int, str]
+
+# Variant of the per-request context size instances (see context_policy): never pinned, CTX_INSTANCES per model
+DYNAMIC_CTX_VARIANT = "dynamic-ctx"
+
+class PoolEntry:
+    """
+    A loaded Llama instance with its bookkeeping information.
+    """
+    def __init__(self, key: ModelKey, llm: Llama, weights_bytes: int, context_bytes: int,
+                 load_time: float, pinned: bool = False):
+        self.key = key
+        self.llm = llm
+        self.weights_bytes = weights_bytes # GGUF file (memory-mapped, shared by the instances of a model)
+        self.context_bytes = context_bytes # KV cache + logits of this instance
+        self.load_time = load_time
+        self.pinned = pinned
+        self.last_used = time.time()
+        self.hits = 0
+
+    @property
+    def memory_bytes(self) -> int:
+        return self.weights_bytes + self.context_bytes
+
+class ModelPool:
+    """
+    A pool of Llama instances keyed by (model file, n_ctx, n_threads).\n
+    Models are kept in LRU order and evicted (except the pinned ones) when the memory budget is exceeded.
+    So alternating between the chat model and the Bluetooth model does not reload any GGUF from disk.
+    A model is loaded outside the pool lock (other models stay available meanwhile), and only once: concurrent
+    callers of the same key wait for that load.
+    """
+    def __init__(self, memory_budget_bytes: int, model_dir: str = MODEL_DIR, pinned_models: list[str] = None):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.model_dir = model_dir
+        self.pinned_models: set[str] = set(pinned_models or [])
+        self._entries: OrderedDict[ModelKey, PoolEntry] = OrderedDict()
+        self._tokenizers: dict[str, Llama] = {}
+        self._loading: dict[ModelKey, Future] = {} # keys being loaded
+        self._lock = threading.RLock()
+
+        # Cores this process may use, e.g. the slice of a worker process (see worker_pool): caps the thread counts
+        self.max_threads: Optional[int] = None
+
+        # Tells whether an entry is used by a running request (it is never evicted then)
+        self.busy_check: Callable[[ModelKey], bool] = lambda key: False
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_load_time = 0.0
+
+    def model_path(self, model: str) -> str:
+        return os.path.abspath(os.path.join(self.model_dir, model))
+
+    def pin(self, model: str) -> None:
+        """
+        Pin a model file so every instance of it stays in the pool.
+        """
+        with self._lock:
+            self.pinned_models.add(model)
+            for key, entry in self._entries.items():
+                if key[0] == model and key[3] != DYNAMIC_CTX_VARIANT:
+                    entry.pinned = True
+
+    def unpin(self, model: str) -> None:
+        with self._lock:
+            self.pinned_models.discard(model)
+            for key, entry in self._entries.items():
+                if key[0] == model:
+                    entry.pinned = False
+
+    @property
+    def memory_used(self) -> int:
+        # The weights are memory-mapped, so they count once per model file
+        weights = {entry.key[0]: entry.weights_bytes for entry in self._entries.values()}
+        return sum(weights.values()) + sum(entry.context_bytes for entry in self._entries.values())
+
+    def default_n_ctx(self, model: str) -> int:
+        """
+        Context size of the default instance of a model (autotuned profile or DEFAULT_N_CTX).
+        """
+        return (load_profile(model) or {}).get("n_ctx", DEFAULT_N_CTX)
+
+    def tokenizer(self, model: str) -> Llama:
+        """
+        A vocabulary-only instance of a model, to count tokens without loading the weights or a context.
+        """
+        with self._lock:
+            llm = self._tokenizers.get(model)
+        if llm is None:
+            # Loaded outside the lock (fast, a concurrent duplicate is dropped)
+            llm = Llama(model_path = self.model_path(model), vocab_only = True, verbose = False)
+            with self._lock:
+                llm = self._tokenizers.setdefault(model, llm)
+        return llm
+
+    def get(self, model: str, n_ctx: int = None, n_threads: int = None,
+            variant: str = "", **llama_kwargs) -> Llama:
+        """
+        Get a Llama instance from the pool, loading it (and evicting old ones) if needed.
+
+        Args:
+            - model (str) : The GGUF file name in the model folder.
+            - n_ctx (int) : The context size of the instance (autotuned profile or DEFAULT_N_CTX if not given).
+            - n_threads (int) : The number of threads (autotuned profile or DEFAULT_N_THREADS if not given).
+            - variant (str) : Name of the instance when llama_kwargs differ from the default instance.
+            - llama_kwargs : Other keyword arguments for Llama (not part of the key).
+                             Defaults: the autotuned profile of the model on this host, the KV cache type
+                             (LLM_KV_TYPE), then DEFAULT_LLAMA_KWARGS.
+
+        Returns:
+            Llama: The loaded instance.
+        """
+        # Runtime parameters: explicit arguments > autotuned profile > defaults
+        profile = load_profile(model) or {}
+        profile_n_ctx = profile.pop("n_ctx", DEFAULT_N_CTX)
+        profile_n_threads = profile.pop("n_threads", DEFAULT_N_THREADS)
+        n_ctx = n_ctx or profile_n_ctx
+        n_threads = n_threads or profile_n_threads
+        if self.max_threads:
+            n_threads = min(n_threads, self.max_threads)
+            profile["n_threads_batch"] = min(profile.get("n_threads_batch", n_threads), self.max_threads)
+
+        key = (model, n_ctx, n_threads, variant)
+        with self._lock:
+            # Cache hit: move to the end (most recently used)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.last_used = time.time()
+                entry.hits += 1
+                self.hits += 1
+                return entry.llm
+
+            # Being loaded by another caller: wait for that load (outside the lock)
+            loading = self._loading.get(key)
+            owner = loading is None
+            if not owner:
+                self.hits += 1
+            else:
+                # Cache miss: this caller loads the model
+                model_path = self.model_path(model)
+                weights_bytes = os.path.getsize(model_path)
+                loading = self._loading[key] = Future()
+                self.misses += 1
+
+                # At most CTX_INSTANCES per-request context instances per model: the least recently used bucket
+                # is dropped (the caller holds the model slot, so it is idle)
+                if variant == DYNAMIC_CTX_VARIANT:
+                    others = [k for k in self._entries if k[0] == model and k[3] == DYNAMIC_CTX_VARIANT]
+                    for other in others[:max(0, len(others) - CTX_INSTANCES + 1)]:
+                        self.remove(other)
+
+                # Make room for the model (its weights are shared if another instance is loaded)
+                self._evict(0 if any(k[0] == model for k in self._entries) else weights_bytes)
+        if not owner:
+            return loading.result()
+
+        # Load it without the lock: the hits of the other models do not wait for the load
+        try:
+            llama_kwargs = {"n_threads_batch": n_threads, **DEFAULT_LLAMA_KWARGS, **profile, **kv_cache_kwargs(), **llama_kwargs}
+            start = time.perf_counter()
+            llm = Llama(
+                model_path = model_path,
+                n_ctx = n_ctx,
+                n_threads = n_threads,
+                **llama_kwargs
+            )
+            load_time = time.perf_counter() - start
+        except Exception as e:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set_exception(e)
+            raise
+
+        with self._lock:
+            self.total_load_time += load_time
+
+            # Real memory = weights + KV cache + Python-side logits (large with logits_all)
+            context_bytes = kv_cache_bytes(llm) + llm.scores.nbytes
+            self._evict(context_bytes)
+            self._entries[key] = PoolEntry(
+                key, llm, weights_bytes, context_bytes, load_time,
+                pinned = model in self.pinned_models and variant != DYNAMIC_CTX_VARIANT
+            )
+            self._loading.pop(key, None)
+        loading.set_result(llm)
+        print(f">>> Model pool: loaded {model} (n_ctx={n_ctx}, n_threads={n_threads}{', ' + variant if variant else ''}) in {load_time:.2f}s")
+        return llm
+
+    def _evict(self, needed_bytes: int) -> None:
+        """
+        Evict least recently used (unpinned) models until needed_bytes fits into the budget.
+        """
+        for key in list(self._entries.keys()):
+            if self.memory_used + needed_bytes <= self.memory_budget_bytes:
+                break
+            entry = self._entries[key]
+            if entry.pinned or self.busy_check(key):
+                continue
+            self.remove(key)
+            self.evictions += 1
+            print(f">>> Model pool: evicted {key[0]} (n_ctx={key[1]}, n_threads={key[2]})")
+
+    def remove(self, key: ModelKey) -> None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # The spilled KV states of the instance go with it
+                if isinstance(entry.llm.cache, SessionKVCache):
+                    entry.llm.cache.close()
+                entry.llm.close()
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._entries.keys()):
+                self.remove(key)
+
+    def stats(self) -> dict:
+        """
+        Hit/miss/load-time stats of the pool and its entries.
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "total_load_time": self.total_load_time,
+                "memory_used": self.memory_used,
+                "memory_budget": self.memory_budget_bytes,
+                "models": [
+                    {
+                        "model": entry.key[0],
+                        "n_ctx": entry.key[1],
+                        "n_threads": entry.key[2],
+                        "variant": entry.key[3],
+                        "memory_bytes": entry.memory_bytes,
+                        **kv_cache_report(entry.llm),
+                        "load_time": entry.load_time,
+                        "hits": entry.hits,
+                        "pinned": entry.pinned,
+                    }
+                    for entry in self._entries.values()
+                ],
+            }
+
+# Global pool used by respond()
+model_pool = ModelPool(
+    memory_budget_bytes = int(POOL_MEMORY_BUDGET_GB * (1 << 30)),
+    pinned_models = [DEFAULT_CHAT_MODEL]
+)
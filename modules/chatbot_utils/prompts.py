@@ -50,4 +50,21 @@ You SHOULD NOT include any other text and code in the response.
   {"signal": "on", "color": "all"}
 ]
 ```
-"""
\ No newline at end of file
+"""
+# Prompt for summarizing old turns of a long conversation
+summary_prompt = """You summarize conversations between a user and an assistant called Jarvis.
+Write a short summary (a few sentences) of the facts, names, preferences and open questions that the assistant should remember.
+Do not add anything that is not in the conversation.
+"""
+
+summary_input_format =\
+"""# Previous summary:
+{summary}
+
+---
+
+# New part of the conversation:
+{conversation}
+"""
+
+summary_message_format = "Summary of the earlier part of this conversation:\n{summary}"
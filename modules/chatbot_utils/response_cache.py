@@ -0,0 +1,259 @@
+# Importing required libraries
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Callable, Generator, Optional, Union
+import numpy as np
+
+# Response cache settings, can be changed in .env
+# Off by default: the answers are sampled (temperature 0.7), a cached one is replayed as is until it expires
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "./cache/responses.sqlite3")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_SEMANTIC = os.getenv("RESPONSE_CACHE_SEMANTIC", "false").lower() == "true"
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95"))
+
+# Answers starting with these are errors, they are never cached
+ERROR_PREFIXES = ("An error happens in Chatbot", "There was some error")
+
+def normalize_message(message: str) -> str:
+    """
+    Lowercase, collapse whitespace and drop trailing punctuation, so trivial variants share a key.
+    """
+    message = re.sub(r"\s+", " ", message.lower()).strip()
+    return message.rstrip(" ?!.")
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    Cache of final answers in front of respond(), backed by SQLite.\n
+    + Exact tier: key = hash(mode, system prompt, normalized message, retrieved context)
+    + Semantic tier (optional): among the answers with the same mode, system prompt and context, the one whose
+      message embedding (bge-small-en-v1.5) has a cosine similarity above the threshold
+    + TTL: entries older than ttl seconds are ignored and deleted; LRU: at most max_entries rows are kept
+    Cached answers are replayed through a generator when a stream is asked.
+    """
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, ttl: float = RESPONSE_CACHE_TTL,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, semantic: bool = RESPONSE_CACHE_SEMANTIC,
+                 similarity: float = RESPONSE_CACHE_SIMILARITY, enabled: bool = RESPONSE_CACHE_ENABLED):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.semantic = semantic
+        self.similarity = similarity
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+        # Embeddings of the semantic tier: key -> (group, unit vector)
+        self._vectors: dict[str, tuple[str, np.ndarray]] = {}
+
+        # Stats
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    ### Storage
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open the database on first use (must hold the lock).
+        """
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok = True)
+            self._conn = sqlite3.connect(self.path, check_same_thread = False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    grp TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    embedding BLOB,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self._conn.commit()
+            self._expire()
+            if self.semantic:
+                for key, group, blob in self._conn.execute(
+                    "SELECT key, grp, embedding FROM responses WHERE embedding IS NOT NULL"
+                ):
+                    self._vectors[key] = (group, np.frombuffer(blob, dtype = np.float32))
+        return self._conn
+
+    def _expire(self) -> None:
+        """
+        Delete expired rows, then the least recently used ones above max_entries (must hold the lock).
+        """
+        conn = self._conn
+        expired = [row[0] for row in conn.execute(
+            "SELECT key FROM responses WHERE created_at < ?", (time.time() - self.ttl,)
+        )]
+        overflow = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - len(expired) - self.max_entries
+        if overflow > 0:
+            expired += [row[0] for row in conn.execute(
+                "SELECT key FROM responses WHERE created_at >= ? ORDER BY last_used LIMIT ?",
+                (time.time() - self.ttl, overflow)
+            )]
+        if expired:
+            conn.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in expired])
+            conn.commit()
+            for key in expired:
+                self._vectors.pop(key, None)
+
+    ### Keys and embeddings
+    @staticmethod
+    def group_of(mode: str, system_prompt: str, context: str) -> str:
+        return _hash(f"{mode}\0{system_prompt}\0{_hash(context or '')}")
+
+    def _embed(self, normalized: str) -> Optional[np.ndarray]:
+        if not self.semantic:
+            return None
+        # Imported here: the embedding model is only loaded when the semantic tier is on
+        from ..agent_tool.tool_rag import embedding_service
+        vector = embedding_service.embed(normalized)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    ### Lookup and store
+    def get(self, group: str, normalized: str, embedding: np.ndarray = None) -> Optional[str]:
+        key = _hash(f"{group}\0{normalized}")
+        with self._lock:
+            conn = self._connect()
+            min_created = time.time() - self.ttl
+
+            # Exact tier
+            row = conn.execute(
+                "SELECT answer FROM responses WHERE key = ? AND created_at >= ?", (key, min_created)
+            ).fetchone()
+
+            # Semantic tier: the most similar message of the same group
+            if row is None and embedding is not None:
+                candidates = [(k, v) for k, (g, v) in self._vectors.items() if g == group]
+                if candidates:
+                    scores = np.stack([v for _, v in candidates]) @ embedding
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.similarity:
+                        key = candidates[best][0]
+                        row = conn.execute(
+                            "SELECT answer FROM responses WHERE key = ? AND created_at >= ?", (key, min_created)
+                        ).fetchone()
+                        if row is not None:
+                            self.semantic_hits += 1
+            elif row is not None:
+                self.exact_hits += 1
+
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+            conn.commit()
+            return row[0]
+
+    def put(self, group: str, normalized: str, answer: str, embedding: np.ndarray = None) -> None:
+        if not answer or answer.startswith(ERROR_PREFIXES):
+            return
+        key = _hash(f"{group}\0{normalized}")
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, grp, message, answer, embedding, created_at, last_used, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                (key, group, normalized, answer, embedding.tobytes() if embedding is not None else None, now, now)
+            )
+            conn.commit()
+            if embedding is not None:
+                self._vectors[key] = (group, embedding)
+            self.stores += 1
+            self._expire()
+
+    @staticmethod
+    def replay(answer: str) -> Generator[str, None, None]:
+        """
+        Stream a cached answer word by word, like a generation.
+        """
+        for chunk in re.findall(r"\S+\s*|\s+", answer):
+            yield chunk
+
+    def _record(self, stream: Generator[str, None, None], group: str, normalized: str,
+                embedding: np.ndarray, cancel_event: threading.Event = None) -> Generator[str, None, None]:
+        # Only complete answers are stored (not when the consumer stopped early or the request was cancelled)
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        if cancel_event is None or not cancel_event.is_set():
+            self.put(group, normalized, "".join(chunks), embedding)
+
+    def answer(self, mode: str, system_prompt: str, message: str, generate: Callable[[], Union[str, Generator]],
+               context: str = "", stream: bool = False, cacheable: bool = True,
+               cancel_event: threading.Event = None) -> Union[str, Generator]:
+        """
+        Get the answer from the cache, or generate (and store) it.
+
+        Args:
+            - mode (str) : The chat mode (vanilla, rag, function_calling, ...).
+            - system_prompt (str) : The system prompt of the answer.
+            - message (str) : The user message.
+            - generate (Callable) : Produces the answer on a miss (a string, or a generator when streaming).
+            - context (str) : The retrieved context / tool results the answer is based on.
+            - stream (bool) : Return a generator (a cached answer is replayed).
+            - cacheable (bool) : False to bypass the cache (e.g. the answer depends on the chat history).
+            - cancel_event (threading.Event) : A cancelled (partial) answer is not stored.
+
+        Returns:
+            str | Generator: The answer.
+        """
+        if not self.enabled or not cacheable:
+            return generate()
+
+        try:
+            group = self.group_of(mode, system_prompt, context)
+            normalized = normalize_message(message)
+            embedding = self._embed(normalized)
+            cached = self.get(group, normalized, embedding)
+        except Exception as e:
+            print(f">>> Response cache unavailable: {e}")
+            return generate()
+
+        if cached is not None:
+            return self.replay(cached) if stream else cached
+
+        answer = generate()
+        if isinstance(answer, str):
+            self.put(group, normalized, answer, embedding)
+            return answer
+        return self._record(answer, group, normalized, embedding, cancel_event)
+
+    def clear(self) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+            self._vectors.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "semantic": self.semantic,
+                "entries": self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0] if self.enabled else 0,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+                "stores": self.stores,
+            }
+
+# Global response cache used by the chat modes
+response_cache = ResponseCache()
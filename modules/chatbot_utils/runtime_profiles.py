@@ -0,0 +1,60 @@
+# Importing required libraries
+import os
+import json
+import socket
+import threading
+from typing import Optional
+
+# Autotuned runtime profiles, can be changed in .env
+PROFILE_PATH = os.getenv("LLM_PROFILE_PATH", "./cache/runtime_profiles.json")
+
+# Parameters stored in a profile
+PROFILE_FIELDS = ("n_ctx", "n_threads", "n_threads_batch", "n_batch", "flash_attn")
+
+_lock = threading.Lock()
+
+# Profiles read from disk, reloaded when the file changes: (path, mtime, profiles)
+_cached: tuple[str, float, dict] = ("", 0.0, {})
+
+def host_id() -> str:
+    """
+    Identify the host: the same model file is tuned separately on each machine.
+    """
+    return f"{socket.gethostname()}:{os.cpu_count()}cpu"
+
+def _read(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding = "utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f">>> Cannot read runtime profiles from {path}: {e}")
+        return {}
+
+def load_profile(model: str, path: str = PROFILE_PATH) -> Optional[dict]:
+    """
+    Get the autotuned runtime parameters of a model on this host (None if it was never tuned).
+    """
+    global _cached
+    with _lock:
+        mtime = os.path.getmtime(path) if os.path.exists(path) else 0.0
+        if _cached[0] != path or _cached[1] != mtime:
+            _cached = (path, mtime, _read(path))
+        profile = _cached[2].get(host_id(), {}).get(model)
+    if profile is None:
+        return None
+    return {field: profile[field] for field in PROFILE_FIELDS if field in profile}
+
+def save_profile(model: str, profile: dict, path: str = PROFILE_PATH) -> None:
+    """
+    Save the runtime parameters (and benchmark results) of a model on this host.
+    """
+    with _lock:
+        profiles = _read(path)
+        profiles.setdefault(host_id(), {})[model] = profile
+        os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding = "utf-8") as f:
+            json.dump(profiles, f, indent = 2)
+        os.replace(tmp_path, path)
@@ -0,0 +1,187 @@
+# Importing required libraries
+import os
+import time
+import threading
+from enum import IntEnum
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from typing import Hashable, Optional
+
+# Scheduler settings, can be changed in .env
+MAX_QUEUE_SIZE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "1"))
+QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "300"))
+
+class Priority(IntEnum):
+    """
+    Priority classes (lower value runs first).
+    """
+    COMMAND = 0 # short Bluetooth commands
+    CHAT = 1    # vanilla and function calling answers
+    RAG = 2     # long RAG answers
+
+class QueueFullError(Exception):
+    pass
+
+class RequestCancelled(Exception):
+    pass
+
+class Ticket:
+    """
+    A request waiting for (or holding) a model slot.
+    """
+    def __init__(self, session_id: str, priority: Priority, resource: Hashable, cancel_event: threading.Event = None):
+        self.session_id = session_id
+        self.priority = priority
+        self.resource = resource
+        self.cancel_event = cancel_event or threading.Event()
+        self.admitted = threading.Event()
+        self.enqueued_at = time.perf_counter()
+        self.started_at: Optional[float] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+class RequestScheduler:
+    """
+    Scheduler in front of model access.\n
+    + Bounded queue: new requests are rejected when MAX_QUEUE_SIZE requests are waiting
+    + Priority classes: COMMAND before CHAT before RAG
+    + Fairness: inside a class, sessions take turns (round robin), so one busy session cannot starve the others
+    + One request per resource (a Llama instance is not thread-safe) and at most max_concurrent in total
+    + Cancellation: a request whose cancel_event is set leaves the queue (or stops streaming)
+    """
+    def __init__(self, max_queue_size: int = MAX_QUEUE_SIZE, max_concurrent: int = MAX_CONCURRENT):
+        self.max_queue_size = max_queue_size
+        self.max_concurrent = max_concurrent
+        self._queues: dict[Priority, OrderedDict[str, deque[Ticket]]] = {p: OrderedDict() for p in Priority}
+        self._running: list[Ticket] = []
+        self._lock = threading.Condition()
+
+        # Metrics
+        self.admitted = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.completed = 0
+        self._wait_times: deque[float] = deque(maxlen = 1000)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(tickets) for queue in self._queues.values() for tickets in queue.values())
+
+    def _enqueue(self, ticket: Ticket) -> None:
+        with self._lock:
+            if self.queue_depth >= self.max_queue_size:
+                self.rejected += 1
+                raise QueueFullError(f"Too many requests are waiting ({self.max_queue_size}), please try again later.")
+            self._queues[ticket.priority].setdefault(ticket.session_id, deque()).append(ticket)
+            self._dispatch()
+
+    def _remove(self, ticket: Ticket) -> None:
+        queue = self._queues[ticket.priority]
+        tickets = queue.get(ticket.session_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del queue[ticket.session_id]
+
+    def _dispatch(self) -> None:
+        """
+        Admit waiting tickets while there are free slots (must hold the lock).
+        """
+        while len(self._running) < self.max_concurrent:
+            busy = {t.resource for t in self._running}
+            ticket = self._next_ticket(busy)
+            if ticket is None:
+                return
+            self._remove(ticket)
+            ticket.started_at = time.perf_counter()
+            self._running.append(ticket)
+            self._wait_times.append(ticket.started_at - ticket.enqueued_at)
+            self.admitted += 1
+            ticket.admitted.set()
+
+    def _next_ticket(self, busy: set) -> Optional[Ticket]:
+        for priority in Priority:
+            queue = self._queues[priority]
+            for session_id in list(queue.keys()):
+                tickets = queue[session_id]
+                if tickets[0].resource in busy:
+                    continue
+                # Round robin: the session goes to the back of its class
+                queue.move_to_end(session_id)
+                return tickets[0]
+        return None
+
+    def _release(self, ticket: Ticket) -> None:
+        with self._lock:
+            if ticket in self._running:
+                self._running.remove(ticket)
+                self.completed += 1
+            else:
+                self._remove(ticket)
+            self._dispatch()
+            self._lock.notify_all()
+
+    def acquire(self, session_id: str, priority: Priority, resource: Hashable = None,
+                cancel_event: threading.Event = None, timeout: float = QUEUE_TIMEOUT) -> Ticket:
+        """
+        Wait for a slot. Raises QueueFullError, RequestCancelled or TimeoutError.
+        """
+        ticket = Ticket(session_id or "default", priority, resource, cancel_event)
+        self._enqueue(ticket)
+
+        deadline = time.perf_counter() + timeout
+        while not ticket.admitted.wait(timeout = 0.1):
+            if ticket.cancelled or time.perf_counter() > deadline:
+                with self._lock:
+                    if ticket.admitted.is_set(): # admitted in the meantime
+                        break
+                    self._remove(ticket)
+                    self._dispatch()
+                if ticket.cancelled:
+                    self.cancelled += 1
+                    raise RequestCancelled("The request was cancelled while waiting in the queue.")
+                raise TimeoutError(f"The request waited more than {timeout}s in the queue.")
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        self._release(ticket)
+
+    def is_busy(self, resource: Hashable) -> bool:
+        with self._lock:
+            return any(t.resource == resource for t in self._running)
+
+    @contextmanager
+    def slot(self, session_id: str, priority: Priority, resource: Hashable = None,
+             cancel_event: threading.Event = None):
+        """
+        Hold a model slot inside the with-block.
+        """
+        ticket = self.acquire(session_id, priority, resource, cancel_event)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            waits = sorted(self._wait_times)
+            return {
+                "queue_depth": self.queue_depth,
+                "queue_depth_by_priority": {
+                    p.name: sum(len(t) for t in self._queues[p].values()) for p in Priority
+                },
+                "running": len(self._running),
+                "admitted": self.admitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "cancelled": self.cancelled,
+                "wait_time_avg": sum(waits) / len(waits) if waits else 0.0,
+                "wait_time_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                "wait_time_max": waits[-1] if waits else 0.0,
+            }
+
+# Global scheduler used by respond()
+scheduler = RequestScheduler()
@@ -0,0 +1,170 @@
+# Importing required libraries
+import os
+import threading
+from typing import Any
+import numpy as np
+import numpy.typing as npt
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+from .model_pool import model_pool
+from .context_policy import CTX_HEADROOM
+
+# Speculative decoding settings, can be changed in .env
+# Methods: "none", "prompt_lookup" (n-grams copied from the prompt) or "draft" (small GGUF model)
+SPECULATIVE_METHODS = ("none", "prompt_lookup", "draft")
+SPECULATIVE_DEFAULTS = {
+    "vanilla": os.getenv("LLM_SPECULATIVE_VANILLA", "none"),
+    "rag": os.getenv("LLM_SPECULATIVE_RAG", "none"),
+    "function_calling": os.getenv("LLM_SPECULATIVE_FUNCTION_CALLING", "none"),
+}
+DRAFT_MODEL = os.getenv("LLM_DRAFT_MODEL", "Llama-3.2-1B-Instruct-Q8_0.gguf")
+LOOKUP_NGRAM_SIZE = int(os.getenv("LLM_SPEC_NGRAM_SIZE", "3"))
+LOOKUP_PRED_TOKENS = int(os.getenv("LLM_SPEC_LOOKUP_TOKENS", "10"))
+DRAFT_PRED_TOKENS = int(os.getenv("LLM_SPEC_DRAFT_TOKENS", "4"))
+
+# Speculative instances keep the logits of every position (logits_all), i.e. n_ctx * n_vocab floats,
+# so they use a smaller context than the default instance
+SPECULATIVE_N_CTX = int(os.getenv("LLM_SPECULATIVE_N_CTX", "4096"))
+
+class SpeculativeStats:
+    """
+    Acceptance stats of one speculative method.
+    """
+    def __init__(self):
+        self.generations = 0
+        self.proposals = 0
+        self.proposed_tokens = 0
+        self.accepted_tokens = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "generations": self.generations,
+            "proposals": self.proposals,
+            "proposed_tokens": self.proposed_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": self.accepted_tokens / self.proposed_tokens if self.proposed_tokens else 0.0,
+        }
+
+speculative_stats = {method: SpeculativeStats() for method in SPECULATIVE_METHODS if method != "none"}
+
+class _TrackedDraft:
+    """
+    Count how many drafted tokens the target model accepts.\n
+    Llama.generate calls the draft model with the verified tokens + the last sampled token.
+    Between two calls the sequence grew by (accepted draft tokens + 1), which gives the acceptance.
+    """
+    def _init_tracking(self, method: str):
+        self.stats = speculative_stats[method]
+        self._pending = None # (input length, number of drafted tokens) of the last proposal
+
+    def begin(self) -> None:
+        """
+        Call before each generation (the last proposal of the previous one is never verified).
+        """
+        self._pending = None
+        self.stats.generations += 1
+
+    def _record(self, n_input: int, proposal: npt.NDArray[np.intc]) -> None:
+        if self._pending is not None:
+            start, n_drafted = self._pending
+            self.stats.accepted_tokens += min(n_drafted, max(0, n_input - 1 - start))
+        self._pending = (n_input, len(proposal)) if len(proposal) else None
+        if len(proposal):
+            self.stats.proposals += 1
+            self.stats.proposed_tokens += len(proposal)
+
+class PromptLookupDraft(LlamaPromptLookupDecoding, _TrackedDraft):
+    """
+    Prompt lookup decoding: the continuation of the last n-gram where it appears earlier in the prompt.
+    Cheap and effective when the answer copies spans of the context (RAG, tool results).
+    """
+    def __init__(self, max_ngram_size: int = LOOKUP_NGRAM_SIZE, num_pred_tokens: int = LOOKUP_PRED_TOKENS):
+        super().__init__(max_ngram_size = max_ngram_size, num_pred_tokens = num_pred_tokens)
+        self._init_tracking("prompt_lookup")
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any) -> npt.NDArray[np.intc]:
+        proposal = super().__call__(input_ids, **kwargs)
+        self._record(len(input_ids), proposal)
+        return proposal
+
+class GGUFDraft(LlamaDraftModel, _TrackedDraft):
+    """
+    Draft model speculative decoding: a small GGUF with the same tokenizer greedily proposes the next tokens.
+    The draft keeps its KV cache between calls and only evaluates the new tokens.
+    """
+    def __init__(self, draft: Llama, num_pred_tokens: int = DRAFT_PRED_TOKENS):
+        self.draft = draft
+        self.num_pred_tokens = num_pred_tokens
+        self._lock = threading.Lock()
+        self._init_tracking("draft")
+
+    def _propose(self, tokens: list[int]) -> list[int]:
+        draft = self.draft
+
+        # Reuse the common prefix (keep at least one token to evaluate, for its logits)
+        prefix = min(Llama.longest_token_prefix(draft.input_ids[:draft.n_tokens].tolist(), tokens), len(tokens) - 1)
+        draft.n_tokens = prefix
+        draft.eval(tokens[prefix:])
+
+        proposal = []
+        while len(proposal) < self.num_pred_tokens and draft.n_tokens < draft.n_ctx():
+            logits = np.ctypeslib.as_array(draft._ctx.get_logits_ith(-1), shape = (draft.n_vocab(),))
+            token = int(np.argmax(logits))
+            if llama_cpp.llama_token_is_eog(draft._model.vocab, token):
+                break
+            proposal.append(token)
+            draft.eval([token])
+        return proposal
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any) -> npt.NDArray[np.intc]:
+        with self._lock:
+            tokens = input_ids.tolist()
+            if len(tokens) >= self.draft.n_ctx():
+                proposal = np.array([], dtype = np.intc)
+            else:
+                proposal = np.array(self._propose(tokens), dtype = np.intc)
+            self._record(len(tokens), proposal)
+            return proposal
+
+# One draft object per (model, method), shared by the pooled speculative instance
+_drafts: dict[tuple[str, str], LlamaDraftModel] = {}
+_drafts_lock = threading.Lock()
+
+def _get_draft(model: str, method: str) -> LlamaDraftModel:
+    with _drafts_lock:
+        draft = _drafts.get((model, method))
+        if draft is None:
+            if method == "prompt_lookup":
+                draft = PromptLookupDraft()
+            elif method == "draft":
+                if not os.path.exists(model_pool.model_path(DRAFT_MODEL)):
+                    raise FileNotFoundError(f"The draft model {DRAFT_MODEL} is not installed.")
+                # The draft is used inside the target's slot, it must not be evicted in the middle
+                model_pool.pin(DRAFT_MODEL)
+                draft = GGUFDraft(model_pool.get(DRAFT_MODEL, n_ctx = SPECULATIVE_N_CTX))
+            else:
+                raise ValueError(f"Unknown speculative method '{method}', use one of {SPECULATIVE_METHODS}.")
+            _drafts[(model, method)] = draft
+        return draft
+
+def get_speculative_llm(model: str, method: str) -> Llama:
+    """
+    Get the pooled instance of a model that decodes speculatively with the given method.
+    """
+    llm = model_pool.get(
+        model, n_ctx = SPECULATIVE_N_CTX, variant = f"speculative-{method}",
+        draft_model = _get_draft(model, method), logits_all = True
+    )
+    llm.draft_model.begin()
+    return llm
+
+def fits_speculative(n_tokens: int) -> bool:
+    """
+    Whether a request of n_tokens (prompt + max_tokens) fits the context of the speculative instances.
+    """
+    return int(n_tokens * CTX_HEADROOM) <= SPECULATIVE_N_CTX
+
+def speculative_metrics() -> dict:
+    return {method: stats.as_dict() for method, stats in speculative_stats.items()}
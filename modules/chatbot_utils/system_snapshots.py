@@ -0,0 +1,122 @@
+# Importing required libraries
+import os
+import glob
+import pickle
+import hashlib
+import weakref
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp_agent.chat_history.messages import Roles
+from llama_cpp_agent.messages_formatter import MessagesFormatter, llama_3_formatter
+
+from .prompts import original_prompt, agent_system_prompt, bluetooth_prompt
+from .model_pool import model_pool, DEFAULT_CHAT_MODEL
+from .kv_cache import get_session_cache
+from .scheduler import scheduler, Priority
+
+# Bluetooth model (finetuned with GRPO)
+BLUETOOTH_MODEL = "Llama-3.2-3B-Instruct-GRPO-GGUF.gguf"
+
+# Registered system prompts: name -> (prompt, models that use it)
+system_prompts: dict[str, tuple[str, list[str]]] = {}
+
+def register_system_prompt(name: str, prompt: str, models: list[str]) -> None:
+    """
+    Register a fixed system prompt so its KV state is precomputed for each model at startup.
+    """
+    system_prompts[name] = (prompt, models)
+
+register_system_prompt("original", original_prompt, [DEFAULT_CHAT_MODEL])
+register_system_prompt("agent", agent_system_prompt, [DEFAULT_CHAT_MODEL])
+register_system_prompt("bluetooth", bluetooth_prompt, [BLUETOOTH_MODEL])
+
+def system_prefix(prompt: str, formatter: MessagesFormatter = llama_3_formatter) -> str:
+    """
+    The formatted system turn, i.e. the start of every prompt built with this system message.
+    """
+    markers = formatter.prompt_markers[Roles.system]
+    content = prompt.strip() if formatter.strip_prompt else prompt
+    return formatter.pre_prompt + markers.start + content + markers.end
+
+def snapshot_hash(llm: Llama, model_path: str, prefix: str) -> str:
+    """
+    Hash of everything the snapshot depends on: prompt text, model file and context parameters.
+    The snapshot is invalid (and recomputed) as soon as one of them changes.
+    """
+    stat = os.stat(model_path)
+    key = "|".join([
+        prefix, os.path.basename(model_path), str(stat.st_size), str(stat.st_mtime_ns),
+        str(llm.n_ctx()), str(llm.n_batch), llama_cpp.__version__
+    ])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+def load_or_build_snapshot(llm: Llama, model: str, name: str, prompt: str) -> None:
+    """
+    Load the KV snapshot of a system prompt from llm_models/ (or evaluate and save it),
+    then add it to the KV-state cache of the model.
+    """
+    model_path = model_pool.model_path(model)
+    prefix = system_prefix(prompt)
+    tokens = llm.tokenize(prefix.encode("utf-8"), add_bos = True, special = True)
+    digest = snapshot_hash(llm, model_path, prefix)
+    # n_ctx in the name: the instances of other context sizes keep their own snapshots
+    snapshot_path = f"{model_path}.{name}.{llm.n_ctx()}.{digest}.kvsnap"
+
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, "rb") as f:
+            state = pickle.load(f)
+        print(f">>> Loaded system prompt snapshot '{name}' for {model}")
+    else:
+        # Remove snapshots of old prompt texts / model files (same context size only)
+        for stale_path in glob.glob(f"{glob.escape(model_path)}.{name}.{llm.n_ctx()}.*.kvsnap"):
+            os.remove(stale_path)
+
+        # Evaluate the system turn once and save the state
+        llm.reset()
+        llm.eval(tokens)
+        state = llm.save_state()
+        with open(snapshot_path, "wb") as f:
+            pickle.dump(state, f, protocol = pickle.HIGHEST_PROTOCOL)
+        print(f">>> Built system prompt snapshot '{name}' for {model} ({len(tokens)} tokens)")
+
+    kv_cache = get_session_cache(llm, namespace = f"{model}_{llm.n_ctx()}")
+    kv_cache.add_snapshot(tokens, state)
+
+# Instances whose snapshots are already in the KV-state cache (a reloaded instance starts with an empty cache)
+_prepared: weakref.WeakSet = weakref.WeakSet()
+
+def ensure_system_snapshots(llm: Llama, model: str) -> None:
+    """
+    Load (or build) the snapshots of a model instance created after startup, e.g. another context size.
+    Must be called while holding the model slot.
+    """
+    if llm in _prepared:
+        return
+    _prepared.add(llm)
+    for name, (prompt, models) in system_prompts.items():
+        if model in models:
+            try:
+                load_or_build_snapshot(llm, model, name, prompt)
+            except Exception as e:
+                print(f">>> Failed to prepare system prompt snapshot '{name}' for {model}: {e}")
+
+def prepare_system_snapshots() -> None:
+    """
+    Startup stage: evaluate (or load) every registered system prompt once per model.
+    Models that are not installed are skipped.
+    """
+    for name, (prompt, models) in system_prompts.items():
+        for model in models:
+            if not os.path.exists(model_pool.model_path(model)):
+                print(f">>> Skip system prompt snapshot '{name}': {model} is not installed")
+                continue
+            try:
+                with scheduler.slot("startup", Priority.COMMAND, model):
+                    llm = model_pool.get(model)
+                    load_or_build_snapshot(llm, model, name, prompt)
+                    _prepared.add(llm)
+            except Exception as e:
+                print(f">>> Failed to prepare system prompt snapshot '{name}' for {model}: {e}")
+
+if __name__ == "__main__":
+    prepare_system_snapshots()
@@ -0,0 +1,309 @@
+# Importing required libraries
+import os
+import time
+import queue
+import hashlib
+import itertools
+import threading
+import multiprocessing as mp
+from collections import OrderedDict
+from typing import Generator, Optional, Union
+
+# Worker pool settings, can be changed in .env
+# LLM_WORKERS=0 (default): respond() runs in this process. LLM_WORKERS=N: N worker processes, each with
+# its own model pool (the GGUF weights are memory-mapped, so the processes share them in the page cache)
+WORKER_PROCESSES = int(os.getenv("LLM_WORKERS", "0"))
+WORKER_HEARTBEAT_TIMEOUT = float(os.getenv("LLM_WORKER_HEARTBEAT_TIMEOUT", "30"))
+WORKER_HEALTH_INTERVAL = 2.0
+WORKER_RESTART_DELAY = 1.0
+MAX_SESSIONS = 4096
+
+# True in the worker processes: respond() runs locally there
+in_worker = False
+
+def core_slices(n_workers: int) -> list[list[int]]:
+    """
+    Split the cores this process may use into n_workers contiguous slices (one per worker).
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    n_workers = max(1, min(n_workers, len(cores)))
+    size, extra = divmod(len(cores), n_workers)
+    slices, start = [], 0
+    for i in range(n_workers):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+def _worker_main(index: int, cores: list[int], requests: mp.Queue, responses: mp.Queue, heartbeat) -> None:
+    """
+    Entry point of a worker process: run respond() for the requests of the dispatcher, one thread per request
+    (the scheduler and the batching engine of the process order them, as in a single process).
+    """
+    global in_worker
+    in_worker = True
+
+    # Pin the process to its slice of cores, and size the llama.cpp thread pools to it
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    from .model_pool import model_pool
+    from .llm_respond import respond
+    from ..warmup import start_warmup, WARMUP_COMPONENTS
+    model_pool.max_threads = len(cores)
+
+    # Liveness: the heartbeat keeps beating while a request runs (llama.cpp releases the GIL)
+    def beat():
+        while True:
+            heartbeat.value = time.time()
+            time.sleep(1.0)
+    threading.Thread(target = beat, name = "heartbeat", daemon = True).start()
+
+    # Load the LLMs of this worker in the background
+    start_warmup([c for c in WARMUP_COMPONENTS if c in ("chat", "bluetooth")])
+
+    cancel_events: dict[int, threading.Event] = {}
+
+    def run(request_id: int, kwargs: dict) -> None:
+        try:
+            answer = respond(**kwargs, cancel_event = cancel_events[request_id])
+            if isinstance(answer, (str, list, dict)) or answer is None:
+                responses.put((request_id, "done", answer))
+            else:
+                for chunk in answer:
+                    responses.put((request_id, "chunk", chunk))
+                responses.put((request_id, "done", None))
+        except Exception as e:
+            responses.put((request_id, "error", str(e)))
+        finally:
+            cancel_events.pop(request_id, None)
+
+    print(f">>> LLM worker {index} started (pid {os.getpid()}, cores {cores})")
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        kind, request_id, payload = message
+        if kind == "respond":
+            cancel_events[request_id] = threading.Event()
+            threading.Thread(target = run, args = (request_id, payload), name = f"request-{request_id}", daemon = True).start()
+        elif kind == "cancel" and request_id in cancel_events:
+            cancel_events[request_id].set()
+
+class Worker:
+    """
+    A worker process and its bookkeeping information (in the dispatcher).
+    """
+    def __init__(self, index: int, cores: list[int]):
+        self.index = index
+        self.cores = cores
+        self.process: Optional[mp.Process] = None
+        self.requests: Optional[mp.Queue] = None
+        self.responses: Optional[mp.Queue] = None
+        self.heartbeat = None
+        self.in_flight: set[int] = set()
+        self.restarts = 0
+        self.served = 0
+
+    @property
+    def healthy(self) -> bool:
+        return (
+            self.process is not None and self.process.is_alive()
+            and time.time() - self.heartbeat.value < WORKER_HEARTBEAT_TIMEOUT
+        )
+
+class WorkerPool:
+    """
+    Run respond() in N worker processes to scale over the cores of big hosts (one GIL and one llama.cpp
+    thread pool per process).\n
+    + Each worker is pinned to a slice of the cores and loads the models with that many threads
+    + Requests of a session always go to the same worker, so its KV-state cache stays warm
+    + A health monitor restarts crashed or hung workers; their requests end with an error
+    """
+    def __init__(self, n_workers: int = WORKER_PROCESSES):
+        self._ctx = mp.get_context("spawn") # no fork: the parent may hold threads and llama.cpp state
+        self.workers = [Worker(i, cores) for i, cores in enumerate(core_slices(n_workers))]
+        self._pending: dict[int, queue.Queue] = {}
+        self._sessions: OrderedDict[str, int] = OrderedDict()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+        for worker in self.workers:
+            self._start(worker)
+        threading.Thread(target = self._monitor, name = "worker-monitor", daemon = True).start()
+
+    def _start(self, worker: Worker) -> None:
+        # New queues on every start: a crashed worker may die holding the lock of its queues
+        worker.requests = self._ctx.Queue()
+        worker.responses = self._ctx.Queue()
+        worker.heartbeat = self._ctx.Value("d", time.time())
+        worker.process = self._ctx.Process(
+            target = _worker_main, name = f"llm-worker-{worker.index}", daemon = True,
+            args = (worker.index, worker.cores, worker.requests, worker.responses, worker.heartbeat)
+        )
+        worker.process.start()
+        threading.Thread(
+            target = self._read_responses, args = (worker, worker.responses),
+            name = f"worker-{worker.index}-responses", daemon = True
+        ).start()
+
+    ### Dispatching
+    def _pick(self, session_id: Optional[str]) -> Worker:
+        """
+        The worker of a session (session affinity), or the least loaded healthy worker for a new session.
+        """
+        with self._lock:
+            if session_id is not None and session_id in self._sessions:
+                worker = self.workers[self._sessions[session_id]]
+                if worker.healthy:
+                    self._sessions.move_to_end(session_id)
+                    return worker
+
+            healthy = [w for w in self.workers if w.healthy] or self.workers
+            if session_id is None:
+                worker = min(healthy, key = lambda w: len(w.in_flight))
+            else:
+                # Stable choice first (same worker after a restart of the dispatcher), unless it is much busier
+                digest = int(hashlib.sha1(session_id.encode("utf-8")).hexdigest(), 16)
+                worker = healthy[digest % len(healthy)]
+                least = min(healthy, key = lambda w: len(w.in_flight))
+                if len(worker.in_flight) > len(least.in_flight) + 1:
+                    worker = least
+                self._sessions[session_id] = worker.index
+                while len(self._sessions) > MAX_SESSIONS:
+                    self._sessions.popitem(last = False)
+            return worker
+
+    def respond(self, stream: bool = False, cancel_event: threading.Event = None,
+                **kwargs) -> Union[str, list, Generator[str, None, None]]:
+        """
+        Run respond() in a worker process. Same arguments and return values as respond().
+        """
+        worker = self._pick(kwargs.get("session_id"))
+        request_id = next(self._ids)
+        answers: queue.Queue = queue.Queue()
+        with self._lock:
+            self._pending[request_id] = answers
+            worker.in_flight.add(request_id)
+            worker.served += 1
+        worker.requests.put(("respond", request_id, {**kwargs, "stream": stream}))
+
+        cancel_sent = False
+        def receive() -> tuple[str, object]:
+            # Forward the cancellation of the caller to the worker (once, the worker ends the request)
+            nonlocal cancel_sent
+            while True:
+                try:
+                    return answers.get(timeout = 0.1)
+                except queue.Empty:
+                    if cancel_event is not None and cancel_event.is_set() and not cancel_sent:
+                        worker.requests.put(("cancel", request_id, None))
+                        cancel_sent = True
+
+        def finish() -> None:
+            with self._lock:
+                self._pending.pop(request_id, None)
+                worker.in_flight.discard(request_id)
+
+        if not stream:
+            try:
+                kind, value = receive()
+                return value if kind == "done" else f"An error happens in Chatbot: {value}"
+            finally:
+                finish()
+
+        def _streaming():
+            try:
+                while True:
+                    kind, value = receive()
+                    if kind == "chunk":
+                        yield value
+                    elif kind == "done":
+                        if value is not None:
+                            yield value
+                        return
+                    else:
+                        yield f"An error happens in Chatbot: {value}"
+                        return
+            except GeneratorExit:
+                # The client stopped reading: stop the generation in the worker
+                worker.requests.put(("cancel", request_id, None))
+                raise
+            finally:
+                finish()
+        return _streaming()
+
+    def _read_responses(self, worker: Worker, responses: mp.Queue) -> None:
+        # Until the worker is restarted (with new queues)
+        while worker.responses is responses:
+            try:
+                request_id, kind, value = responses.get(timeout = 1.0)
+            except queue.Empty:
+                continue
+            with self._lock:
+                answers = self._pending.get(request_id)
+            if answers is not None:
+                answers.put((kind, value))
+
+    ### Health
+    def _monitor(self) -> None:
+        while True:
+            time.sleep(WORKER_HEALTH_INTERVAL)
+            for worker in self.workers:
+                if worker.healthy:
+                    continue
+                reason = "crashed" if not worker.process.is_alive() else "stopped answering"
+                print(f">>> LLM worker {worker.index} {reason}, restarting it")
+                if worker.process.is_alive():
+                    worker.process.kill()
+                worker.process.join(timeout = 5)
+
+                # Its requests are lost: end them with an error
+                with self._lock:
+                    lost = [self._pending.get(request_id) for request_id in worker.in_flight]
+                    worker.in_flight.clear()
+                    for session_id in [s for s, i in self._sessions.items() if i == worker.index]:
+                        del self._sessions[session_id]
+                for answers in lost:
+                    if answers is not None:
+                        answers.put(("error", f"LLM worker {worker.index} {reason}"))
+
+                time.sleep(WORKER_RESTART_DELAY)
+                worker.restarts += 1
+                self._start(worker)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": [
+                    {
+                        "index": worker.index,
+                        "pid": worker.process.pid if worker.process else None,
+                        "cores": worker.cores,
+                        "healthy": worker.healthy,
+                        "in_flight": len(worker.in_flight),
+                        "served": worker.served,
+                        "restarts": worker.restarts,
+                        "sessions": sum(1 for i in self._sessions.values() if i == worker.index),
+                    }
+                    for worker in self.workers
+                ],
+            }
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.requests.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout = 5)
+
+# Global pool, started on first use (only when LLM_WORKERS > 0 and not in a worker itself)
+_worker_pool: Optional[WorkerPool] = None
+_worker_pool_lock = threading.Lock()
+
+def get_worker_pool() -> Optional[WorkerPool]:
+    global _worker_pool
+    if WORKER_PROCESSES <= 0 or in_worker:
+        return None
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = WorkerPool(WORKER_PROCESSES)
+        return _worker_pool
@@ -0,0 +1,100 @@
+# Importing required libraries (only the standard library: this module is imported before the first paint)
+import sys
+import time
+import importlib
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable
+
+# Start of the process (as seen by Python, close enough for a breakdown)
+PROCESS_START = time.perf_counter()
+
+class StartupTimer:
+    """
+    Record how long each startup phase takes (UI imports, first paint, heavy imports, model construction).
+    """
+    def __init__(self):
+        self.phases: list[tuple[str, float, float]] = [] # (name, start since process start, seconds)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.phases.append((name, start - PROCESS_START, end - start))
+
+    def mark(self, name: str) -> None:
+        """
+        Record a point in time (e.g. the first paint) as a phase of zero seconds.
+        """
+        with self._lock:
+            self.phases.append((name, time.perf_counter() - PROCESS_START, 0.0))
+
+    def report(self) -> list[dict]:
+        with self._lock:
+            return [
+                {"phase": name, "at": round(at, 3), "seconds": round(seconds, 3)}
+                for name, at, seconds in self.phases
+            ]
+
+    def format_report(self) -> str:
+        lines = [">>> Startup time breakdown (seconds since process start | duration):"]
+        for phase in self.report():
+            lines.append(f"    {phase['at']:8.3f}s | {phase['seconds']:7.3f}s  {phase['phase']}")
+        return "\n".join(lines)
+
+# Global timer of the process
+startup_timer = StartupTimer()
+
+def patch_torch_classes() -> None:
+    # Streamlit's file watcher walks torch.classes.__path__ and fails on it (must have to avoid error)
+    torch = sys.modules.get("torch")
+    if torch is not None and getattr(torch.classes, "__path__", None) != []:
+        torch.classes.__path__ = []
+
+class LazyLoader:
+    """
+    Build an object (a module, a model...) the first time it is used, and time it.\n
+    Attributes are forwarded to the object, so `chromadb = lazy_import("chromadb")` then
+    `chromadb.PersistentClient(...)` only imports chromadb on that call.
+    """
+    def __init__(self, name: str, load: Callable[[], Any]):
+        self._name = name
+        self._load = load
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self) -> Any:
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    with startup_timer.phase(self._name):
+                        self._value = self._load()
+                    patch_torch_classes() # the loaded object may have imported torch
+                    self._loaded = True
+        return self._value
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.get(), attr)
+
+    def __repr__(self) -> str:
+        return f"<LazyLoader {self._name} ({'loaded' if self._loaded else 'not loaded'})>"
+
+def lazy_import(module_name: str, name: str = None) -> LazyLoader:
+    """
+    A module imported on first attribute access.
+
+    Args:
+        - module_name (str) : The module to import (e.g. "llama_index.core").
+        - name (str) : The name of the phase in the startup report (default: "import <module_name>").
+    """
+    return LazyLoader(name or f"import {module_name}", lambda: importlib.import_module(module_name))
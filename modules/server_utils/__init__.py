@@ -0,0 +1,2 @@
+# Only the thin client is exported here (the server itself imports the models, see server.py)
+from .client import vanilla, function_call_chatbot, rag_chatbot, bluetooth_processor, server_ready
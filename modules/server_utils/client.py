@@ -0,0 +1,86 @@
+# Importing required libraries
+import os
+import json
+import urllib.request
+import urllib.error
+from typing import Generator, Union
+
+# Address of the inference server (see server.py)
+INFERENCE_SERVER_URL = os.getenv("INFERENCE_SERVER_URL", "http://127.0.0.1:8000")
+REQUEST_TIMEOUT = float(os.getenv("INFERENCE_SERVER_TIMEOUT", "600"))
+
+def _post(path: str, data: dict):
+    request = urllib.request.Request(
+        INFERENCE_SERVER_URL.rstrip("/") + path,
+        data = json.dumps(data).encode("utf-8"),
+        headers = {"Content-Type": "application/json"},
+        method = "POST",
+    )
+    return urllib.request.urlopen(request, timeout = REQUEST_TIMEOUT)
+
+def _error_message(e: urllib.error.HTTPError) -> str:
+    try:
+        return json.loads(e.read().decode("utf-8")).get("error", str(e))
+    except Exception:
+        return str(e)
+
+def _stream_events(response) -> Generator[str, None, None]:
+    """
+    Read the server-sent events of a streaming response and yield the text chunks.
+    Closing the generator closes the connection, which cancels the generation on the server.
+    """
+    try:
+        for line in response:
+            line = line.decode("utf-8").strip()
+            if not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            yield json.loads(data)["text"]
+    finally:
+        response.close()
+
+def _chat(mode: str, message: str, history: list, stream: bool, session_id: str = None, **kwargs) -> tuple[Union[str, Generator], bool]:
+    data = {"message": message, "history": history, "stream": stream, "session_id": session_id, **kwargs}
+    try:
+        response = _post(f"/v1/chat/{mode}", data)
+        if stream:
+            return _stream_events(response), True
+        with response:
+            return json.loads(response.read().decode("utf-8"))["answer"], False
+    except urllib.error.HTTPError as e:
+        return f"There was some error in the inference server: {_error_message(e)}", False
+    except Exception as e:
+        return f"Cannot reach the inference server at {INFERENCE_SERVER_URL}: {e}", False
+
+### Same interface as modules.chatbot_utils
+def vanilla(message: str, history: list[str], stream: bool = True, session_id: str = None):
+    return _chat("vanilla", message, history, stream, session_id)
+
+def function_call_chatbot(message: str, history: list[str], stream: bool = True, session_id: str = None):
+    return _chat("function_calling", message, history, stream, session_id)
+
+def rag_chatbot(message: str, history: list[str], stream: bool = True,
+                n_results: int = 4, update_database: bool = False,
+                text = None, session_id: str = None):
+    return _chat(
+        "rag", message, history, stream, session_id,
+        n_results = n_results, update_database = bool(update_database)
+    )
+
+def bluetooth_processor(message: str):
+    try:
+        with _post("/v1/bluetooth", {"message": message}) as response:
+            return json.loads(response.read().decode("utf-8"))["answer"]
+    except urllib.error.HTTPError as e:
+        return f"Failed to get the command: {_error_message(e)}", False
+    except Exception as e:
+        return f"Cannot reach the inference server at {INFERENCE_SERVER_URL}: {e}", False
+
+def server_ready() -> bool:
+    try:
+        with urllib.request.urlopen(INFERENCE_SERVER_URL.rstrip("/") + "/ready", timeout = 5) as response:
+            return json.loads(response.read().decode("utf-8")).get("ready", False)
+    except Exception:
+        return False
@@ -0,0 +1,108 @@
+# Importing required libraries
+import json
+import asyncio
+from typing import AsyncIterator, Optional
+
+# HTTP status texts used by the server
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+# Max size of a request body (10 MB)
+MAX_BODY_BYTES = 10 << 20
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class Request:
+    """
+    A parsed HTTP/1.1 request.
+    """
+    def __init__(self, method: str, path: str, headers: dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> dict:
+        if not self.body:
+            return {}
+        try:
+            return json.loads(self.body.decode("utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise HTTPError(400, f"Invalid JSON body: {e}")
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    """
+    Read one request from the connection (None when the client closed it).
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, path, _ = request_line.decode("latin-1").strip().split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+
+    # Headers
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    # Body
+    length = int(headers.get("content-length", "0") or 0)
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, "Request body is too large")
+    body = await reader.readexactly(length) if length > 0 else b""
+
+    return Request(method.upper(), path.split("?", 1)[0], headers, body)
+
+def _head(status: int, headers: dict[str, str]) -> bytes:
+    lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'OK')}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    lines.append("Connection: close") # One request per connection
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+async def send_json(writer: asyncio.StreamWriter, status: int, data: dict) -> None:
+    body = json.dumps(data, ensure_ascii = False).encode("utf-8")
+    writer.write(_head(status, {
+        "Content-Type": "application/json; charset=utf-8",
+        "Content-Length": str(len(body)),
+    }) + body)
+    await writer.drain()
+
+async def send_sse(writer: asyncio.StreamWriter, events: AsyncIterator[str]) -> None:
+    """
+    Stream server-sent events (each event is a "data: ..." line) over a chunked response.
+    Raises ConnectionError when the client disconnects, so the caller can cancel the generation.
+    """
+    writer.write(_head(200, {
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "Cache-Control": "no-cache",
+        "Transfer-Encoding": "chunked",
+    }))
+    await writer.drain()
+
+    async for event in events:
+        payload = f"data: {event}\n\n".encode("utf-8")
+        writer.write(f"{len(payload):X}\r\n".encode("latin-1") + payload + b"\r\n")
+        await writer.drain()
+        if writer.is_closing():
+            raise ConnectionError("Client disconnected")
+
+    # Last chunk
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
@@ -0,0 +1,334 @@
+# Importing required libraries
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterable, Union
+
+from ..chatbot_utils import respond, vanilla, function_call_chatbot, rag_chatbot, bluetooth_processor, model_pool, scheduler
+from ..chatbot_utils.prompts import original_prompt
+from ..chatbot_utils.model_pool import DEFAULT_CHAT_MODEL, MODEL_DIR
+from ..chatbot_utils.batch_engine import batch_engines
+from ..chatbot_utils.history_manager import history_manager
+from ..chatbot_utils.grammar_cache import grammar_cache
+from ..chatbot_utils.speculative import speculative_metrics
+from ..chatbot_utils.response_cache import response_cache
+from ..chatbot_utils.worker_pool import get_worker_pool, WORKER_PROCESSES
+from ..agent_tool.bluetooth_command_utils import command_parser
+from ..agent_tool.tool_rag import index_stats, embedding_service
+from ..agent_tool.rag_context import context_metrics
+from ..lazy_loader import startup_timer
+from ..warmup import warmup, start_warmup, models_installed, WARMUP_COMPONENTS
+from .http_utils import Request, HTTPError, read_request, send_json, send_sse
+
+# Chat modes exposed by the server (also usable as "model" in the OpenAI-compatible endpoint)
+MODES: dict[str, Callable] = {
+    "vanilla": vanilla,
+    "rag": rag_chatbot,
+    "function_calling": function_call_chatbot,
+}
+MODE_MODEL_PREFIX = "jarvis-"
+
+# Blocking model calls run on this executor (the scheduler decides which request may use a model)
+SERVER_THREADS = int(os.getenv("LLM_SERVER_THREADS", "16"))
+model_executor = ThreadPoolExecutor(max_workers = SERVER_THREADS, thread_name_prefix = "llm")
+
+# Readiness of the server (models installed + system prompt snapshots built)
+server_state = {
+    "ready": False,
+    "error": None,
+    "started_at": time.time(),
+}
+
+### HELPERS
+def split_openai_messages(messages: list[dict]) -> tuple[str, list[tuple[str, str]], str]:
+    """
+    Convert OpenAI chat messages into (system message, history pairs, last user message).
+    """
+    if not messages:
+        raise HTTPError(400, "'messages' must not be empty")
+
+    system_message = None
+    history: list[tuple[str, str]] = []
+    pending_user = None
+    for message in messages:
+        role = message.get("role")
+        content = message.get("content") or ""
+        if role == "system":
+            system_message = content
+        elif role == "user":
+            pending_user = content
+        elif role == "assistant" and pending_user is not None:
+            history.append((pending_user, content))
+            pending_user = None
+
+    if pending_user is None:
+        raise HTTPError(400, "The last message must come from the user")
+    return system_message, history, pending_user
+
+async def iterate_in_executor(iterable: Iterable[str], cancelled: threading.Event) -> AsyncIterator[str]:
+    """
+    Consume a (blocking) streaming generator on the model executor and yield its chunks to the event loop.
+    When the consumer stops early (client disconnected), cancelled is set: the request leaves the
+    scheduler queue or the generation stops at the next token.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    def produce():
+        try:
+            for chunk in iterable:
+                if cancelled.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, chunk)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    future = loop.run_in_executor(model_executor, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+        await asyncio.shield(future)
+
+async def run_model(func: Callable, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(model_executor, lambda: func(*args, **kwargs))
+
+def answer_to_text(answer: Union[str, Iterable[str]]) -> str:
+    return answer if isinstance(answer, str) else "".join(answer)
+
+### ROUTES
+async def handle_health(request: Request, writer: asyncio.StreamWriter):
+    await send_json(writer, 200, {"status": "ok", "uptime": time.time() - server_state["started_at"]})
+
+async def handle_metrics(request: Request, writer: asyncio.StreamWriter):
+    await send_json(writer, 200, {
+        "scheduler": scheduler.metrics(),
+        "model_pool": model_pool.stats(),
+        "batch_engines": {model: engine.stats() for model, engine in batch_engines.items()},
+        "history": history_manager.stats(),
+        "grammar_cache": grammar_cache.stats(),
+        "bluetooth_parser": command_parser.stats(),
+        "speculative": speculative_metrics(),
+        "response_cache": response_cache.stats(),
+        "startup": startup_timer.report(),
+        "warmup": warmup.status(),
+        "worker_pool": get_worker_pool().stats() if WORKER_PROCESSES > 0 else None,
+        "rag_index": index_stats(),
+        "rag_context": context_metrics.stats(),
+        "embedding_service": embedding_service.stats(),
+    })
+
+async def handle_ready(request: Request, writer: asyncio.StreamWriter):
+    status = 200 if server_state["ready"] else 503
+    await send_json(writer, status, {
+        "ready": server_state["ready"],
+        "error": server_state["error"],
+        "warmup": warmup.status(),
+        "model_pool": model_pool.stats(),
+    })
+
+async def handle_models(request: Request, writer: asyncio.StreamWriter):
+    models = [MODE_MODEL_PREFIX + mode for mode in MODES]
+    if os.path.isdir(MODEL_DIR):
+        models += [f for f in sorted(os.listdir(MODEL_DIR)) if f.endswith(".gguf")]
+    await send_json(writer, 200, {
+        "object": "list",
+        "data": [{"id": m, "object": "model", "owned_by": "jarvis"} for m in models],
+    })
+
+async def handle_mode(request: Request, writer: asyncio.StreamWriter, mode: str):
+    """
+    POST /v1/chat/{mode} with {"message", "history", "session_id", "stream", "n_results", "update_database"}.
+    Streams {"text": chunk} events, or returns {"answer": str}.
+    """
+    if mode not in MODES:
+        raise HTTPError(404, f"Unknown mode '{mode}'")
+    body = request.json()
+    if not body.get("message"):
+        raise HTTPError(400, "'message' is required")
+
+    kwargs = {
+        "message": body["message"],
+        "history": [tuple(pair) for pair in body.get("history", [])],
+        "stream": bool(body.get("stream", True)),
+        "session_id": body.get("session_id"),
+        "cancel_event": threading.Event(),
+    }
+    if mode == "rag":
+        kwargs["n_results"] = int(body.get("n_results", 4))
+        kwargs["update_database"] = bool(body.get("update_database", False))
+
+    answer, stream = await run_model(MODES[mode], **kwargs)
+
+    if kwargs["stream"]:
+        # Errors come back as a plain string even when streaming was asked
+        chunks = iterate_in_executor(answer if stream else [answer], kwargs["cancel_event"])
+        async def events():
+            async for chunk in chunks:
+                yield json.dumps({"text": chunk}, ensure_ascii = False)
+            yield "[DONE]"
+        await send_sse(writer, events())
+    else:
+        await send_json(writer, 200, {"answer": answer_to_text(answer)})
+
+async def handle_bluetooth(request: Request, writer: asyncio.StreamWriter):
+    body = request.json()
+    if not body.get("message"):
+        raise HTTPError(400, "'message' is required")
+    answer = await run_model(bluetooth_processor, body["message"])
+
+    # bluetooth_processor returns (error, False) on failure
+    if isinstance(answer, tuple):
+        await send_json(writer, 500, {"error": answer[0]})
+    else:
+        await send_json(writer, 200, {"answer": answer})
+
+async def handle_chat_completions(request: Request, writer: asyncio.StreamWriter):
+    """
+    OpenAI-compatible POST /v1/chat/completions.\n
+    "model" is either a chat mode (jarvis-vanilla, jarvis-rag, jarvis-function_calling) or a GGUF file name.
+    The "user" field is used as the session id of the KV-state cache.
+    """
+    body = request.json()
+    model = body.get("model") or DEFAULT_CHAT_MODEL
+    stream = bool(body.get("stream", False))
+    session_id = body.get("user")
+    system_message, history, message = split_openai_messages(body.get("messages", []))
+    cancel_event = threading.Event()
+
+    if model.startswith(MODE_MODEL_PREFIX):
+        mode = model[len(MODE_MODEL_PREFIX):]
+        if mode not in MODES:
+            raise HTTPError(404, f"Unknown model '{model}'")
+        answer, is_stream = await run_model(
+            MODES[mode], message = message, history = history, stream = stream,
+            session_id = session_id, cancel_event = cancel_event
+        )
+        if not is_stream:
+            answer = [answer] if stream else answer
+    else:
+        if not os.path.exists(model_pool.model_path(model)):
+            raise HTTPError(404, f"Model '{model}' is not installed")
+        answer = await run_model(
+            respond, message, history = history, model = model,
+            system_message = system_message or original_prompt,
+            max_tokens = int(body.get("max_tokens") or 1024),
+            temperature = float(body.get("temperature", 0.7)),
+            top_p = float(body.get("top_p", 0.95)),
+            stream = stream, session_id = session_id, cancel_event = cancel_event
+        )
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    if stream:
+        chunks = iterate_in_executor(answer, cancel_event)
+        async def events():
+            yield json.dumps({
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}],
+            })
+            async for chunk in chunks:
+                yield json.dumps({
+                    "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}],
+                }, ensure_ascii = False)
+            yield json.dumps({
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            })
+            yield "[DONE]"
+        await send_sse(writer, events())
+    else:
+        await send_json(writer, 200, {
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": answer_to_text(answer)},
+                "finish_reason": "stop",
+            }],
+        })
+
+async def route(request: Request, writer: asyncio.StreamWriter):
+    path = request.path.rstrip("/") or "/"
+    if request.method == "GET" and path in ("/health", "/healthz"):
+        return await handle_health(request, writer)
+    if request.method == "GET" and path in ("/ready", "/readyz"):
+        return await handle_ready(request, writer)
+    if request.method == "GET" and path == "/metrics":
+        return await handle_metrics(request, writer)
+    if request.method == "GET" and path == "/v1/models":
+        return await handle_models(request, writer)
+
+    # Model endpoints wait for the server to be ready
+    if path.startswith("/v1/") and not server_state["ready"]:
+        raise HTTPError(503, "The models are still loading")
+    if request.method == "POST" and path == "/v1/chat/completions":
+        return await handle_chat_completions(request, writer)
+    if request.method == "POST" and path == "/v1/bluetooth":
+        return await handle_bluetooth(request, writer)
+    if request.method == "POST" and path.startswith("/v1/chat/"):
+        return await handle_mode(request, writer, path[len("/v1/chat/"):])
+    raise HTTPError(404, f"No route for {request.method} {request.path}")
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await read_request(reader)
+        if request is not None:
+            try:
+                await route(request, writer)
+            except HTTPError as e:
+                await send_json(writer, e.status, {"error": e.message})
+    except HTTPError as e:
+        await send_json(writer, e.status, {"error": e.message})
+    except (ConnectionError, asyncio.IncompleteReadError):
+        # Client disconnected (the generation is cancelled by iterate_in_executor)
+        pass
+    except Exception as e:
+        try:
+            await send_json(writer, 500, {"error": f"Server-side error: {e}"})
+        except ConnectionError:
+            pass
+    finally:
+        writer.close()
+
+def warm_up() -> None:
+    """
+    Install the models, load them and build the system prompt snapshots (in the background threads of warmup).
+    The server is ready once the chat model is: the other models are waited for by their own requests.
+    """
+    try:
+        models_installed.get()
+        tasks = start_warmup([c for c in WARMUP_COMPONENTS if c != "whisper"])
+        if not warmup.wait(DEFAULT_CHAT_MODEL):
+            task = tasks.get(DEFAULT_CHAT_MODEL)
+            raise RuntimeError(task.error if task is not None else f"{DEFAULT_CHAT_MODEL} is not warmed up")
+        server_state["ready"] = True
+        print(startup_timer.format_report())
+    except Exception as e:
+        server_state["error"] = str(e)
+
+async def serve(host: str = "127.0.0.1", port: int = 8000) -> None:
+    server = await asyncio.start_server(handle_connection, host, port)
+    print(f">>> Inference server listening on http://{host}:{port}")
+
+    # Warm up in the background so /health answers right away
+    asyncio.get_running_loop().run_in_executor(model_executor, warm_up)
+
+    async with server:
+        await server.serve_forever()
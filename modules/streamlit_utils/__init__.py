@@ -1,2 +1,2 @@
-from .utils import display_message, init_page, render_page
+from .utils import display_message, init_page, render_page, wait_for_models
 from .param import avatars
\ No newline at end of file
@@ -1,18 +1,22 @@
 import os
+import time
 import tempfile
 import io
 import streamlit as st
-import whisper
 from .param import avatars
 from ..ux_utils import ImageResources, Locale, Translator, TextResources, LANGUAGE_MAP
+from ..lazy_loader import LazyLoader, lazy_import
+from ..warmup import warmup
+from ..agent_tool.tool_rag import ingestion_queue
+
+# Whisper (and torch) are only imported in transcript mode
+whisper = lazy_import("whisper")
+whisper_model = LazyLoader("load whisper large-v3-turbo", lambda: whisper.load_model("large-v3-turbo"))
 
 global audio_value
 global audio_index
 audio_index = 0
 
-global whisper_model
-whisper_model = None
-
 ### FUNCTIONS
 # Function for message displaying and history
 def display_message(name: str, avatar: str, content: str) -> None:
@@ -32,6 +36,27 @@ def init_page(text: TextResources):
     st.header(text.TITLE)
     st.markdown("[Link Github](https://github.com/Phuishere/Multitasking-Chatbot-Not-You)")
 
+# Show the warm-up progress of the models a request needs, until they are ready
+def wait_for_models(names: list[str], text: TextResources) -> None:
+    """
+    :names: warm-up task names (see warmup.names)
+    :text: text resources of the current language
+    """
+    pending = [name for name in names if not warmup.is_ready(name)]
+    if not pending:
+        return
+
+    bar = st.progress(0.0)
+    while pending:
+        status = warmup.status()
+        progress = sum(status[name]["progress"] for name in names) / len(names)
+        bar.progress(progress, text = text.WARMUP_PROGRESS.format(
+            name = pending[0], step = status[pending[0]]["step"], percent = int(100 * progress)
+        ))
+        time.sleep(0.25)
+        pending = [name for name in names if not warmup.is_ready(name)]
+    bar.empty()
+
 # Function runs every loop
 def render_page(text: TextResources, state: dict[str, Locale]):
     """
@@ -61,6 +86,15 @@ def render_page(text: TextResources, state: dict[str, Locale]):
             text.MODE,
             (text.VANILLA, text.RAG, text.FUNCTION_CALLING, text.TRANSCRIPT)
         )
+
+        # Readiness of the models loaded in the background
+        status = warmup.status()
+        if status:
+            st.caption(text.MODELS_STATUS)
+            icons = {"pending": "⏳", "loading": "⏳", "ready": "✅", "failed": "❌"}
+            for name, task in status.items():
+                percent = "" if task["state"] == "ready" else f" {int(100 * task['progress'])}%"
+                st.caption(f"{icons[task['state']]} {name}{percent}")
     
     init_page(text = text)
 
@@ -91,10 +125,9 @@ def render_page(text: TextResources, state: dict[str, Locale]):
     # Get audio UI and audio value
     audio_transcript = None
     if mode == text.TRANSCRIPT:
-        # Load whisper_model for the first time
-        global whisper_model
-        if not whisper_model:
-            whisper_model = whisper.load_model("large-v3-turbo")
+        # Load whisper_model for the first time (or wait for the background warm-up)
+        warmup.wait("whisper")
+        model = whisper_model.get()
 
         audio_value = st.audio_input(text.TRANSCRIPT_PROMPT.format(audio_index = audio_index), key = audio_index)
         if audio_value:
@@ -113,16 +146,16 @@ def render_page(text: TextResources, state: dict[str, Locale]):
             audio = whisper.audio.load_audio(audio_path)
             audio = whisper.pad_or_trim(audio)
             mel = whisper.log_mel_spectrogram(
-                audio, n_mels = whisper_model.dims.n_mels
-            ).to(whisper_model.device)
+                audio, n_mels = model.dims.n_mels
+            ).to(model.device)
 
             # Detect the spoken language
-            _, probs = whisper_model.detect_language(mel)
+            _, probs = model.detect_language(mel)
             print(f"Detected language: {max(probs, key=probs.get)}")
 
             # Decode the audio (transcript send to state)
             options = whisper.DecodingOptions()
-            audio_transcript = whisper.decode(whisper_model, mel, options).text
+            audio_transcript = whisper.decode(model, mel, options).text
 
             # Re-render the UI
             audio_index += 1
@@ -193,6 +226,25 @@ def render_page(text: TextResources, state: dict[str, Locale]):
                 st.success(rag_message)
             update_database = True
 
+            # Index the files in the background now (with an inference server, the server indexes them on the next question)
+            if not os.getenv("INFERENCE_SERVER_URL"):
+                ingestion_queue.submit("upload")
+                update_database = False
+
+        # Progress and errors of the indexing jobs
+        jobs = ingestion_queue.jobs()[-3:]
+        if jobs:
+            with st.sidebar:
+                for job in jobs:
+                    if job["state"] in ("queued", "running"):
+                        st.progress(job["progress"], text = text.RAG_INGEST_PROGRESS.format(
+                            step = job["step"] or job["state"], percent = int(100 * job["progress"])
+                        ))
+                    elif job["state"] == "failed":
+                        st.error(text.RAG_INGEST_FAILED.format(error = job["error"]))
+                    else:
+                        st.caption(f"{text.RAG_UPDATE_ANNOUNCEMENT} ({job['summary']})")
+
     return {
         "api_key": api_key,
         "mode": mode,
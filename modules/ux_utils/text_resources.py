@@ -18,6 +18,11 @@ class MainText(Enum):
     RAG_FILE_LABEL = "RAG_FILE_LABEL"
     RAG_PROMPT = "RAG_PROMPT"
     RAG_UPDATE_ANNOUNCEMENT = "RAG_UPDATE_ANNOUNCEMENT"
+    RAG_INGEST_PROGRESS = "RAG_INGEST_PROGRESS"
+    RAG_INGEST_FAILED = "RAG_INGEST_FAILED"
+
+    # Model warm-up
+    WARMUP_PROGRESS = "WARMUP_PROGRESS"
 
 class SideBarText(Enum):
     # API key
@@ -30,6 +35,9 @@ class SideBarText(Enum):
     FUNCTION_CALLING = "FUNCTION_CALLING"
     TRANSCRIPT = "TRANSCRIPT"
 
+    # Model warm-up
+    MODELS_STATUS = "MODELS_STATUS"
+
 class Locale(Enum):
     ENGLISH = "en"
     VIETNAMESE = "vn"
\ No newline at end of file
@@ -0,0 +1,221 @@
+# Importing required libraries (standard library only: the loaders import the models when they run)
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from .lazy_loader import LazyLoader, startup_timer
+
+# Warm-up settings, can be changed in .env
+# Components: chat, bluetooth (the two GGUF models), embedding (bge, RAG), whisper (transcript, UI only)
+WARMUP_COMPONENTS = [c.strip() for c in os.getenv("WARMUP_MODELS", "chat,bluetooth,embedding").split(",") if c.strip()]
+WARMUP_THREADS = int(os.getenv("WARMUP_THREADS", "2"))
+PREFETCH_CHUNK_BYTES = 64 << 20
+
+# Progress callback of a loader: fraction in [0, 1] and a short description of the current step
+Progress = Callable[[float, str], None]
+
+class WarmupTask:
+    """
+    A model loaded in the background, with its readiness and progress.
+    """
+    def __init__(self, name: str, load: Callable[[Progress], None]):
+        self.name = name
+        self.load = load
+        self.state = "pending" # pending -> loading -> ready | failed
+        self.progress = 0.0
+        self.step = ""
+        self.error: Optional[str] = None
+        self.seconds = 0.0
+        self.done = threading.Event()
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "progress": round(self.progress, 3),
+            "step": self.step,
+            "error": self.error,
+            "seconds": round(self.seconds, 2),
+        }
+
+class WarmupManager:
+    """
+    Preload the configured models in background threads at process start.\n
+    + Requests wait for the model they need (wait()) instead of loading it themselves
+    + Per-model readiness and progress are exposed to the UI and the inference server (status())
+    + A failed warm-up does not block anything: the caller then loads the model on its own, as before
+    """
+    def __init__(self, n_threads: int = WARMUP_THREADS):
+        self.tasks: dict[str, WarmupTask] = {}
+        self.components: dict[str, str] = {} # component ("chat", "embedding"...) -> task name
+        self._executor = ThreadPoolExecutor(max_workers = max(1, n_threads), thread_name_prefix = "warmup")
+        self._lock = threading.Lock()
+
+    def register(self, name: str, load: Callable[[Progress], None]) -> WarmupTask:
+        """
+        Register a loader and start it in the background (once per name).
+
+        Args:
+            - name (str) : The name of the task, e.g. a GGUF file name, "embedding" or "whisper".
+            - load (Callable[[Progress], None]) : Loads the model, reporting its progress.
+        """
+        with self._lock:
+            task = self.tasks.get(name)
+            if task is None:
+                task = self.tasks[name] = WarmupTask(name, load)
+                self._executor.submit(self._run, task)
+            return task
+
+    def _run(self, task: WarmupTask) -> None:
+        def progress(fraction: float, step: str = "") -> None:
+            task.progress = max(task.progress, min(fraction, 1.0))
+            task.step = step or task.step
+
+        task.state = "loading"
+        start = time.perf_counter()
+        try:
+            with startup_timer.phase(f"warm up {task.name}"):
+                task.load(progress)
+            task.progress = 1.0
+            task.state = "ready"
+        except Exception as e:
+            task.state = "failed"
+            task.error = str(e)
+            print(f">>> Warm-up of {task.name} failed: {e}")
+        finally:
+            task.seconds = time.perf_counter() - start
+            task.done.set()
+
+    def is_ready(self, name: str) -> bool:
+        task = self.tasks.get(name)
+        return task is None or task.done.is_set()
+
+    def wait(self, name: str, timeout: float = None) -> bool:
+        """
+        Wait until the warm-up of a model is over. Returns at once if it was never registered.
+
+        Returns:
+            bool: True if the model is ready (or has no warm-up), False if it failed or the timeout expired.
+        """
+        task = self.tasks.get(name)
+        if task is None:
+            return True
+        return task.done.wait(timeout) and task.state == "ready"
+
+    def names(self, *components: str) -> list[str]:
+        """
+        Task names of the given components that are warmed up (the others are loaded on first use).
+        """
+        return [self.components[c] for c in components if c in self.components]
+
+    def status(self) -> dict:
+        return {name: task.status() for name, task in self.tasks.items()}
+
+# Global warm-up manager of the process
+warmup = WarmupManager()
+
+### LOADERS
+def prefetch_file(path: str, progress: Progress, start: float = 0.0, end: float = 1.0) -> None:
+    """
+    Read a file once so its pages are in the page cache: the memory-mapped load that follows does not wait on the disk.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb", buffering = 0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        done = 0
+        while True:
+            chunk = f.read(PREFETCH_CHUNK_BYTES)
+            if not chunk:
+                break
+            done += len(chunk)
+            progress(start + (end - start) * done / max(size, 1), f"reading {os.path.basename(path)}")
+
+def _install_models() -> None:
+    from .chatbot_utils.install_utils import install_models
+    install_models()
+
+# Shared by the LLM tasks (downloads the missing GGUF files once)
+models_installed = LazyLoader("install models", _install_models)
+
+def llm_loader(model: str) -> Callable[[Progress], None]:
+    def load(progress: Progress) -> None:
+        from .chatbot_utils import model_pool
+        from .chatbot_utils.scheduler import scheduler, Priority
+        from .chatbot_utils.system_snapshots import ensure_system_snapshots
+        from .chatbot_utils.model_pool import DYNAMIC_CTX_VARIANT
+        from .chatbot_utils.context_policy import DYNAMIC_CTX, context_buckets
+
+        progress(0.0, "installing")
+        models_installed.get()
+        model_path = model_pool.model_path(model)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"{model} is not installed")
+
+        # Weights into the page cache (0-70%), Llama instance (70-90%), system prompt snapshots (90-100%)
+        prefetch_file(model_path, progress, 0.0, 0.7)
+        progress(0.7, "loading weights")
+        with scheduler.slot("startup", Priority.COMMAND, model):
+            if DYNAMIC_CTX:
+                # Per-request context sizes: the snapshots of every bucket are saved now (largest first), so
+                # requests never build them; the smallest buckets stay loaded (CTX_INSTANCES)
+                for n_ctx in reversed(context_buckets(model_pool.default_n_ctx(model))):
+                    llm = model_pool.get(model, n_ctx = n_ctx, variant = DYNAMIC_CTX_VARIANT)
+                    progress(0.9, f"system prompt snapshots (n_ctx={n_ctx})")
+                    ensure_system_snapshots(llm, model)
+            else:
+                llm = model_pool.get(model)
+                progress(0.9, "system prompt snapshots")
+                ensure_system_snapshots(llm, model)
+    return load
+
+def embedding_loader(progress: Progress) -> None:
+    from .agent_tool.tool_rag import embed_model_loader
+    progress(0.0, "loading bge-small-en-v1.5")
+    embed_model_loader.get()
+
+def whisper_loader(progress: Progress) -> None:
+    from .streamlit_utils.utils import whisper_model
+    progress(0.0, "loading whisper large-v3-turbo")
+    whisper_model.get()
+
+def _llm_task(component: str) -> Optional[tuple[str, Callable[[Progress], None]]]:
+    # Imported here: the UI only imports the chatbot (llama_cpp) when the LLMs are warmed up in its process
+    from .chatbot_utils.model_pool import DEFAULT_CHAT_MODEL
+    from .chatbot_utils.system_snapshots import BLUETOOTH_MODEL
+    from .chatbot_utils.worker_pool import WORKER_PROCESSES, in_worker
+
+    # With worker processes, the LLMs are loaded (and warmed up) by the workers only
+    if WORKER_PROCESSES > 0 and not in_worker:
+        return None
+    model = DEFAULT_CHAT_MODEL if component == "chat" else BLUETOOTH_MODEL
+    return model, llm_loader(model)
+
+def start_warmup(components: list[str] = WARMUP_COMPONENTS) -> dict[str, WarmupTask]:
+    """
+    Start the warm-up of the configured components (idempotent).
+
+    Args:
+        - components (list[str]) : Any of "chat", "bluetooth", "embedding" and "whisper" (default: WARMUP_MODELS in .env).
+
+    Returns:
+        dict[str, WarmupTask]: The registered tasks by name.
+    """
+    loaders = {
+        "chat": lambda: _llm_task("chat"),
+        "bluetooth": lambda: _llm_task("bluetooth"),
+        "embedding": lambda: ("embedding", embedding_loader),
+        "whisper": lambda: ("whisper", whisper_loader),
+    }
+    for component in components:
+        if component not in loaders:
+            print(f">>> Unknown warm-up component '{component}', use some of {list(loaders)}")
+            continue
+        task = loaders[component]()
+        if task is None:
+            continue
+        name, load = task
+        warmup.components[component] = name
+        warmup.register(name, load)
+    return warmup.tasks
@@ -0,0 +1,19 @@
+# Importing required libraries
+import argparse
+import asyncio
+from dotenv import load_dotenv
+
+# Load dotenv (before the models are imported)
+load_dotenv()
+
+from modules.lazy_loader import startup_timer
+with startup_timer.phase("import inference server (models, tools)"):
+    from modules.server_utils.inference_server import serve
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Inference server of the chatbot (one warm model process for many UI processes)")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8000)
+    args = parser.parse_args()
+
+    asyncio.run(serve(host = args.host, port = args.port))